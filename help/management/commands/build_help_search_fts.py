@@ -0,0 +1,26 @@
+"""
+Builds (or rebuilds) the full-text search structures for this database
+"""
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from help.search import BACKENDS, FTSBackend, reset_search_backend
+
+
+class Command(NoArgsCommand):
+    help = "Creates the SQLite FTS5 table or PostgreSQL GIN index that full-text help search uses, replacing any existing one"
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        engine = connection.settings_dict['ENGINE']
+        backends = [b for b in BACKENDS.values() if isinstance(b, FTSBackend) and b.engine in engine]
+        for backend in backends:
+            backend.build()
+            if verbosity > 0:
+                print "Built the %s search backend" % backend.name
+        if not backends and verbosity > 0:
+            print "No full-text search backend for %s - search will keep using the term index" % engine
+
+        reset_search_backend()
@@ -0,0 +1,24 @@
+"""
+Drops the full-text search structures for this database
+"""
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from help.search import BACKENDS, FTSBackend, reset_search_backend
+
+
+class Command(NoArgsCommand):
+    help = "Drops the SQLite FTS5 table and triggers or PostgreSQL GIN index that full-text help search uses, so search goes back to the term index"
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        engine = connection.settings_dict['ENGINE']
+        backends = [b for b in BACKENDS.values() if isinstance(b, FTSBackend) and b.engine in engine]
+        for backend in backends:
+            backend.drop()
+            if verbosity > 0:
+                print "Dropped the %s search backend" % backend.name
+
+        reset_search_backend()
@@ -0,0 +1,44 @@
+"""
+Rebuilds the materialized HelpCategory.path index from the parent links
+"""
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from help.models import HelpCategory, path_segment
+
+
+class Command(NoArgsCommand):
+    help = "Recomputes HelpCategory.path for every category, eg after loading fixtures or upgrading"
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        rows = HelpCategory.objects.values_list('pk', 'parent', 'path')
+        parents = dict((pk, parent) for pk, parent, path in rows)
+        current = dict((pk, path) for pk, parent, path in rows)
+
+        paths = {}
+        def build(pk):
+            if pk not in paths:
+                seen = []
+                node = pk
+                while node is not None and node not in paths:
+                    if node in seen:
+                        raise ValueError("Help category %s is its own ancestor" % node)
+                    seen.append(node)
+                    node = parents[node]
+                prefix = paths.get(node, '')
+                for node in reversed(seen):
+                    prefix = paths[node] = prefix + path_segment(node) + '/'
+            return paths[pk]
+
+        changed = 0
+        for pk in parents:
+            path = build(pk)
+            if path != current[pk]:
+                HelpCategory.objects.filter(pk=pk).update(path=path)
+                changed += 1
+
+        if verbosity > 0:
+            print "Rebuilt paths for %s of %s help categories" % (changed, len(parents))
@@ -0,0 +1,53 @@
+"""
+Re-indexes every HelpItem's search content - the denormed column, its 
+HelpSearchTerm postings and search_length - without re-saving the items, 
+then recounts the search stats row
+"""
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from help.models import HelpItem, HelpSearchStats
+
+
+class Command(NoArgsCommand):
+    help = "Re-indexes every HelpItem's search content in chunks, eg after loading fixtures or upgrading"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+            help='How many items to load and commit at a time (default 500)'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options.get('chunk_size') or 500
+
+        count = 0
+        last_pk = 0
+        while True:
+            # seek by pk, so each chunk is one cheap range query however far in we are
+            chunk = list(HelpItem.objects.select_related('category').filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+            if not chunk:
+                break
+            self.reindex(chunk)
+            count += len(chunk)
+            last_pk = chunk[-1].pk
+            if verbosity > 1:
+                print "Re-indexed %s help items..." % count
+
+        HelpSearchStats.objects.rebuild()
+        transaction.commit_unless_managed()
+
+        if verbosity > 0:
+            print "Re-indexed %s help items" % count
+
+    @transaction.commit_on_success
+    def reindex(self, items):
+        for item in items:
+            denormed = item.denorm_search_terms()
+            if denormed != item.denormed_search_terms:
+                # update() rather than save(), to skip re-tagging and the other save() work
+                HelpItem.objects.filter(pk=item.pk).update(denormed_search_terms=denormed)
+                item.denormed_search_terms = denormed
+            item.update_search_index()
@@ -0,0 +1,70 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'HelpCategory'
+        db.create_table('help_helpcategory', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('slug', self.gf('django.db.models.fields.SlugField')(unique=True, max_length=50, db_index=True)),
+            ('published', self.gf('django.db.models.fields.BooleanField')(default=True)),
+            ('order', self.gf('django.db.models.fields.FloatField')(default='1.0')),
+            ('parent', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['help.HelpCategory'], null=True, blank=True)),
+            ('title', self.gf('django.db.models.fields.CharField')(max_length=255)),
+        ))
+        db.send_create_signal('help', ['HelpCategory'])
+
+        # Adding model 'HelpItem'
+        db.create_table('help_helpitem', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('slug', self.gf('django.db.models.fields.SlugField')(unique=True, max_length=50, db_index=True)),
+            ('published', self.gf('django.db.models.fields.BooleanField')(default=True)),
+            ('order', self.gf('django.db.models.fields.FloatField')(default='1.0')),
+            ('category', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['help.HelpCategory'])),
+            ('heading', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('body', self.gf('django.db.models.fields.TextField')()),
+            ('denormed_search_terms', self.gf('django.db.models.fields.TextField')(null=True, blank=True)),
+            ('help_tags', self.gf('tagging.fields.TagField')()),
+        ))
+        db.send_create_signal('help', ['HelpItem'])
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting model 'HelpItem'
+        db.delete_table('help_helpitem')
+
+        # Deleting model 'HelpCategory'
+        db.delete_table('help_helpcategory')
+    
+    
+    models = {
+        'help.helpcategory': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpCategory'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']", 'null': 'True', 'blank': 'True'}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'help.helpitem': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpItem'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']"}),
+            'denormed_search_terms': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'heading': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'help_tags': ('tagging.fields.TagField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'})
+        }
+    }
+    
+    complete_apps = ['help']
@@ -0,0 +1,58 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding field 'HelpCategory.path'
+        db.add_column('help_helpcategory', 'path', self.gf('django.db.models.fields.CharField')(default='', max_length=255, db_index=True, blank=True), keep_default=False)
+
+        # Filling in the path of every existing category, from its parent links
+        if not db.dry_run:
+            parents = dict(orm['help.HelpCategory'].objects.values_list('pk', 'parent'))
+            paths = {}
+            def build(pk):
+                if pk not in paths:
+                    parent = parents[pk]
+                    paths[pk] = (parent is not None and build(parent) or '') + '%06d/' % pk
+                return paths[pk]
+            for pk in parents:
+                orm['help.HelpCategory'].objects.filter(pk=pk).update(path=build(pk))
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting field 'HelpCategory.path'
+        db.delete_column('help_helpcategory', 'path')
+    
+    
+    models = {
+        'help.helpcategory': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpCategory'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']", 'null': 'True', 'blank': 'True'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'help.helpitem': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpItem'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']"}),
+            'denormed_search_terms': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'heading': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'help_tags': ('tagging.fields.TagField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'})
+        }
+    }
+    
+    complete_apps = ['help']
@@ -0,0 +1,78 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'HelpSearchTerm'
+        db.create_table('help_helpsearchterm', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('term', self.gf('django.db.models.fields.CharField')(max_length=64, db_index=True)),
+            ('item', self.gf('django.db.models.fields.related.ForeignKey')(related_name='search_terms', to=orm['help.HelpItem'])),
+            ('frequency', self.gf('django.db.models.fields.FloatField')(default=1.0)),
+        ))
+        db.send_create_signal('help', ['HelpSearchTerm'])
+
+        # Adding unique constraint on 'HelpSearchTerm', fields ['term', 'item']
+        db.create_unique('help_helpsearchterm', ['term', 'item_id'])
+
+        # Indexing the existing items, weighting each field's words as HelpItem.save() does
+        if not db.dry_run:
+            from help.models import MAX_TERM_LENGTH, SEARCH_FIELD_WEIGHTS, search_tokens
+            for item in orm['help.HelpItem'].objects.select_related('category').iterator():
+                fields = {'heading': item.heading, 'body': item.body, 'category_title': item.category.title}
+                frequencies = {}
+                for field, weight in SEARCH_FIELD_WEIGHTS:
+                    for t in search_tokens(fields[field]):
+                        t = t[:MAX_TERM_LENGTH]
+                        frequencies[t] = frequencies.get(t, 0.0) + weight
+                for t, frequency in frequencies.items():
+                    orm['help.HelpSearchTerm'].objects.create(term=t, item=item, frequency=frequency)
+    
+    
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'HelpSearchTerm', fields ['term', 'item']
+        db.delete_unique('help_helpsearchterm', ['term', 'item_id'])
+
+        # Deleting model 'HelpSearchTerm'
+        db.delete_table('help_helpsearchterm')
+    
+    
+    models = {
+        'help.helpcategory': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpCategory'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']", 'null': 'True', 'blank': 'True'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'help.helpitem': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpItem'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']"}),
+            'denormed_search_terms': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'heading': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'help_tags': ('tagging.fields.TagField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'})
+        },
+        'help.helpsearchterm': {
+            'Meta': {'unique_together': "(('term', 'item'),)", 'object_name': 'HelpSearchTerm'},
+            'frequency': ('django.db.models.fields.FloatField', [], {'default': '1.0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'item': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'search_terms'", 'to': "orm['help.HelpItem']"}),
+            'term': ('django.db.models.fields.CharField', [], {'max_length': '64', 'db_index': 'True'})
+        }
+    }
+    
+    complete_apps = ['help']
@@ -0,0 +1,63 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding field 'HelpItem.search_length'
+        db.add_column('help_helpitem', 'search_length', self.gf('django.db.models.fields.FloatField')(default=0.0), keep_default=False)
+
+        # Summing each item's weighted term frequencies from the term index
+        if not db.dry_run:
+            db.execute("""
+            UPDATE help_helpitem
+            SET search_length = COALESCE((
+                SELECT SUM(help_helpsearchterm.frequency)
+                FROM help_helpsearchterm
+                WHERE help_helpsearchterm.item_id = help_helpitem.id), 0)""")
+    
+    
+    def backwards(self, orm):
+        
+        # Deleting field 'HelpItem.search_length'
+        db.delete_column('help_helpitem', 'search_length')
+    
+    
+    models = {
+        'help.helpcategory': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpCategory'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']", 'null': 'True', 'blank': 'True'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'help.helpitem': {
+            'Meta': {'ordering': "['order']", 'object_name': 'HelpItem'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['help.HelpCategory']"}),
+            'denormed_search_terms': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'heading': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'help_tags': ('tagging.fields.TagField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order': ('django.db.models.fields.FloatField', [], {'default': "'1.0'"}),
+            'published': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'search_length': ('django.db.models.fields.FloatField', [], {'default': '0.0'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50', 'db_index': 'True'})
+        },
+        'help.helpsearchterm': {
+            'Meta': {'unique_together': "(('term', 'item'),)", 'object_name': 'HelpSearchTerm'},
+            'frequency': ('django.db.models.fields.FloatField', [], {'default': '1.0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'item': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'search_terms'", 'to': "orm['help.HelpItem']"}),
+            'term': ('django.db.models.fields.CharField', [], {'max_length': '64', 'db_index': 'True'})
+        }
+    }
+    
+    complete_apps = ['help']
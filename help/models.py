@@ -1,14 +1,24 @@
 #help.models
 
+import heapq
+import logging
+import math
 import re
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, F, Sum
 from django.contrib.auth.models import User
 
 from tagging.fields import TagField
-from tagging.models import Tag
+from tagging.models import BULK_CHUNK_SIZE, Tag, TaggedItem, model_infos, register_usage_subset
+from tagging.utils import get_tags_by_name
 
-from help.modelutils import unescape, update_specific_fields
+from help.modelutils import commit_on_success_unless_managed, unescape, update_specific_fields
+from help.search import get_search_backend, search_cache
+
+#how many related items a help item lists by default
+RELATED_ITEMS = getattr(settings, 'HELP_RELATED_ITEMS', 5)
 
 
 class PublishedObjectsManager(models.Manager):
@@ -39,9 +49,17 @@ class HelpBase(models.Model):
 class HelpCategory(HelpBase):
     """
     Main node for a topic area or sub-topic area 
+
+    ``path`` is a materialized path of zero-padded pks from the root down 
+    to (and including) this category, eg "000001/000005/000007/", so that 
+    ancestors, descendants and subtree items are each a single query.
+    It's maintained by save(), and filled in for existing data by the 
+    0002 migration or the rebuild_category_paths command; until then, 
+    categories without one fall back to following the parent links.
     """
     parent    = models.ForeignKey('HelpCategory', null=True, blank=True)
     title     = models.CharField(blank=False, max_length=255, help_text='No HTML in the this label, please')
+    path      = models.CharField(max_length=255, editable=False, blank=True, db_index=True)
 
     class Meta:
         verbose_name=("Help category")
@@ -50,31 +68,215 @@ class HelpCategory(HelpBase):
     def __unicode__(self):
         return u"%s" % (self.title)
 
+    @commit_on_success_unless_managed
+    def save(self, *args, **kwargs):
+        """
+        Overriding save() to keep the materialized path of this category, 
+        and of everything below it if it has moved, up to date - and to 
+        drop cached postings that a change of title could affect. The 
+        save and the rewritten paths are committed together.
+        """
+        old_title = None
+        if self.pk is not None:
+            for title in HelpCategory.objects.filter(pk=self.pk).values_list('title', flat=True):
+                old_title = title
+
+        parent_path = ''
+        if self.parent_id is not None:
+            parent_path = category_path(self.parent_id)
+            if self.pk is not None and path_segment(self.pk) in parent_path.split('/'):
+                raise ValueError("A help category can't be moved underneath itself")
+
+        super(HelpCategory, self).save(*args, **kwargs)
+
+        old_path = self.path
+        self.path = parent_path + path_segment(self.pk) + '/'
+        if self.path != old_path:
+            if old_path:
+                # moved - rewrite the prefix of its own path and every descendant's in one go
+                self.move_paths(old_path, self.path)
+            else:
+                HelpCategory.objects.filter(pk=self.pk).update(path=self.path)
+
+        if old_title is not None and old_title != self.title:
+            self.retitle_items(old_title)
+            search_cache.invalidate(search_tokens(old_title) + search_tokens(self.title))
+
+    def move_paths(self, old_path, new_path):
+        """
+        Swaps the ``old_path`` prefix for ``new_path`` in the path of every 
+        category that starts with it, with a single set-based UPDATE
+        """
+        qn = connection.ops.quote_name
+        path = qn(HelpCategory._meta.get_field('path').column)
+        if 'mysql' in connection.settings_dict['ENGINE']:
+            new_paths = 'CONCAT(%%s, SUBSTR(%s, %%s))' % path
+        else:
+            new_paths = '%%s || SUBSTR(%s, %%s)' % path
+        # paths are only digits and slashes, so there's nothing to escape for LIKE
+        connection.cursor().execute('UPDATE %s SET %s = %s WHERE %s LIKE %%s' % (
+            qn(HelpCategory._meta.db_table), path, new_paths, path), 
+            [new_path, len(old_path) + 1, old_path + '%'])
+        transaction.commit_unless_managed()
+    move_paths.alters_data = True
+
+    def retitle_items(self, old_title):
+        """
+        Swaps ``old_title`` for the current title in the search content of 
+        every item in this category, with set-based UPDATEs rather than 
+        re-saving (and re-tagging) each item: the denormed column gets its 
+        old title suffix replaced, and postings for the title's terms have 
+        their weighted frequencies shifted, inserted or removed. Items whose 
+        denormed column doesn't end with the old title (eg after a queryset 
+        update()) are left out of the UPDATE and re-saved instead.
+        """
+        qn = connection.ops.quote_name
+        item_table = qn(HelpItem._meta.db_table)
+        denormed = qn(HelpItem._meta.get_field('denormed_search_terms').column)
+        if 'mysql' in connection.settings_dict['ENGINE']:
+            new_denormed = 'CONCAT(SUBSTR(%s, 1, CHAR_LENGTH(%s) - %%s), %%s)' % (denormed, denormed)
+        else:
+            new_denormed = 'SUBSTR(%s, 1, LENGTH(%s) - %%s) || %%s' % (denormed, denormed)
+
+        stale_pks = list(HelpItem.objects.filter(category=self).exclude(
+            denormed_search_terms__endswith=old_title.lower()).values_list('pk', flat=True))
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = %s WHERE %s = %%s AND %s %s' % (item_table, denormed, new_denormed, 
+            qn(HelpItem._meta.get_field('category').column), denormed, connection.operators['endswith'] % '%s'), 
+            [len(old_title.lower()), self.title.lower(), self.pk, 
+             '%' + connection.ops.prep_for_like_query(old_title.lower())])
+
+        weight = dict(SEARCH_FIELD_WEIGHTS)['category_title']
+        changes = {}
+        for t in search_tokens(old_title):
+            t = t[:MAX_TERM_LENGTH]
+            changes[t] = changes.get(t, 0.0) - weight
+        for t in search_tokens(self.title):
+            t = t[:MAX_TERM_LENGTH]
+            changes[t] = changes.get(t, 0.0) + weight
+
+        names = {
+            'terms': qn(HelpSearchTerm._meta.db_table), 
+            'items': item_table,
+            'term': qn(HelpSearchTerm._meta.get_field('term').column),
+            'item': qn(HelpSearchTerm._meta.get_field('item').column),
+            'frequency': qn(HelpSearchTerm._meta.get_field('frequency').column),
+            'pk': qn(HelpItem._meta.pk.column),
+            'category': qn(HelpItem._meta.get_field('category').column),
+        }
+        for t, change in changes.items():
+            if not change:
+                continue
+            HelpSearchTerm.objects.filter(term=t, item__category=self).update(frequency=F('frequency') + change)
+            if change > 0:
+                cursor.execute('INSERT INTO %(terms)s (%(term)s, %(item)s, %(frequency)s) '
+                    'SELECT %%s, %(pk)s, %%s FROM %(items)s WHERE %(category)s = %%s '
+                    'AND %(pk)s NOT IN (SELECT %(item)s FROM %(terms)s WHERE %(term)s = %%s)' % names, 
+                    [t, change, self.pk, t])
+        cursor.execute('DELETE FROM %(terms)s WHERE %(frequency)s <= 0 '
+            'AND %(item)s IN (SELECT %(pk)s FROM %(items)s WHERE %(category)s = %%s)' % names, [self.pk])
+
+        length_change = sum(changes.values())
+        if length_change:
+            HelpItem.objects.filter(category=self).update(search_length=F('search_length') + length_change)
+            HelpSearchStats.objects.add(0, length_change * HelpItem.published_objects.filter(category=self).count())
+            # the cached postings of every term in these items carry their search_length
+            search_cache.invalidate(HelpSearchTerm.objects.filter(
+                item__category=self).values_list('term', flat=True).distinct())
+
+        for item in HelpItem.objects.filter(pk__in=stale_pks).select_related('category'):
+            item.save()
+        transaction.commit_unless_managed()
+    retitle_items.alters_data = True
+
     @property
-    def subcategories(self):
-        """Returns a recursively generated list of any subcategories for the category"""
+    def descendants(self):
+        """Returns a queryset of every category below this one, at any depth"""
+        if not self.path:
+            # not indexed yet, so gather the levels below one query at a time instead
+            return HelpCategory.objects.filter(pk__in=self._descendant_ids())
+        return HelpCategory.objects.filter(path__startswith=self.path).exclude(pk=self.pk)
 
-        children = []
-        subcats = list(self.helpcategory_set.all().order_by('order'))
+    @property
+    def subtree_items(self):
+        """Returns a queryset of the published items in this category or any below it"""
+        if not self.path:
+            return HelpItem.published_objects.filter(category__in=[self.pk] + self._descendant_ids())
+        return HelpItem.published_objects.filter(category__path__startswith=self.path)
+
+    def _descendant_ids(self):
+        """Returns the pks of every category below this one, following the parent links"""
+        ids = []
+        level = [self.pk]
+        while level:
+            level = [pk for pk in HelpCategory.objects.filter(parent__in=level).values_list('pk', flat=True)
+                     if pk not in ids and pk != self.pk]
+            ids.extend(level)
+        return ids
 
-        for s in subcats:
-            cats = s.helpcategory_set.all().order_by('order')
-            if len(cats) > 0:
-                children.append([s, s.subcategories])
-            else:
-                children.append([s])
-        return children
+    @property
+    def subcategories(self):
+        """Returns a recursively generated list of any subcategories for the category"""
+        return category_branches(self.descendants.order_by('order'), root=self.pk)
         
     @property
     def trail(self):
-        trail = []
-        parent = self.parent
-        trail.append(self)
-        while parent is not None:
-            trail.append(parent)
-            parent = parent.parent 
-        
-        return trail[::-1]
+        """Returns this category and its ancestors, root first"""
+        if not self.path:
+            # not indexed yet, so walk up the parents instead
+            trail = [self]
+            parent = self.parent
+            while parent is not None:
+                trail.append(parent)
+                parent = parent.parent
+            return trail[::-1]
+
+        ids = [int(segment) for segment in self.path.split('/') if segment]
+        ancestors = HelpCategory.objects.in_bulk(ids[:-1])
+        return [ancestors[pk] for pk in ids[:-1] if pk in ancestors] + [self]
+
+
+def path_segment(pk):
+    """Formats a pk as one fixed-width step of a HelpCategory.path"""
+    return '%06d' % pk
+
+
+def category_path(pk):
+    """
+    Returns the path of the category with the given pk - filling in its 
+    own and its ancestors' first, if they haven't been indexed yet
+    """
+    parent_id, path = HelpCategory.objects.filter(pk=pk).values_list('parent', 'path')[0]
+    if not path:
+        path = (parent_id is not None and category_path(parent_id) or '') + path_segment(pk) + '/'
+        HelpCategory.objects.filter(pk=pk).update(path=path)
+    return path
+
+
+def category_branches(categories, root=None):
+    """
+    Assembles an iterable of categories into the nested lists that
+    category_nest.html recurses over - [category] for a leaf, 
+    [category, [branch, branch...]] for a node with children - starting 
+    from the children of ``root`` (a category pk, or None for the top level).
+
+    Evaluates ``categories`` once and does the rest in memory, so pass in 
+    an ordered queryset and the whole tree costs a single query.
+    """
+    children = {}
+    for category in categories:
+        children.setdefault(category.parent_id, []).append(category)
+
+    def branch(parent_id):
+        nodes = []
+        for category in children.get(parent_id, []):
+            if category.pk in children:
+                nodes.append([category, branch(category.pk)])
+            else:
+                nodes.append([category])
+        return nodes
+
+    return branch(root)
 
 
 class HelpItemSearchManager(PublishedObjectsManager):
@@ -83,28 +285,169 @@ class HelpItemSearchManager(PublishedObjectsManager):
     so that it only searches published objects 
     """
 
-    def search(self, search_terms):
+    def search(self, search_terms, after=None):
+        """
+        Returns a queryset of the published items matching the search, in pk 
+        order. To page through it without OFFSET or COUNT(*), slice off a 
+        page and pass the pk of its last item as ``after`` to seek to the next.
+        """
+        if search_terms is None:
+            return self.model.objects.none()
         try:
-            search_terms = search_terms[:64] #limit to 64 chars
-            query = None
-            qs = self.get_query_set() 
-
-            search_terms = unescape(search_terms)
-            query = search_terms.lower()
-            query = re.sub(r'\W+', ' ', query)    #strip non-alphanumerics from string
-            tokens = query.split()
-
-            for t in tokens:
-                # iteratively build a chain of filter()s that narrow down the search selection
-                # to contain all words that are or start with every one of the tokens entered 
-                qs = qs.filter(denormed_search_terms__contains = " %s" % t)
-            
+            qs = self._matching(self.query_tokens(search_terms)).order_by('pk')
+            if after is not None:
+                qs = qs.filter(pk__gt=after)
             return qs
 
         except Exception, e:
             logging.error("%s when searching for %s -- %s" % (type(e), search_terms, e) )
             return self.model.objects.none()
 
+    def ranked_search(self, search_terms, limit=20, after=None):
+        """
+        Returns a list of the ``limit`` best hits for the search, best first, 
+        each with a BM25 ``score`` attribute. Scores the postings of each 
+        token (from search_cache, or one query per token that isn't cached) 
+        and keeps only the top ``limit`` in a heap rather than sorting every 
+        hit, so only that page of items is ever loaded. When a token is too 
+        common for its postings to be cached, the search backend (see 
+        help.search) picks the candidates, and only those are scored.
+
+        To get the next page, pass the (score, pk) of the last hit as ``after``.
+        """
+        try:
+            tokens = self.query_tokens(search_terms)
+            if not tokens:
+                return []
+
+            scores = self._scores(tokens, self._postings(tokens))
+            ranks = ((score, -pk) for pk, score in scores.iteritems())
+            if after is not None:
+                after = (after[0], -after[1])
+                ranks = (rank for rank in ranks if rank < after)
+            top = heapq.nlargest(limit, ranks)
+            if not top:
+                return []
+
+            items = self.get_query_set().select_related('category').in_bulk([-pk for score, pk in top])
+            ranked = []
+            for score, pk in top:
+                if -pk in items:
+                    item = items[-pk]
+                    item.score = score
+                    ranked.append(item)
+            return ranked
+
+        except Exception, e:
+            logging.error("%s when ranking a search for %s -- %s" % (type(e), search_terms, e) )
+            return []
+
+    def _postings(self, tokens):
+        """
+        Returns a dict of each token to its postings - a dict of the pk of 
+        each published item with a term starting with it to its 
+        (frequency, search_length) - or, for a token with more than 
+        search_cache.max_postings of them, just how many items it's in
+        """
+        postings = search_cache.get_many(tokens)
+        missing = {}
+        for t in set(tokens) - set(postings):
+            terms = HelpSearchTerm.objects.filter(term__startswith=t, item__in=self.get_query_set().values('pk'))
+            rows = list(terms.values_list('item', 'frequency', 'item__search_length')[:search_cache.max_postings + 1])
+            if len(rows) > search_cache.max_postings:
+                missing[t] = terms.values('item').distinct().count()
+            else:
+                missing[t] = self._sum_postings(rows)
+        if missing:
+            search_cache.set_many(missing)
+            postings.update(missing)
+        return postings
+
+    def _sum_postings(self, rows):
+        """Turns (item pk, frequency, search_length) rows into postings"""
+        postings = {}
+        for pk, frequency, length in rows:
+            # a prefix can match several words in one item - count them all as the one term
+            postings[pk] = (postings.get(pk, (0.0, length))[0] + frequency, length)
+        return postings
+
+    def _scores(self, tokens, postings):
+        """
+        Returns a dict of the pk of every item matching all of ``tokens`` to 
+        its BM25 score, from their ``postings`` as _postings() returns them
+        """
+        common = set([t for t in tokens if not isinstance(postings[t], dict)])
+        cached = [postings[t] for t in tokens if t not in common]
+        if common:
+            # a token's in too many items for its postings to be cached, so 
+            # let the search backend pick the items that have them all, and 
+            # read only their postings for it
+            hits = set(self._matching(tokens).values_list('pk', flat=True))
+        else:
+            hits = set(cached[0])
+        for token_postings in cached:
+            hits.intersection_update(token_postings)
+        if not hits:
+            return {}
+
+        postings = dict(postings)
+        document_frequencies = {}
+        candidates = list(hits)
+        for t in set(tokens):
+            if t not in common:
+                document_frequencies[t] = len(postings[t])
+                continue
+            document_frequencies[t], rows = postings[t], []
+            for i in range(0, len(candidates), BULK_CHUNK_SIZE):
+                rows.extend(HelpSearchTerm.objects.filter(term__startswith=t, item__in=candidates[i:i + BULK_CHUNK_SIZE]
+                    ).values_list('item', 'frequency', 'item__search_length'))
+            postings[t] = self._sum_postings(rows)
+            # in case a full-text backend and the term index disagree
+            hits.intersection_update(postings[t])
+
+        size, average_length = HelpSearchStats.objects.corpus()
+
+        scores = dict.fromkeys(hits, 0.0)
+        for t in tokens:
+            document_frequency = document_frequencies[t]
+            idf = math.log(1.0 + (size - document_frequency + 0.5) / (document_frequency + 0.5))
+            for pk in hits:
+                tf, length = postings[t][pk]
+                norm = BM25_K1 * (1.0 - BM25_B + BM25_B * length / average_length)
+                scores[pk] += idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+        return scores
+
+    def query_tokens(self, search_terms):
+        """Normalises a raw search query into the tokens to look up"""
+        search_terms = (search_terms or '')[:64] #limit to 64 chars
+        return [t[:MAX_TERM_LENGTH] for t in search_tokens(unescape(search_terms))]
+
+    def _matching(self, tokens):
+        return get_search_backend().filter(self.get_query_set(), tokens)
+
+
+# BM25 tuning - term frequency saturation and document length normalisation
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# how much an occurrence of a word in each field counts towards its term frequency
+SEARCH_FIELD_WEIGHTS = (
+    ('heading', 3.0),
+    ('body', 1.0),
+    ('category_title', 1.0),
+)
+
+
+def search_tokens(text):
+    """
+    Splits text into the lowercased alphanumeric words used both to 
+    index help items and to search for them
+    """
+    text = text.lower()
+    text = re.sub(r'\W+', ' ', text)    #strip non-alphanumerics from string
+    return text.split()
+
 
 class HelpItem(HelpBase):
     """
@@ -117,6 +460,7 @@ class HelpItem(HelpBase):
     #add another manager, to help with search, plus a denormed search content column to speed things up
     search_manager    = HelpItemSearchManager()
     denormed_search_terms = models.TextField(editable=False, blank=True, null=True)
+    search_length = models.FloatField(editable=False, default=0.0)  #weighted count of words, for ranking
 
     help_tags = TagField("Tags", help_text="Optional tags that will help this item be shown on other pages. Put spaces between tags. Avoid all punctuation. If a tag is multiple words, enclose it in quote marks. Consult the official list of which tags the system is expecting to associated with which pages. Cheers!")
 
@@ -125,6 +469,9 @@ class HelpItem(HelpBase):
         verbose_name_plural=("Help item")
         
     def _get_tags(self):
+        #tags cached for a whole list of items by tagging.generic.prefetch_tags()
+        if getattr(self, '_prefetched_tags', None) is not None:
+            return self._prefetched_tags
         return Tag.objects.get_for_object(self)
 
     def _set_tags(self, tag_list):
@@ -133,22 +480,241 @@ class HelpItem(HelpBase):
     tags = property(_get_tags, _set_tags)    
 
 
-    def save(self):
+    def save(self, *args, **kwargs):
         """
-        Overriding save() to denorm the search content - we could 
-        use Full Text Searching instead, but that's not DB-independent.
+        Overriding save() to denorm the search content - Full Text 
+        Searching isn't DB-independent, so the denormed column is what 
+        the optional FTS backends in help.search index where they're built.
         
-        Includes category.title to improve hit usefulness
+        Includes category.title to improve hit usefulness. The terms are 
+        also split into the HelpSearchTerm index that every backend falls 
+        back to and ranked_search() scores from.
+        """
+        was_published, old_length = None, 0.0
+        if self.pk is not None:
+            for published, length in HelpItem.objects.filter(pk=self.pk).values_list('published', 'search_length'):
+                was_published, old_length = published, length
+
+        self.denormed_search_terms = self.denorm_search_terms()
+        frequencies = self.search_term_frequencies()
+        self.search_length = sum(frequencies.values())
+        super(HelpItem, self).save(*args, **kwargs)
+        self.update_search_index(frequencies)
+        HelpSearchStats.objects.add(int(self.published) - int(bool(was_published)), 
+            (self.published and self.search_length) - (was_published and old_length or 0.0))
+
+        if was_published is not None and was_published != self.published:
+            # appearing in or vanishing from search affects every query that can match it
+            search_cache.invalidate(frequencies.keys())
+
+    def denorm_search_terms(self):
+        """Returns the lowercased text that denormed_search_terms should hold"""
+        return self.heading.lower() + " " + self.body.lower() + " " + self.category.title.lower()
+
+    def search_term_frequencies(self):
+        """
+        Returns a dict of each search term in the item to its term frequency, 
+        weighted by SEARCH_FIELD_WEIGHTS so that heading matches rank higher
+        """
+        fields = {'heading': self.heading, 'body': self.body, 'category_title': self.category.title}
+        frequencies = {}
+        for field, weight in SEARCH_FIELD_WEIGHTS:
+            for t in search_tokens(fields[field]):
+                t = t[:MAX_TERM_LENGTH]
+                frequencies[t] = frequencies.get(t, 0.0) + weight
+        return frequencies
+
+    def update_search_index(self, frequencies=None):
         """
-        self.denormed_search_terms = self.heading.lower() + " " + self.body.lower() + " " + self.category.title.lower()
-        super(HelpItem, self).save()
+        Brings this item's postings in the HelpSearchTerm index (and its 
+        search_length) into line with its content, touching only the terms 
+        that were added, removed or changed frequency - and drops the 
+        cached postings those terms (or all of its terms, if its length 
+        changed) could be in
+        """
+        if frequencies is None:
+            frequencies = self.search_term_frequencies()
+            search_length = sum(frequencies.values())
+            if search_length != self.search_length:
+                HelpItem.objects.filter(pk=self.pk).update(search_length=search_length)
+                if self.published:
+                    HelpSearchStats.objects.add(0, search_length - self.search_length)
+                self.search_length = search_length
+
+        current = dict(HelpSearchTerm.objects.filter(item=self).values_list('term', 'frequency'))
+
+        stale = [t for t in current if frequencies.get(t) != current[t]]
+        if stale:
+            HelpSearchTerm.objects.filter(item=self, term__in=stale).delete()
+
+        new = [t for t in frequencies if current.get(t) != frequencies[t]]
+        if new:
+            opts = HelpSearchTerm._meta
+            qn = connection.ops.quote_name
+            sql = 'INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (qn(opts.db_table),
+                qn(opts.get_field('term').column), qn(opts.get_field('item').column), 
+                qn(opts.get_field('frequency').column))
+            connection.cursor().executemany(sql, [(t, self.pk, frequencies[t]) for t in new])
+            transaction.commit_unless_managed()
+
+        if sum(current.values()) != sum(frequencies.values()):
+            # the cached postings of all its terms carry its search_length
+            search_cache.invalidate(set(current) | set(frequencies))
+        else:
+            search_cache.invalidate(set(stale) | set(new))
+    update_search_index.alters_data = True
         
     def __unicode__(self):
          return u"%s: '%s' " % (self.category.title, self.heading)
 
     @property
     def related_items(self):
-        "Returns a list of items in the same category as before"
-        related = self.parent.helpitem_set.exclude(id=self.id)
-        return related
+        """
+        Returns a list of up to HELP_RELATED_ITEMS published items related 
+        to this one - those sharing the rarest tags first, then the rest of 
+        its category in order. Uses what prefetch_related_items() has 
+        stored, if it's been run.
+        """
+        if not hasattr(self, '_related_items_cache'):
+            prefetch_related_items([self], RELATED_ITEMS)
+        return self._related_items_cache
+
+
+def prefetch_related_items(items, num=RELATED_ITEMS):
+    """
+    Works out related_items for a whole list of help items at once, in a 
+    constant number of queries however long the list is, and stores them 
+    where each item's related_items property will find them. Each item 
+    gets at most ``num`` related items, or all of them if ``num`` is None.
+
+    Related items are ranked as TaggedItem.objects.get_related() ranks 
+    them, by the weight of the tags they share, and are followed by the 
+    rest of each item's category, by order.
+    """
+    items = list(items)
+    if not items:
+        return items
+
+    published = HelpItem.published_objects.select_related('category')
+    related = TaggedItem.objects.get_related_in_bulk(items, published, num=num)
+
+    short = [item for item in items if num is None or len(related[item.pk]) < num]
+    siblings = {}
+    category_ids = list(set([item.category_id for item in short]))
+    for i in range(0, len(category_ids), BULK_CHUNK_SIZE):
+        for pk, category_id in published.filter(category__in=category_ids[i:i + BULK_CHUNK_SIZE]).order_by(
+                'order', 'pk').values_list('pk', 'category'):
+            siblings.setdefault(category_id, []).append(pk)
+
+    wanted = {}
+    for item in short:
+        exclude = set([item.pk] + [other.pk for other in related[item.pk]])
+        pks = [pk for pk in siblings.get(item.category_id, []) if pk not in exclude]
+        if num is not None:
+            pks = pks[:num - len(related[item.pk])]
+        wanted[item.pk] = pks
+    found = {}
+    wanted_pks = list(set([pk for pks in wanted.values() for pk in pks]))
+    for i in range(0, len(wanted_pks), BULK_CHUNK_SIZE):
+        found.update(published.in_bulk(wanted_pks[i:i + BULK_CHUNK_SIZE]))
+
+    for item in items:
+        item._related_items_cache = related[item.pk] + [found[pk] for pk in wanted.get(item.pk, []) 
+            if pk in found]
+    return items
+
+
+MAX_TERM_LENGTH = 64
+
+class HelpSearchTerm(models.Model):
+    """
+    Inverted index for search - one row (posting) per distinct word per 
+    help item, maintained by HelpItem.save(). Plain indexed columns keep 
+    it DB-independent, and term__startswith keeps prefix matching cheap.
+    """
+    term      = models.CharField(max_length=MAX_TERM_LENGTH, db_index=True)
+    item      = models.ForeignKey('HelpItem', related_name='search_terms')
+    frequency = models.FloatField(default=1.0)  #weighted occurrences of the term in the item
+
+    class Meta:
+        unique_together = (('term', 'item'),)
 
+    def __unicode__(self):
+        return u"%s -> %s" % (self.term, self.item_id)
+
+
+class HelpSearchStatsManager(models.Manager):
+
+    def corpus(self):
+        """
+        Returns the number of published items and their average 
+        search_length, for BM25 - from the stats row, so searching never 
+        needs to count or average the items
+        """
+        for items, total_length in self.filter(pk=1).values_list('items', 'total_length'):
+            break
+        else:
+            items, total_length = self.rebuild()
+        return items, (items and total_length / items) or 1.0
+
+    def add(self, items, length):
+        """Counts ``items`` more published items, with ``length`` more search_length between them"""
+        if items or length:
+            if not self.filter(pk=1).update(items=F('items') + items, total_length=F('total_length') + length):
+                self.rebuild()
+
+    def rebuild(self):
+        """Recounts the stats row from the published items, returning (items, total_length)"""
+        corpus = HelpItem.published_objects.aggregate(items=Count('pk'), total_length=Sum('search_length'))
+        items, total_length = corpus['items'], corpus['total_length'] or 0.0
+        if not self.filter(pk=1).update(items=items, total_length=total_length):
+            sid = transaction.savepoint()
+            try:
+                self.create(pk=1, items=items, total_length=total_length)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # a concurrent rebuild got there first, with the same numbers
+                transaction.savepoint_rollback(sid)
+        return items, total_length
+
+class HelpSearchStats(models.Model):
+    """
+    The published item count and total search_length that ranked_search() 
+    needs, in a single row kept in step by HelpItem's write paths. Updates 
+    that bypass them (eg queryset.update()) need a rebuild_help_search_index.
+    """
+    items        = models.IntegerField(default=0)
+    total_length = models.FloatField(default=0.0)
+
+    objects = HelpSearchStatsManager()
+
+    class Meta:
+        verbose_name_plural = "Help search stats"
+
+    def __unicode__(self):
+        return u"%s items, %s long" % (self.items, self.total_length)
+
+
+def forget_deleted_item(sender, instance, **kwargs):
+    """Drops the cached postings that a deleted help item could be in, and uncounts it"""
+    search_cache.invalidate(instance.search_terms.values_list('term', flat=True))
+    # the stored values, as a category retitle can change search_length under a loaded item
+    for published, length in HelpItem.objects.filter(pk=instance.pk).values_list('published', 'search_length'):
+        if published:
+            HelpSearchStats.objects.add(-1, -length)
+
+models.signals.pre_delete.connect(forget_deleted_item, sender=HelpItem)
+
+# the category pages' tag cloud only counts published items, so keep
+# their tag usage counted separately rather than recounting it per view
+register_usage_subset(HelpItem, 'published', published=True)
+
+
+def get_tag_id(name):
+    """
+    Returns the id of the tag called ``name``, or None if there's no such 
+    tag - from tagging's cache of tag ids, which only holds tags that exist
+    """
+    for tag in get_tags_by_name([name]):
+        return tag.id
+    return None
@@ -4,6 +4,10 @@ Handy utils gathered from the web
 
 import re, htmlentitydefs
 
+from django.db import transaction
+
+from tagging.utils import commit_on_success_unless_managed
+
 def unescape(text):
     """
     Hat-tip to http://effbot.org/zone/re-sub.htm#unescape-html        
@@ -0,0 +1,269 @@
+"""
+Pluggable backends for matching help items against search tokens.
+
+Every backend narrows a HelpItem queryset down to the items containing
+a word that is or starts with every token - they only differ in which
+index does the work:
+
+ * TermIndexBackend - the DB-independent HelpSearchTerm inverted index
+ * SQLiteFTSBackend - an FTS5 table kept in step by triggers
+ * PostgreSQLFTSBackend - a GIN index over to_tsvector() of the denormed terms
+
+The full-text ones need building with the build_help_search_fts command, 
+and drop_help_search_fts removes them again.
+Set HELP_SEARCH_BACKEND to 'index', 'sqlite_fts' or 'postgresql_fts' to
+force one; by default ('auto') a full-text backend is used if it matches
+the database and has been built, falling back to the term index otherwise.
+
+HelpItemSearchManager.search() filters with the selected backend, and 
+ranked_search() uses it to pick the candidates of queries with a token 
+too common for its postings to be cached.
+"""
+
+import base64
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from django.db import connection, transaction
+
+
+class TermIndexBackend(object):
+    """Intersects one HelpSearchTerm prefix lookup per token"""
+
+    name = 'index'
+
+    def is_available(self):
+        return True
+
+    def filter(self, qs, tokens):
+        from help.models import HelpSearchTerm
+        for t in tokens:
+            # iteratively build a chain of filter()s that narrow down the search selection
+            # to items with a term that is or starts with every one of the tokens entered -
+            # each one an indexed range scan of the term index, intersected by the DB
+            postings = HelpSearchTerm.objects.filter(term__startswith=t).values('item')
+            qs = qs.filter(pk__in=postings)
+        return qs
+
+    def build(self):
+        pass
+
+    def drop(self):
+        pass
+
+
+class FTSBackend(TermIndexBackend):
+    """Shared plumbing for the database-specific full-text backends"""
+
+    engine = None
+
+    def is_available(self):
+        return self.engine in connection.settings_dict['ENGINE'] and self.is_built()
+
+    def filter(self, qs, tokens):
+        if not tokens:
+            return qs
+        return qs.extra(where=[self.where_sql(qs.model)], params=[self.query_for(tokens)])
+
+    def _execute(self, statements):
+        cursor = connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        transaction.commit_unless_managed()
+
+    def _names(self, model):
+        qn = connection.ops.quote_name
+        return {
+            'table': qn(model._meta.db_table),
+            'pk': qn(model._meta.pk.column),
+            'column': qn(model._meta.get_field('denormed_search_terms').column),
+            'fts': qn(model._meta.db_table + '_fts'),
+            'trigger': model._meta.db_table + '_fts',
+        }
+
+
+class SQLiteFTSBackend(FTSBackend):
+    """
+    Uses an external-content FTS5 table over denormed_search_terms,
+    which triggers on the item table keep up to date
+    """
+
+    name = 'sqlite_fts'
+    engine = 'sqlite3'
+
+    def is_built(self):
+        from help.models import HelpItem
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [HelpItem._meta.db_table + '_fts'])
+        return cursor.fetchone() is not None
+
+    def where_sql(self, model):
+        return '%(table)s.%(pk)s IN (SELECT rowid FROM %(fts)s WHERE %(fts)s MATCH %%s)' % self._names(model)
+
+    def query_for(self, tokens):
+        # implicit AND of quoted prefix queries
+        return ' '.join(['"%s"*' % t for t in tokens])
+
+    def build(self):
+        from help.models import HelpItem
+        names = self._names(HelpItem)
+        self.drop()
+        self._execute([sql % names for sql in (
+            # underscores are part of a word, as they are to search_tokens()
+            "CREATE VIRTUAL TABLE %(fts)s USING fts5(%(column)s, content=%(table)s, content_rowid=%(pk)s, "
+                "tokenize=\"unicode61 tokenchars '_'\")",
+            "INSERT INTO %(fts)s (%(fts)s) VALUES ('rebuild')",
+            """CREATE TRIGGER %(trigger)s_ai AFTER INSERT ON %(table)s BEGIN
+                 INSERT INTO %(fts)s (rowid, %(column)s) VALUES (new.%(pk)s, new.%(column)s);
+               END""",
+            """CREATE TRIGGER %(trigger)s_ad AFTER DELETE ON %(table)s BEGIN
+                 INSERT INTO %(fts)s (%(fts)s, rowid, %(column)s) VALUES ('delete', old.%(pk)s, old.%(column)s);
+               END""",
+            """CREATE TRIGGER %(trigger)s_au AFTER UPDATE ON %(table)s BEGIN
+                 INSERT INTO %(fts)s (%(fts)s, rowid, %(column)s) VALUES ('delete', old.%(pk)s, old.%(column)s);
+                 INSERT INTO %(fts)s (rowid, %(column)s) VALUES (new.%(pk)s, new.%(column)s);
+               END""",
+        )])
+
+    def drop(self):
+        from help.models import HelpItem
+        names = self._names(HelpItem)
+        # the triggers go first, so the item table never writes to a missing FTS table
+        self._execute([sql % names for sql in (
+            "DROP TRIGGER IF EXISTS %(trigger)s_ai",
+            "DROP TRIGGER IF EXISTS %(trigger)s_ad",
+            "DROP TRIGGER IF EXISTS %(trigger)s_au",
+            "DROP TABLE IF EXISTS %(fts)s",
+        )])
+
+
+class PostgreSQLFTSBackend(FTSBackend):
+    """
+    Uses a GIN expression index over to_tsvector() of denormed_search_terms,
+    so there's nothing extra to keep up to date. The 'simple' configuration
+    and the same non-alphanumeric splitting as search_tokens() keep matches
+    identical to the term index - no stemming or stop words.
+    """
+
+    name = 'postgresql_fts'
+    engine = 'postgresql'
+
+    def is_built(self):
+        from help.models import HelpItem
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [HelpItem._meta.db_table + '_fts'])
+        return cursor.fetchone() is not None
+
+    def _vector(self, column):
+        return ("to_tsvector('simple', regexp_replace(lower(coalesce(%s, '')), "
+                "'[^[:alnum:]_]+', ' ', 'g'))" % column)
+
+    def where_sql(self, model):
+        return "%s @@ to_tsquery('simple', %%s)" % self._vector('%(table)s.%(column)s' % self._names(model))
+
+    def query_for(self, tokens):
+        return ' & '.join(["'%s':*" % t for t in tokens])
+
+    def build(self):
+        from help.models import HelpItem
+        names = self._names(HelpItem)
+        names['vector'] = self._vector(names['column'])
+        self.drop()
+        self._execute(['CREATE INDEX %(fts)s ON %(table)s USING GIN (%(vector)s)' % names])
+
+    def drop(self):
+        from help.models import HelpItem
+        self._execute(['DROP INDEX IF EXISTS %(fts)s' % self._names(HelpItem)])
+
+
+BACKENDS = dict([(backend.name, backend) for backend in
+    (TermIndexBackend(), SQLiteFTSBackend(), PostgreSQLFTSBackend())])
+
+_selected = []
+
+def get_search_backend():
+    """
+    Returns the backend named by settings.HELP_SEARCH_BACKEND or, for
+    'auto', the first available full-text one - worked out once per process
+    """
+    if not _selected:
+        name = getattr(settings, 'HELP_SEARCH_BACKEND', 'auto')
+        if name == 'auto':
+            for name in ('sqlite_fts', 'postgresql_fts', 'index'):
+                if BACKENDS[name].is_available():
+                    break
+        _selected.append(BACKENDS[name])
+    return _selected[0]
+
+def reset_search_backend():
+    """Forgets the selected backend, eg after building full-text indexes"""
+    del _selected[:]
+
+
+def encode_cursor(score, pk):
+    """Packs the position of a ranked search hit into an opaque URL-safe cursor"""
+    return base64.urlsafe_b64encode('%r:%d' % (score, pk))
+
+def decode_cursor(cursor):
+    """
+    Unpacks a cursor from encode_cursor() back into (score, pk), or returns 
+    None if there isn't one or it has been tampered with
+    """
+    try:
+        score, pk = base64.urlsafe_b64decode(str(cursor)).split(':')
+        return float(score), int(pk)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        return None
+
+
+class SearchCache(object):
+    """
+    Caches the postings ranked_search() scores from, per query token, in 
+    Django's cache framework: a dict of the pk of every published item 
+    with a term starting with the token to its (term frequency, 
+    search_length). A token with more than HELP_SEARCH_CACHE_MAX_POSTINGS 
+    postings - a short prefix, say - has only how many items it's in 
+    cached, so no one entry grows past the bound (or memcached's 1MB).
+
+    BM25 scores are worked out from these when read, with the corpus 
+    statistics as they are then, so a cached entry never goes stale just 
+    because some other item changed. Changing an item (or a category 
+    title) deletes the entries for all prefixes of the terms whose 
+    postings changed. Otherwise entries last HELP_SEARCH_CACHE_TIMEOUT 
+    seconds, unless the cache backend evicts them first - memcached 
+    evicts least recently used entries, locmem a random third when full.
+    """
+
+    prefix = 'help-search'
+
+    def __init__(self):
+        self.timeout = getattr(settings, 'HELP_SEARCH_CACHE_TIMEOUT', 60 * 60)
+        self.max_postings = getattr(settings, 'HELP_SEARCH_CACHE_MAX_POSTINGS', 1000)
+
+    def _key(self, token):
+        # hashed, since tokens needn't be valid (or short enough) memcached keys
+        return '%s:p:%s' % (self.prefix, md5_constructor(token.encode('utf-8')).hexdigest())
+
+    def get_many(self, tokens):
+        """
+        Returns a dict of each of ``tokens`` that's cached to its postings, 
+        or to its document frequency if it has too many postings to cache
+        """
+        keys = dict([(self._key(t), t) for t in tokens])
+        return dict([(keys[k], postings) for k, postings in cache.get_many(keys.keys()).items()])
+
+    def set_many(self, postings):
+        cache.set_many(dict([(self._key(t), p) for t, p in postings.items()]), self.timeout)
+
+    def invalidate(self, terms):
+        """Drops the postings of every token that is a prefix of any of ``terms``"""
+        keys = set()
+        for term in terms:
+            for i in range(1, len(term) + 1):
+                keys.add(self._key(term[:i]))
+        if keys:
+            cache.delete_many(list(keys))
+
+search_cache = SearchCache()
@@ -1 +1,520 @@
-#tests to come here
\ No newline at end of file
+"""
+Tests for django-help-pages
+"""
+
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from help import search
+from tagging.generic import prefetch_tags
+from tagging.models import Tag
+from tagging.tests import TagCacheTestCase
+
+from help.models import RELATED_ITEMS, HelpCategory, HelpItem, HelpSearchStats, HelpSearchTerm, category_branches, get_tag_id, prefetch_related_items
+
+
+class CategoryTestCase(TestCase):
+    """Builds a small category tree: 1 -> (1.1, 1.2 -> 1.2.1), 2"""
+
+    def setUp(self):
+        cache.clear()
+        self.top1 = HelpCategory.objects.create(title="Top 1", slug="top-1", order=1)
+        self.top2 = HelpCategory.objects.create(title="Top 2", slug="top-2", order=2)
+        self.sub11 = HelpCategory.objects.create(title="Sub 1.1", slug="sub-11", parent=self.top1, order=1)
+        self.sub12 = HelpCategory.objects.create(title="Sub 1.2", slug="sub-12", parent=self.top1, order=2)
+        self.sub121 = HelpCategory.objects.create(title="Sub 1.2.1", slug="sub-121", parent=self.sub12, order=1)
+
+
+class TestCategoryBranches(CategoryTestCase):
+
+    def test_branches_for_whole_tree(self):
+        branches = category_branches(HelpCategory.objects.order_by('order'))
+        self.assertEquals(branches, [
+            [self.top1, [[self.sub11], [self.sub12, [[self.sub121]]]]],
+            [self.top2],
+        ])
+
+    def test_branches_below_a_category(self):
+        self.assertEquals(self.top1.subcategories, [[self.sub11], [self.sub12, [[self.sub121]]]])
+        self.assertEquals(self.sub121.subcategories, [])
+
+    def test_unpublished_categories_prune_their_branch(self):
+        self.sub12.published = False
+        self.sub12.save()
+        branches = category_branches(HelpCategory.published_objects.order_by('order'))
+        self.assertEquals(branches, [[self.top1, [[self.sub11]]], [self.top2]])
+
+
+class TestCategoryPaths(CategoryTestCase):
+
+    def test_paths_are_built_on_save(self):
+        self.assertEquals(self.top1.path, '%06d/' % self.top1.pk)
+        self.assertEquals(self.sub121.path, '%06d/%06d/%06d/' % (self.top1.pk, self.sub12.pk, self.sub121.pk))
+
+    def test_trail(self):
+        self.assertEquals(self.sub121.trail, [self.top1, self.sub12, self.sub121])
+        self.assertEquals(self.top2.trail, [self.top2])
+
+    def test_descendants_and_subtree_items(self):
+        self.assertEquals(set(self.top1.descendants), set([self.sub11, self.sub12, self.sub121]))
+        item = HelpItem.objects.create(category=self.sub121, heading="Deep", body="Down here", slug="deep")
+        HelpItem.objects.create(category=self.top2, heading="Elsewhere", body="Over there", slug="elsewhere")
+        self.assertEquals(list(self.top1.subtree_items), [item])
+
+    def test_moving_a_category_moves_its_descendants(self):
+        self.sub12.parent = self.top2
+        self.sub12.save()
+        sub121 = HelpCategory.objects.get(pk=self.sub121.pk)
+        self.assertEquals(sub121.trail, [self.top2, self.sub12, sub121])
+        self.assertEquals(self.top1.subcategories, [[self.sub11]])
+
+    def test_moving_rewrites_paths_in_one_update(self):
+        for i in range(5):
+            HelpCategory.objects.create(title="Deeper %s" % i, slug="deeper-%s" % i, parent=self.sub121)
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            connection.queries = []
+            self.sub12.parent = self.top2
+            self.sub12.save()
+            updates = [q['sql'] for q in connection.queries if q['sql'].startswith('UPDATE')]
+        finally:
+            settings.DEBUG = old_debug
+        # the save itself, then every path under the old one at once
+        self.assertEquals(len(updates), 2)
+        prefix = self.top2.path + self.sub12.path[-7:]
+        self.assertEquals(HelpCategory.objects.filter(path__startswith=prefix).count(), 7)
+        self.assertEquals(HelpCategory.objects.get(pk=self.sub12.pk).path, prefix)
+
+    def test_cannot_move_a_category_beneath_itself(self):
+        self.top1.parent = self.sub121
+        self.assertRaises(ValueError, self.top1.save)
+
+    def test_rebuild_command(self):
+        HelpCategory.objects.update(path='')
+        call_command('rebuild_category_paths', verbosity=0)
+        sub121 = HelpCategory.objects.get(pk=self.sub121.pk)
+        self.assertEquals(sub121.path, self.sub121.path)
+
+    def test_categories_without_paths_fall_back_to_parent_links(self):
+        HelpCategory.objects.update(path='')
+        item = HelpItem.objects.create(category=self.sub121, heading="Deep", body="Down here", slug="deep")
+        HelpItem.objects.create(category=self.top2, heading="Elsewhere", body="Over there", slug="elsewhere")
+        top1 = HelpCategory.objects.get(pk=self.top1.pk)
+        self.assertEquals(set(top1.descendants), set([self.sub11, self.sub12, self.sub121]))
+        self.assertEquals(list(top1.subtree_items), [item])
+        self.assertEquals(top1.subcategories, [[self.sub11], [self.sub12, [[self.sub121]]]])
+
+    def test_saving_beneath_a_category_without_a_path_fills_in_its_path(self):
+        HelpCategory.objects.update(path='')
+        sub1211 = HelpCategory.objects.create(title="Sub 1.2.1.1", slug="sub-1211", parent=self.sub121)
+        self.assertEquals(sub1211.path, self.sub121.path + '%06d/' % sub1211.pk)
+        self.assertEquals(HelpCategory.objects.get(pk=self.sub121.pk).path, self.sub121.path)
+        self.assertEquals(HelpCategory.objects.get(pk=self.top1.pk).path, self.top1.path)
+
+
+class TestSearch(CategoryTestCase):
+
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        self.password = HelpItem.objects.create(category=self.sub11, heading="Resetting your password", 
+            body="Use the forgotten password link", slug="password")
+        self.billing = HelpItem.objects.create(category=self.sub12, heading="Billing", 
+            body="Invoices are sent monthly", slug="billing")
+        self.hidden = HelpItem.objects.create(category=self.sub12, heading="Billing secrets", 
+            body="Not for public view", slug="hidden", published=False)
+
+    def test_search_matches_word_prefixes(self):
+        self.assertEquals(list(HelpItem.search_manager.search("passw")), [self.password])
+        self.assertEquals(list(HelpItem.search_manager.search("resetting")), [self.password])
+        self.assertEquals(list(HelpItem.search_manager.search("ssword")), [])
+
+    def test_search_requires_every_token(self):
+        self.assertEquals(list(HelpItem.search_manager.search("billing monthly")), [self.billing])
+        self.assertEquals(list(HelpItem.search_manager.search("billing password")), [])
+
+    def test_search_includes_category_title(self):
+        self.assertEquals(list(HelpItem.search_manager.search("sub 1.2")), [self.billing])
+
+    def test_index_follows_edits(self):
+        self.billing.body = "Statements are sent quarterly"
+        self.billing.save()
+        self.assertEquals(list(HelpItem.search_manager.search("monthly")), [])
+        self.assertEquals(list(HelpItem.search_manager.search("quarter")), [self.billing])
+
+    def test_rebuild_command(self):
+        HelpSearchTerm.objects.all().delete()
+        HelpItem.objects.update(denormed_search_terms='', search_length=0)
+        call_command('rebuild_help_search_index', chunk_size=2, verbosity=0)
+        self.assertEquals(list(HelpItem.search_manager.search("invoice")), [self.billing])
+        billing = HelpItem.objects.get(pk=self.billing.pk)
+        self.assertEquals(billing.denormed_search_terms, billing.denorm_search_terms())
+        self.failUnless(billing.search_length > 0)
+        self.assertEquals(HelpSearchStats.objects.get(pk=1).total_length, 
+            sum(HelpItem.published_objects.values_list('search_length', flat=True)))
+
+    def test_ranked_search_prefers_heading_matches(self):
+        invoices = HelpItem.objects.create(category=self.top2, heading="Invoices", 
+            body="Where to find old ones", slug="invoices")
+        hits = HelpItem.search_manager.ranked_search("invoices")
+        self.assertEquals(hits, [invoices, self.billing])
+        self.failUnless(hits[0].score > hits[1].score)
+
+    def test_search_stats_follow_changes(self):
+        def stats():
+            row = HelpSearchStats.objects.get(pk=1)
+            return row.items, row.total_length
+        self.assertEquals(stats(), HelpSearchStats.objects.rebuild())
+        self.billing.body = "Invoices are sent every month"
+        self.billing.save()
+        self.password.published = False
+        self.password.save()
+        HelpItem.objects.create(category=self.sub12, heading="Refunds", body="Refunds", slug="refunds")
+        self.sub12.title = "Billing"
+        self.sub12.save()
+        counted = stats()
+        self.assertEquals(counted, HelpSearchStats.objects.rebuild())
+        self.assertEquals(counted[0], 2)
+        self.billing.delete()
+        self.assertEquals(stats(), HelpSearchStats.objects.rebuild())
+
+    def test_ranked_search_limit(self):
+        self.assertEquals(len(HelpItem.search_manager.ranked_search("sub", limit=1)), 1)
+        self.assertEquals(len(HelpItem.search_manager.ranked_search("sub", limit=5)), 2)
+        self.assertEquals(HelpItem.search_manager.ranked_search("nothing"), [])
+
+
+    def test_search_pages_by_seeking(self):
+        first = HelpItem.search_manager.search("sub")[:1]
+        self.assertEquals(list(first), [self.password])
+        self.assertEquals(list(HelpItem.search_manager.search("sub", after=first[0].pk)[:1]), [self.billing])
+        self.assertEquals(list(HelpItem.search_manager.search("sub", after=self.billing.pk)), [])
+
+    def test_ranked_search_pages_by_seeking(self):
+        for n in range(5):
+            HelpItem.objects.create(category=self.top2, heading="Paging %s" % n, 
+                body="paging " * n, slug="paging-%s" % n)
+        everything = HelpItem.search_manager.ranked_search("paging", limit=10)
+        pages, after = [], None
+        while True:
+            page = HelpItem.search_manager.ranked_search("paging", limit=2, after=after)
+            if not page:
+                break
+            pages.extend(page)
+            after = search.decode_cursor(search.encode_cursor(page[-1].score, page[-1].pk))
+        self.assertEquals(len(everything), 5)
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            cache.clear()
+            connection.queries = []
+            page = HelpItem.search_manager.ranked_search("paging", limit=2, 
+                after=(everything[1].score, everything[1].pk))
+            self.assertEquals(page, everything[2:4])
+            self.failIf([q for q in connection.queries if 'COUNT(' in q['sql'].upper()])
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEquals(pages, everything)
+
+    def test_bad_cursors_are_ignored(self):
+        self.assertEquals(search.decode_cursor(None), None)
+        self.assertEquals(search.decode_cursor("not a cursor"), None)
+        self.assertEquals(search.decode_cursor(search.encode_cursor(1.5, 3)), (1.5, 3))
+
+    def test_renaming_a_category_retitles_its_items(self):
+        self.sub12.title = "Accounts and Sub-Billing"
+        self.sub12.save()
+        billing = HelpItem.objects.get(pk=self.billing.pk)
+        self.assertEquals(billing.denormed_search_terms, billing.denorm_search_terms())
+        self.assertEquals(billing.search_length, sum(billing.search_term_frequencies().values()))
+        self.assertEquals(dict(billing.search_terms.values_list('term', 'frequency')), 
+            billing.search_term_frequencies())
+        self.assertEquals(list(HelpItem.search_manager.search("accounts")), [self.billing])
+        self.assertEquals(list(HelpItem.search_manager.search("1.2")), [])
+
+    def test_renaming_a_category_resaves_items_whose_denormed_column_is_out_of_date(self):
+        HelpItem.objects.filter(pk=self.billing.pk).update(body="Invoices 100%_off", 
+            denormed_search_terms="out of date")
+        self.sub12.title = "Accounts"
+        self.sub12.save()
+        billing = HelpItem.objects.get(pk=self.billing.pk)
+        self.assertEquals(billing.denormed_search_terms, billing.denorm_search_terms())
+        self.assertEquals(billing.search_length, sum(billing.search_term_frequencies().values()))
+        self.assertEquals(dict(billing.search_terms.values_list('term', 'frequency')), 
+            billing.search_term_frequencies())
+        self.assertEquals(list(HelpItem.search_manager.search("invoices accounts")), [billing])
+        counted = HelpSearchStats.objects.get(pk=1)
+        self.assertEquals((counted.items, counted.total_length), HelpSearchStats.objects.rebuild())
+
+
+class TestRelatedItems(CategoryTestCase):
+
+    urls = 'help.urls'
+
+    def setUp(self):
+        super(TestRelatedItems, self).setUp()
+        def item(slug, category, tags, **kwargs):
+            return HelpItem.objects.create(category=category, heading=slug, body=slug, slug=slug, 
+                help_tags=tags, **kwargs)
+        self.login = item("login", self.sub11, "account password", order=1)
+        self.logout = item("logout", self.sub11, "", order=2)
+        self.reset = item("reset", self.sub12, "account password")
+        self.profile = item("profile", self.top2, "account")
+        self.hidden = item("hidden", self.top2, "account password", published=False)
+
+    def test_related_items(self):
+        self.assertEquals(self.login.related_items, [self.reset, self.profile, self.logout])
+        self.assertEquals(self.logout.related_items, [self.login])
+
+    def test_related_items_are_limited(self):
+        self.assertEquals(prefetch_related_items([self.login], num=1)[0].related_items, [self.reset])
+        self.assertEquals(prefetch_related_items([self.login], num=None)[0].related_items, 
+            [self.reset, self.profile, self.logout])
+        for i in range(RELATED_ITEMS):
+            HelpItem.objects.create(category=self.sub11, heading='more', body='more', slug='more%s' % i, 
+                order=3)
+        related = HelpItem.objects.get(pk=self.login.pk).related_items
+        self.assertEquals(len(related), RELATED_ITEMS)
+        self.assertEquals(related[:3], [self.reset, self.profile, self.logout])
+
+    def test_single_item_lists_related_items(self):
+        for i in range(RELATED_ITEMS):
+            HelpItem.objects.create(category=self.sub11, heading='more', body='more', slug='more%s' % i, 
+                order=3)
+        response = self.client.get(reverse('help_single_item', args=[self.sub11.slug, self.login.slug]))
+        self.assertEquals(response.context['related_items'], 
+            HelpItem.objects.get(pk=self.login.pk).related_items)
+        self.assertContains(response, '"%s"' % reverse('help_single_item', 
+            args=[self.reset.category.slug, self.reset.slug]))
+        self.assertNotContains(response, '"%s"' % reverse('help_single_item', 
+            args=[self.sub11.slug, 'more%s' % (RELATED_ITEMS - 1)]))
+
+    def test_prefetched_related_items_match(self):
+        items = list(HelpItem.objects.filter(published=True).order_by('pk'))
+        expected = [HelpItem.objects.get(pk=item.pk).related_items for item in items]
+        prefetch_related_items(items)
+        self.assertEquals([item.related_items for item in items], expected)
+
+    def test_prefetch_uses_constant_queries(self):
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            connection.queries = []
+            prefetch_related_items(HelpItem.objects.filter(pk=self.login.pk))
+            few = len(connection.queries)
+            connection.queries = []
+            items = prefetch_related_items(HelpItem.objects.all())
+            [item.related_items for item in items]
+            self.assertEquals(len(connection.queries), few)
+        finally:
+            settings.DEBUG = old_debug
+
+    def test_item_list_fetches_tags_in_one_query(self):
+        items = prefetch_tags(HelpItem.objects.order_by('pk'))
+        self.assertEquals([[t.name for t in item.tags] for item in items], 
+            [[t.name for t in Tag.objects.get_for_object(item)] for item in items])
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            connection.queries = []
+            response = self.client.get(reverse('help_item_list', args=[self.top2.slug]))
+            self.assertContains(response, 'href="%s"' % reverse('help_items_by_tag', args=['account']))
+            few = len(connection.queries)
+            for i in range(5):
+                HelpItem.objects.create(category=self.top2, heading='more', body='more', 
+                    slug='more%s' % i, help_tags='account extra%s' % i)
+            connection.queries = []
+            self.client.get(reverse('help_item_list', args=[self.top2.slug]))
+            self.assertEquals(len(connection.queries), few)
+        finally:
+            settings.DEBUG = old_debug
+
+    def test_published_tag_counts_follow_changes(self):
+        def published_usage():
+            return [(t.name, t.count) for t in Tag.objects.usage_for_model(HelpItem, 
+                counts=True, filters={'published': True})]
+        self.assertEquals(published_usage(), [(u'account', 3), (u'password', 2)])
+        self.hidden.published = True
+        self.hidden.save()
+        self.login.delete()
+        self.profile.published = False
+        self.profile.help_tags = 'account profile'
+        self.profile.save()
+        self.assertEquals(published_usage(), [(u'account', 2), (u'password', 2)])
+        self.assertEquals(published_usage(), [(t.name, t.count) for t in 
+            Tag.objects.usage_for_queryset(HelpItem.published_objects.all(), counts=True)])
+
+
+class TestTagIds(TagCacheTestCase):
+
+    def test_tag_ids_are_cached_until_tags_change(self):
+        category = HelpCategory.objects.create(title="Top", slug="top")
+        HelpItem.objects.create(category=category, heading="login", body="login", slug="login", 
+            help_tags="account")
+        account = Tag.objects.get(name='account')
+        self.assertEquals(get_tag_id('account'), account.pk)
+        Tag.objects.filter(pk=account.pk).update(name='renamed behind our back')
+        self.assertEquals(get_tag_id('account'), account.pk)
+        account.name = 'accounts'
+        account.save()
+        self.assertEquals(get_tag_id('account'), None)
+        self.assertEquals(get_tag_id('accounts'), account.pk)
+
+class TestSearchCache(CategoryTestCase):
+
+    def setUp(self):
+        super(TestSearchCache, self).setUp()
+        self.billing = HelpItem.objects.create(category=self.sub12, heading="Billing", 
+            body="Invoices are sent monthly", slug="billing")
+        self.other = HelpItem.objects.create(category=self.sub11, heading="Passwords", 
+            body="Keep them secret", slug="passwords")
+        self.old_debug, settings.DEBUG = settings.DEBUG, True
+
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+
+    def queries_for(self, query):
+        """Returns the hits for ``query`` and how many queries read postings from the DB"""
+        connection.queries = []
+        hits = HelpItem.search_manager.ranked_search(query)
+        return hits, len([q for q in connection.queries if HelpSearchTerm._meta.db_table in q['sql']])
+
+    def test_repeat_searches_are_cached(self):
+        hits, queries = self.queries_for("bill")
+        hits_again, queries_again = self.queries_for("Bill!")
+        self.assertEquals(hits_again, hits)
+        self.assertEquals(queries, 1)
+        self.assertEquals(queries_again, 0)
+
+    def test_unrelated_changes_keep_the_cache(self):
+        self.queries_for("bill")
+        self.other.body = "Keep them very secret"
+        self.other.save()
+        self.assertEquals(self.queries_for("bill")[1], 0)
+
+    def test_scores_follow_unrelated_changes(self):
+        self.queries_for("bill")
+        HelpItem.objects.create(category=self.sub11, heading="Refunds", 
+            body="Refunds take a week or two to arrive", slug="refunds")
+        self.other.body = "Keep them very secret"
+        self.other.save()
+        cached = [hit.score for hit in self.queries_for("bill")[0]]
+        cache.clear()
+        self.assertEquals(cached, [hit.score for hit in self.queries_for("bill")[0]])
+
+    def test_related_changes_invalidate_the_cache(self):
+        self.queries_for("quarterly")
+        self.billing.body = "Invoices are sent quarterly"
+        self.billing.save()
+        self.assertEquals(self.queries_for("quarterly")[0], [self.billing])
+
+        self.billing.published = False
+        self.billing.save()
+        self.assertEquals(self.queries_for("quarterly")[0], [])
+
+    def test_length_changes_invalidate_all_its_terms(self):
+        score = self.queries_for("invoices")[0][0].score
+        self.billing.body = "Invoices are sent monthly by post"
+        self.billing.save()
+        self.failUnless(self.queries_for("invoices")[0][0].score < score)
+
+    def test_category_title_changes_invalidate_the_cache(self):
+        self.queries_for("sub")
+        self.queries_for("pass")
+        self.sub12.title = "Renamed"
+        self.sub12.save()
+        self.assertEquals(self.queries_for("sub")[1], 1)
+        self.assertEquals(self.queries_for("pass")[1], 0)
+
+    def test_deleting_invalidates_the_cache(self):
+        self.queries_for("monthly")
+        self.billing.delete()
+        self.assertEquals(self.queries_for("monthly")[0], [])
+
+    def test_common_tokens_only_cache_their_document_frequency(self):
+        def ranks(query):
+            return [(hit.pk, round(hit.score, 9)) for hit in self.queries_for(query)[0]]
+        expected = [ranks(query) for query in ("s", "s sub", "in")]
+        self.assertEquals([len(hits) for hits in expected], [2, 2, 1])
+        cache.clear()
+        old_max, search.search_cache.max_postings = search.search_cache.max_postings, 1
+        try:
+            self.assertEquals([ranks(query) for query in ("s", "s sub", "in")], expected)
+            self.assertEquals(search.search_cache.get_many(["s", "sub"]), {"s": 2, "sub": 2})
+            self.assertEquals(search.search_cache.get_many(["in"]).keys(), ["in"])
+            self.assertEquals(ranks("s sub"), expected[1])
+        finally:
+            search.search_cache.max_postings = old_max
+
+class TestSearchBackendParity(TransactionTestCase):
+    """
+    Every search backend usable on this database should find exactly the same items.
+
+    Building the full-text structures is DDL, which commits on some databases, 
+    so this runs outside a test transaction and cleans up after itself.
+    """
+
+    queries = ["thing", "th", "this is", "bbbb thing", "sub 1 2", "subcategory 1.2.1", 
+               "aaaaa", "a", "nothing", "", "THING!!", "&amp; thing", "this_is", "thing_c"]
+
+    def setUp(self):
+        call_command('loaddata', os.path.join(settings.FILEROOT, 'fixtures', 'test_data.json'), verbosity=0)
+        call_command('build_help_search_fts', verbosity=0)
+        self.backends = [b for b in search.BACKENDS.values() if b.is_available()]
+
+    def tearDown(self):
+        call_command('drop_help_search_fts', verbosity=0)
+        call_command('flush', verbosity=0, interactive=False)
+        search.reset_search_backend()
+
+    def assertBackendsAgree(self, queries):
+        for query in queries:
+            tokens = HelpItem.search_manager.query_tokens(query)
+            results = [set(b.filter(HelpItem.search_manager.get_query_set(), tokens).values_list('pk', flat=True)) 
+                       for b in self.backends]
+            for backend, result in zip(self.backends, results):
+                self.assertEquals(result, results[0], "%s disagrees about '%s'" % (backend.name, query))
+
+    def test_ranked_search_agrees_whichever_backend_picks_the_candidates(self):
+        queries = ["thing", "th", "this is", "bbbb thing", "sub 1 2", "a", "this_is"]
+        def ranks():
+            cache.clear()
+            return [[(hit.pk, round(hit.score, 9)) for hit in HelpItem.search_manager.ranked_search(query)] 
+                    for query in queries]
+        expected = ranks()
+        self.failUnless([hits for hits in expected if hits])
+        old_max, search.search_cache.max_postings = search.search_cache.max_postings, 0
+        try:
+            for backend in self.backends:
+                search.reset_search_backend()
+                search._selected.append(backend)
+                self.assertEquals(ranks(), expected, "%s ranks differently" % backend.name)
+        finally:
+            search.search_cache.max_postings = old_max
+
+    def test_backends_agree_on_fixture_data(self):
+        if 'sqlite3' in connection.settings_dict['ENGINE']:
+            self.failUnless(search.BACKENDS['sqlite_fts'] in self.backends)
+        self.assertBackendsAgree(self.queries)
+        self.assertEquals(HelpItem.search_manager.search("thing").count(), 3)
+
+    def test_backends_agree_after_edits(self):
+        item = HelpItem.objects.get(slug='bbbb')
+        item.heading = "Renamed"
+        item.save()
+        HelpItem.objects.get(slug='aaaaa').delete()
+        self.assertBackendsAgree(("renamed", "bbbb", "aaaaa", "thing"))
+        item.body = "Follow the reset_password link"
+        item.save()
+        self.assertBackendsAgree(("reset_password", "reset", "password", "reset_pass", "reset password"))
+        self.assertEquals(HelpItem.search_manager.search("reset").count(), 1)
+
+    def test_dropping_leaves_the_term_index(self):
+        call_command('drop_help_search_fts', verbosity=0)
+        self.failIf(search.BACKENDS['sqlite_fts'].is_available())
+        self.assertEquals(search.get_search_backend().name, 'index')
+        item = HelpItem.objects.get(slug='bbbb')
+        item.save()
+        self.assertEquals(HelpItem.search_manager.search("thing").count(), 3)
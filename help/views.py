@@ -3,28 +3,24 @@ from django.conf import settings
 
 import urllib
 
+from django.core.paginator import InvalidPage, Paginator
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 
 from help.shortcuts import render_with_context
-from help.models import HelpCategory, HelpItem
+from help.models import RELATED_ITEMS, HelpCategory, HelpItem, category_branches, get_tag_id, prefetch_related_items
 from help.forms import SearchForm
+from help.search import decode_cursor, encode_cursor
+from tagging.generic import prefetch_tags
+from tagging.models import Tag, TaggedItem
 
 def category_list(request, template='help_category_list.html'):
-    
-    tree = None
-
-    top_categories = HelpCategory.objects.filter(parent=None).order_by('order')
-    
-    branches = []
+    """
+    Lists the whole tree of published categories, fetched in one query
+    """
+    categories = HelpCategory.published_objects.order_by('order')
+    branches = category_branches(categories)
 
-    for top_category in top_categories:
-        subcategories = top_category.subcategories
-        if len(subcategories) == 0:
-            branches.append([top_category])
-        else:
-            branches.append([top_category, subcategories])
-            
     return render_with_context(request, template, {'branches':branches})
     
 
@@ -43,7 +39,8 @@ def item_list(request, identifier=None, template="help_item_list.html"):
         except HelpCategory.DoesNotExist:
             raise Http404
 
-    help_items = HelpItem.published_objects.filter(category=category).order_by('order')
+    #one query for all the items' tags, rather than one per item
+    help_items = prefetch_tags(HelpItem.published_objects.filter(category=category).select_related('category').order_by('order'))
     
     trail = category.trail
     
@@ -51,21 +48,38 @@ def item_list(request, identifier=None, template="help_item_list.html"):
     
     
     
-def items_by_tag(request, tag, template="help_items_by_tag.html"):
+def items_by_tag(request, tag, template="help_items_by_tag.html", paginate_by=20):
     """
-    Lists all the items that are tagged with the relevant category
+    Lists all the published items that are tagged with the relevant tag, 
+    ``paginate_by`` at a time
     """
 
     #convert tag back to unurlencoded
     fixed_tag = urllib.unquote(tag)
 
-    return render_with_context(request, template, {'tag':fixed_tag} )
+    tag_id = get_tag_id(fixed_tag)
+    if tag_id is None:
+        raise Http404
+
+    #one query for the items and their categories, joined to the tag
+    items = TaggedItem.objects.get_by_model(
+        HelpItem.published_objects.select_related('category').order_by('order'), 
+        Tag(id=tag_id, name=fixed_tag))
+
+    paginator = Paginator(items, paginate_by)
+    try:
+        page = paginator.page(int(request.GET.get('page', 1)))
+    except (ValueError, InvalidPage):
+        raise Http404
+
+    return render_with_context(request, template, {'tag':fixed_tag, 'items':page.object_list, 'page':page } )
     
     
     
-def single_item(request, cat_identifier, item_identifier, template='help_single_item.html'):
+def single_item(request, cat_identifier, item_identifier, template='help_single_item.html', 
+        num_related=RELATED_ITEMS):
     """
-    Individual help item view 
+    Individual help item view, listing up to ``num_related`` related items
     """
     #see if we can make the identifiers into ints, so we know they'll be pks
     try:
@@ -99,24 +113,31 @@ def single_item(request, cat_identifier, item_identifier, template='help_single_
         raise Http404
             
             
-    return render_with_context(request, template, {'item':help_item } )
+    prefetch_related_items([help_item], num_related)
+    return render_with_context(request, template, {'item':help_item, 'related_items':help_item.related_items } )
     
     
     
     
     
-def search_results(request, template="search_results.html"):
+def search_results(request, template="search_results.html", page_size=20):
     """
-    Displays relevant help items based on the search query entered
+    Displays the most relevant help items for the search query entered, 
+    best first, ``page_size`` at a time
     
-    Query is sent as a GET, and uses the very simple form help.forms.SearchForm 
+    Query is sent as a GET, and uses the very simple form help.forms.SearchForm. 
+    Later pages are reached with the opaque ``cursor`` GET parameter, which 
+    seeks past the last hit shown rather than counting or offsetting.
     """
     
     query = request.GET.get('query', None)
+    after = decode_cursor(request.GET.get('cursor', None))
     
-    hits = HelpItem.search_manager.search(query)    
+    hits = HelpItem.search_manager.ranked_search(query, limit=page_size + 1, after=after)
+
+    next_cursor = None
+    if len(hits) > page_size:
+        hits = hits[:page_size]
+        next_cursor = encode_cursor(hits[-1].score, hits[-1].pk)
                 
-    return render_with_context(request, template, {'query':query, 'hits':hits } )
-    
-    
-    
\ No newline at end of file
+    return render_with_context(request, template, {'query':query, 'hits':hits, 'next_cursor':next_cursor } )
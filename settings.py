@@ -65,6 +65,9 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    #retires cached tag clouds once tag writes in a managed transaction are 
+    #committed - keep it ahead of any TransactionMiddleware
+    'tagging.middleware.TagGenerationMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -99,6 +102,18 @@ INSTALLED_APPS = (
 #django-tagging settings
 FORCE_LOWERCASE_TAGS = True
 
+#django-help-pages settings
+#which help.search backend to match searches with - 'auto' uses full-text 
+#search once ./manage.py build_help_search_fts has been run
+HELP_SEARCH_BACKEND = 'auto'
+#how long to cache each search word's postings for (seconds)
+HELP_SEARCH_CACHE_TIMEOUT = 60 * 60
+#how many postings a search word can have and still be cached - commoner 
+#words only have how many items they're in cached
+HELP_SEARCH_CACHE_MAX_POSTINGS = 1000
+#how many related items to list on each help item's page
+HELP_RELATED_ITEMS = 5
+
 
 
 #import any local settings 
@@ -32,7 +32,9 @@ def register(model, tag_descriptor_attr='tags',
     Sets the given model class up for working with tags.
     """
 
+    from django.db.models import signals
     from tagging.managers import ModelTaggedItemManager, TagDescriptor
+    from tagging.models import delete_tags_of_deleted_object
 
     if model in registry:
         raise AlreadyRegistered("The model '%s' has already been "
@@ -58,5 +60,8 @@ def register(model, tag_descriptor_attr='tags',
     # Add custom manager
     ModelTaggedItemManager().contribute_to_class(model, tagged_item_manager_attr)
 
+    # Remove the tags of deleted instances
+    signals.pre_delete.connect(delete_tags_of_deleted_object, model)
+
     # Finally register in registry
     registry.append(model)
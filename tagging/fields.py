@@ -6,7 +6,7 @@ from django.db.models.fields import CharField
 from django.utils.translation import ugettext_lazy as _
 
 from tagging import settings
-from tagging.models import Tag
+from tagging.models import Tag, delete_tags_of_deleted_object
 from tagging.utils import edit_string_for_tags
 
 class TagField(CharField):
@@ -29,6 +29,9 @@ class TagField(CharField):
         # Save tags back to the database post-save
         signals.post_save.connect(self._save, cls, True)
 
+        # Remove the tags of deleted objects
+        signals.pre_delete.connect(delete_tags_of_deleted_object, cls)
+
     def __get__(self, instance, owner=None):
         """
         Tag getter. Returns an instance's tags if accessed on an instance, and
@@ -38,3 +38,46 @@ def fetch_content_objects(tagged_items, select_related_for=None):
     for item in tagged_items:
         item._object_cache = objects[item.content_type_id][item.object_id]
         item._content_type_cache = content_types[item.content_type_id]
+
+def prefetch_tags(queryset_or_list):
+    """
+    Retrieves the tags of every object in the given ``QuerySet`` or list
+    of model instances with one query per model type, rather than one
+    per object.
+
+    Each object's tags are cached where ``Tag.objects.get_for_object``
+    would otherwise be called for them - as the tag string of its
+    ``TagField`` attributes, and as a list of ``Tag`` objects for a
+    ``tags`` descriptor set up by ``tagging.register``, or anything else
+    reading the ``_prefetched_tags`` attribute. The cached list is
+    dropped when the object's tags are next updated.
+
+    Returns the objects as a list.
+    """
+    from tagging.fields import TagField
+    from tagging.models import TaggedItem, _chunks, model_infos
+    from tagging.utils import edit_string_for_tags
+
+    objects = list(queryset_or_list)
+
+    # Group objects by their content types
+    objects_by_model = {}
+    for obj in objects:
+        objects_by_model.setdefault(obj.__class__, []).append(obj)
+
+    for model, model_objects in objects_by_model.iteritems():
+        content_type_id = model_infos.get(model).content_type_id
+        tags = {}
+        for object_ids in _chunks([obj.pk for obj in model_objects]):
+            tagged_items = TaggedItem._default_manager.filter(content_type__pk=content_type_id,
+                object_id__in=object_ids).select_related('tag').order_by('tag__name')
+            for item in tagged_items:
+                tags.setdefault(item.object_id, []).append(item.tag)
+
+        tag_fields = [field for field in model._meta.fields if isinstance(field, TagField)]
+        for obj in model_objects:
+            obj._prefetched_tags = tags.get(obj.pk, [])
+            for field in tag_fields:
+                if field._get_instance_tag_cache(obj) is None:
+                    field._set_instance_tag_cache(obj, edit_string_for_tags(obj._prefetched_tags))
+    return objects
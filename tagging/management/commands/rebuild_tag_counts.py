@@ -0,0 +1,20 @@
+"""
+Recounts the tag usage, co-occurrence and tagged object count tables from
+the tagged items
+"""
+from django.core.management.base import NoArgsCommand
+
+from tagging.models import TagCooccurrence, TaggedObjectCount, TagUsage, tag_generation
+
+
+class Command(NoArgsCommand):
+    help = "Recounts how often each tag and each pair of tags is used, and how many objects have tags, eg after loading tagged items directly"
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        usage = TagUsage.objects.rebuild()
+        pairs = TagCooccurrence.objects.rebuild()
+        TaggedObjectCount.objects.rebuild()
+        tag_generation.bump()
+        if verbosity > 0:
+            print "Counted the uses of %s tags and %s pairs of tags used together" % (usage, pairs)
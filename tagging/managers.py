@@ -2,19 +2,17 @@
 Custom managers for Django models registered with the tagging
 application.
 """
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
-from tagging.models import Tag, TaggedItem
+from tagging.models import Tag, TaggedItem, model_infos
 
 class ModelTagManager(models.Manager):
     """
     A manager for retrieving tags for a particular model.
     """
     def get_query_set(self):
-        ctype = ContentType.objects.get_for_model(self.model)
         return Tag.objects.filter(
-            items__content_type__pk=ctype.pk).distinct()
+            items__content_type__pk=model_infos.get(self.model).content_type_id).distinct()
 
     def cloud(self, *args, **kwargs):
         return Tag.objects.cloud_for_model(self.model, *args, **kwargs)
@@ -59,6 +57,9 @@ class TagDescriptor(object):
             tag_manager.model = owner
             return tag_manager
         else:
+            prefetched = getattr(instance, '_prefetched_tags', None)
+            if prefetched is not None:
+                return prefetched
             return Tag.objects.get_for_object(instance)
 
     def __set__(self, instance, value):
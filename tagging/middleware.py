@@ -0,0 +1,19 @@
+from tagging.models import tag_generation
+
+
+class TagGenerationMiddleware(object):
+    """
+    Replaces the tag generation again once a response is done, if tags
+    were written inside a managed transaction - so that nothing cached
+    from the rows as they were before it committed outlives the commit.
+
+    List it before ``django.middleware.transaction.TransactionMiddleware``
+    in ``MIDDLEWARE_CLASSES``, so that its ``process_response`` runs after
+    that middleware has committed.
+    """
+    def process_response(self, request, response):
+        tag_generation.bump_after_commit()
+        return response
+
+    def process_exception(self, request, exception):
+        tag_generation.bump_after_commit()
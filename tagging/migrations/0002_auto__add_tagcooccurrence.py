@@ -0,0 +1,76 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'TagCooccurrence'
+        db.create_table('tagging_tagcooccurrence', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'])),
+            ('tag', self.gf('django.db.models.fields.related.ForeignKey')(related_name='cooccurrences', to=orm['tagging.Tag'])),
+            ('related_tag', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['tagging.Tag'])),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('tagging', ['TagCooccurrence'])
+
+        # Adding unique constraint on 'TagCooccurrence', fields ['content_type', 'tag', 'related_tag']
+        db.create_unique('tagging_tagcooccurrence', ['content_type_id', 'tag_id', 'related_tag_id'])
+
+        # Counting the pairs of tags already used together
+        if not db.dry_run:
+            db.execute("""
+            INSERT INTO tagging_tagcooccurrence (content_type_id, tag_id, related_tag_id, count)
+            SELECT tagged.content_type_id, tagged.tag_id, related.tag_id, COUNT(*)
+            FROM tagging_taggeditem tagged
+                INNER JOIN tagging_taggeditem related
+                    ON related.content_type_id = tagged.content_type_id
+                    AND related.object_id = tagged.object_id
+                    AND related.tag_id != tagged.tag_id
+            GROUP BY tagged.content_type_id, tagged.tag_id, related.tag_id""")
+    
+    
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'TagCooccurrence', fields ['content_type', 'tag', 'related_tag']
+        db.delete_unique('tagging_tagcooccurrence', ['content_type_id', 'tag_id', 'related_tag_id'])
+
+        # Deleting model 'TagCooccurrence'
+        db.delete_table('tagging_tagcooccurrence')
+    
+    
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'tagging.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'unique': 'True', 'db_index': 'True'})
+        },
+        'tagging.tagcooccurrence': {
+            'Meta': {'unique_together': "(('content_type', 'tag', 'related_tag'),)", 'object_name': 'TagCooccurrence'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'related_tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['tagging.Tag']"}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cooccurrences'", 'to': "orm['tagging.Tag']"})
+        },
+        'tagging.taggeditem': {
+            'Meta': {'unique_together': "(('tag', 'content_type', 'object_id'),)", 'object_name': 'TaggedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'items'", 'to': "orm['tagging.Tag']"})
+        }
+    }
+    
+    complete_apps = ['tagging']
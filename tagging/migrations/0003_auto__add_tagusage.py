@@ -0,0 +1,89 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Adding model 'TagUsage'
+        db.create_table('tagging_tagusage', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'])),
+            ('tag', self.gf('django.db.models.fields.related.ForeignKey')(related_name='usage', to=orm['tagging.Tag'])),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('tagging', ['TagUsage'])
+
+        # Adding unique constraint on 'TagUsage', fields ['content_type', 'tag']
+        db.create_unique('tagging_tagusage', ['content_type_id', 'tag_id'])
+
+        # Counting the uses of each tag on objects which still exist
+        if not db.dry_run:
+            for content_type in orm['contenttypes.ContentType'].objects.filter(
+                    pk__in=list(orm['tagging.TaggedItem'].objects.values_list('content_type', flat=True).distinct())):
+                model = models.get_model(content_type.app_label, content_type.model)
+                if model is None:
+                    continue
+                db.execute("""
+                INSERT INTO tagging_tagusage (content_type_id, tag_id, count)
+                SELECT tagging_taggeditem.content_type_id, tagging_taggeditem.tag_id, COUNT(*)
+                FROM tagging_taggeditem
+                    INNER JOIN %(model)s
+                        ON tagging_taggeditem.object_id = %(model)s.%(pk)s
+                WHERE tagging_taggeditem.content_type_id = %%s
+                GROUP BY tagging_taggeditem.content_type_id, tagging_taggeditem.tag_id""" % {
+                    'model': db.quote_name(model._meta.db_table),
+                    'pk': db.quote_name(model._meta.pk.column),
+                }, [content_type.pk])
+    
+    
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'TagUsage', fields ['content_type', 'tag']
+        db.delete_unique('tagging_tagusage', ['content_type_id', 'tag_id'])
+
+        # Deleting model 'TagUsage'
+        db.delete_table('tagging_tagusage')
+    
+    
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'tagging.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'unique': 'True', 'db_index': 'True'})
+        },
+        'tagging.tagcooccurrence': {
+            'Meta': {'unique_together': "(('content_type', 'tag', 'related_tag'),)", 'object_name': 'TagCooccurrence'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'related_tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['tagging.Tag']"}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cooccurrences'", 'to': "orm['tagging.Tag']"})
+        },
+        'tagging.taggeditem': {
+            'Meta': {'unique_together': "(('tag', 'content_type', 'object_id'),)", 'object_name': 'TaggedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'items'", 'to': "orm['tagging.Tag']"})
+        },
+        'tagging.tagusage': {
+            'Meta': {'unique_together': "(('content_type', 'tag'),)", 'object_name': 'TagUsage'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'usage'", 'to': "orm['tagging.Tag']"})
+        }
+    }
+    
+    complete_apps = ['tagging']
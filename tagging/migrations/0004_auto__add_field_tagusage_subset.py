@@ -0,0 +1,78 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+    
+    def forwards(self, orm):
+        
+        # Removing unique constraint on 'TagUsage', fields ['content_type', 'tag']
+        db.delete_unique('tagging_tagusage', ['content_type_id', 'tag_id'])
+
+        # Adding field 'TagUsage.subset'
+        db.add_column('tagging_tagusage', 'subset', self.gf('django.db.models.fields.CharField')(default='', max_length=50, blank=True), keep_default=False)
+
+        # Adding unique constraint on 'TagUsage', fields ['content_type', 'tag', 'subset']
+        db.create_unique('tagging_tagusage', ['content_type_id', 'tag_id', 'subset'])
+
+        # The existing rows count every object, which is the blank subset -
+        # run the rebuild_tag_counts command to count any registered subsets
+    
+    
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'TagUsage', fields ['content_type', 'tag', 'subset']
+        db.delete_unique('tagging_tagusage', ['content_type_id', 'tag_id', 'subset'])
+
+        # Dropping the counts of the usage subsets
+        if not db.dry_run:
+            db.execute("DELETE FROM tagging_tagusage WHERE subset <> ''")
+
+        # Deleting field 'TagUsage.subset'
+        db.delete_column('tagging_tagusage', 'subset')
+
+        # Adding unique constraint on 'TagUsage', fields ['content_type', 'tag']
+        db.create_unique('tagging_tagusage', ['content_type_id', 'tag_id'])
+    
+    
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'tagging.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'unique': 'True', 'db_index': 'True'})
+        },
+        'tagging.tagcooccurrence': {
+            'Meta': {'unique_together': "(('content_type', 'tag', 'related_tag'),)", 'object_name': 'TagCooccurrence'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'related_tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['tagging.Tag']"}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cooccurrences'", 'to': "orm['tagging.Tag']"})
+        },
+        'tagging.taggeditem': {
+            'Meta': {'unique_together': "(('tag', 'content_type', 'object_id'),)", 'object_name': 'TaggedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'items'", 'to': "orm['tagging.Tag']"})
+        },
+        'tagging.tagusage': {
+            'Meta': {'unique_together': "(('content_type', 'tag', 'subset'),)", 'object_name': 'TagUsage'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'subset': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'usage'", 'to': "orm['tagging.Tag']"})
+        }
+    }
+    
+    complete_apps = ['tagging']
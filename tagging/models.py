@@ -7,18 +7,162 @@ try:
 except NameError:
     from sets import Set as set
 
+import copy
+import math
+import threading
+import uuid
+
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection, models
-from django.db.models.query import QuerySet
+from django.core.cache import cache
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, signals
+from django.db.models.query import EmptyQuerySet, QuerySet
 from django.utils.translation import ugettext_lazy as _
 
 from tagging import settings
-from tagging.utils import calculate_cloud, get_tag_list, get_queryset_and_model, parse_tag_input
+from tagging.utils import calculate_cloud, commit_on_success_unless_managed, get_tag_list, get_queryset_and_model
+from tagging.utils import parse_tag_input, tag_ids
 from tagging.utils import LOGARITHMIC
 
 qn = connection.ops.quote_name
 
+class ModelInfo(object):
+    """
+    What the tagging queries need to know about a model: the id of its
+    ``ContentType`` and its quoted table and primary key names.
+    """
+    def __init__(self, model, content_type_id):
+        self.model = model
+        self.content_type_id = content_type_id
+        self.table = qn(model._meta.db_table)
+        self.pk_column = qn(model._meta.pk.column)
+        self.pk = '%s.%s' % (self.table, self.pk_column)
+
+class ModelInfoCache(object):
+    """
+    A process-wide cache of ``ModelInfo`` for every model, shared by all
+    the tagging managers so their hot paths neither look up content
+    types nor quote names on each call.
+
+    The cache is warmed with every installed model from a single query
+    of the content types table - when ``warm`` is called at startup, or
+    else on first use - as the tables may not exist yet when the
+    models are loaded. Models missed by that are looked up one by one.
+    Saving or deleting a content type empties the cache.
+    """
+    def __init__(self):
+        self._infos = {}
+        self._warm = False
+
+    def warm(self):
+        infos = {}
+        for content_type in ContentType.objects.all():
+            model = content_type.model_class()
+            # get_for_model resolves proxy models to their concrete model's content type
+            if model is not None and not model._meta.proxy:
+                infos[model] = ModelInfo(model, content_type.pk)
+        self._infos = infos
+        self._warm = True
+
+    def clear(self):
+        self._infos = {}
+        self._warm = False
+
+    def get(self, model):
+        """
+        Returns the ``ModelInfo`` of a model class or instance.
+        """
+        if not isinstance(model, type):
+            model = model.__class__
+        try:
+            return self._infos[model]
+        except KeyError:
+            if not self._warm:
+                self.warm()
+                return self.get(model)
+            info = ModelInfo(model, ContentType.objects.get_for_model(model).pk)
+            self._infos[model] = info
+            return info
+
+model_infos = ModelInfoCache()
+
+class StatementCache(object):
+    """
+    Holds the SQL for each of the tagging queries, built once per key -
+    typically the model queried, the number of tags and any flags that
+    change the shape of the statement. Everything else, content type ids
+    and tag counts included, is passed as a bound parameter, so that a
+    statement's text is identical from one call to the next and the
+    database's statement and plan caches can do their job.
+    """
+    def __init__(self):
+        self._statements = {}
+
+    def get(self, key, build, *args):
+        """
+        Returns the statement for ``key``, calling ``build(*args)`` to
+        create it the first time.
+        """
+        try:
+            return self._statements[key]
+        except KeyError:
+            statement = self._statements[key] = build(*args)
+            return statement
+
+    def clear(self):
+        self._statements = {}
+
+statements = StatementCache()
+
+class TagGeneration(object):
+    """
+    A version of everything tagged, in Django's cache, which every write
+    to tags, tagged items or their counts replaces - so that anything
+    cached from them can be keyed on it and retired all at once.
+
+    A new version is made up whenever the current one isn't cached, and
+    versions are never reused, so an evicted version can't bring back
+    stale entries.
+
+    A write made inside a managed transaction isn't seen by anyone else
+    until the transaction's owner commits it, and something cached from
+    the old rows in the meantime would be keyed on the new version - so
+    such writes replace the version again in ``bump_after_commit()``,
+    which ``tagging.middleware.TagGenerationMiddleware`` calls once the
+    response is done, and anything else committing tag writes should call
+    after committing.
+    """
+    key = 'tagging:generation'
+    timeout = 60 * 60 * 24 * 30
+
+    def __init__(self):
+        self._uncommitted = threading.local()
+
+    def get(self):
+        generation = cache.get(self.key)
+        if generation is None:
+            generation = self._replace()
+        return generation
+
+    def bump(self):
+        if transaction.is_managed():
+            self._uncommitted.bumped = True
+        return self._replace()
+
+    def bump_after_commit(self):
+        """Replaces the version again if it was bumped inside a managed transaction since the last call"""
+        if getattr(self._uncommitted, 'bumped', False):
+            self._uncommitted.bumped = False
+            self._replace()
+
+    def _replace(self):
+        generation = uuid.uuid4().hex
+        cache.set(self.key, generation, self.timeout)
+        return generation
+
+tag_generation = TagGeneration()
+
 ############
 # Managers #
 ############
@@ -27,27 +171,184 @@ class TagManager(models.Manager):
     def update_tags(self, obj, tag_names):
         """
         Update tags associated with an object.
+
+        Works out the difference between the object's current and updated
+        tags, then applies it in a single transaction with one ``SELECT``
+        of the existing tags, one batched ``INSERT`` of any missing tags,
+        one batched ``INSERT`` of the new ``TaggedItem`` rows and one
+        ``DELETE`` of the old ones - however many tags are involved.
         """
-        ctype = ContentType.objects.get_for_model(obj)
-        current_tags = list(self.filter(items__content_type__pk=ctype.pk,
-                                        items__object_id=obj.pk))
-        updated_tag_names = parse_tag_input(tag_names)
-        if settings.FORCE_LOWERCASE_TAGS:
-            updated_tag_names = [t.lower() for t in updated_tag_names]
-
-        # Remove tags which no longer apply
-        tags_for_removal = [tag for tag in current_tags \
-                            if tag.name not in updated_tag_names]
-        if len(tags_for_removal):
-            TaggedItem._default_manager.filter(content_type__pk=ctype.pk,
-                                               object_id=obj.pk,
-                                               tag__in=tags_for_removal).delete()
-        # Add new tags
-        current_tag_names = [tag.name for tag in current_tags]
-        for tag_name in updated_tag_names:
-            if tag_name not in current_tag_names:
-                tag, created = self.get_or_create(name=tag_name)
-                TaggedItem._default_manager.create(tag=tag, object=obj)
+        self.update_tags_bulk([(obj, tag_names)])
+
+    def update_tags_bulk(self, tag_names_by_object):
+        """
+        Update tags associated with many objects at once.
+
+        ``tag_names_by_object`` maps each object to its tag input, as
+        given to ``update_tags`` - either as a dict or as a sequence of
+        ``(obj, tag_names)`` pairs. The objects may be of different models.
+
+        Everything is written in a single transaction, using the same
+        handful of batched statements as ``update_tags`` for every
+        ``BULK_CHUNK_SIZE`` objects or tag names.
+
+        Returns a ``(inserted, removed)`` tuple of the number of
+        ``TaggedItem`` rows added and deleted.
+        """
+        if hasattr(tag_names_by_object, 'items'):
+            tag_names_by_object = tag_names_by_object.items()
+
+        updated = {}
+        object_ids_by_ctype = {}
+        models_by_ctype = {}
+        for obj, tag_names in tag_names_by_object:
+            updated_tag_names = parse_tag_input(tag_names)
+            if settings.FORCE_LOWERCASE_TAGS:
+                updated_tag_names = [t.lower() for t in updated_tag_names]
+            ctype_id = model_infos.get(obj).content_type_id
+            models_by_ctype[ctype_id] = obj.__class__
+            updated[(ctype_id, obj.pk)] = updated_tag_names
+            # forget any tags cached by tagging.generic.prefetch_tags
+            obj.__dict__.pop('_prefetched_tags', None)
+            object_ids_by_ctype.setdefault(ctype_id, []).append(obj.pk)
+
+        inserted, removed = self._apply_tag_changes(updated, object_ids_by_ctype, models_by_ctype)
+        if inserted or removed:
+            tag_generation.bump()
+        return inserted, removed
+
+    @commit_on_success_unless_managed
+    def _apply_tag_changes(self, updated, object_ids_by_ctype, models_by_ctype):
+        """
+        Moves each object in ``updated`` - which maps ``(content_type_id,
+        object_id)`` keys to updated tag names - from its current tags to
+        its updated ones, keeping the tag usage and co-occurrence counts
+        in step. Returns how many ``TaggedItem`` rows were added and removed.
+
+        The current tags are read in the same transaction as the changes,
+        and the counts only move for rows this actually inserted or
+        deleted: the rows to delete are locked first (on databases with
+        row locks - SQLite serialises writers anyway), and a row someone
+        else inserted in the meantime is skipped, re-reading that object's
+        tags to pair the new ones with. Two requests adding different
+        tags to one object at once can still miss their co-occurrences,
+        until ``TagCooccurrence.objects.rebuild()``.
+        """
+        # Map each object to its current tag names and their TaggedItem and Tag ids
+        current = {}
+        for ctype_id, object_ids in object_ids_by_ctype.items():
+            for chunk in _chunks(object_ids):
+                items = TaggedItem._default_manager.filter(content_type__pk=ctype_id, object_id__in=chunk)
+                for item_id, object_id, tag_id, name in items.values_list('id', 'object_id', 'tag', 'tag__name'):
+                    current.setdefault((ctype_id, object_id), {})[name] = (item_id, tag_id)
+
+        changed = {}
+        for key, updated_tag_names in updated.items():
+            current_tags = current.get(key, {})
+            if [name for name in current_tags if name not in updated_tag_names] or \
+               [name for name in updated_tag_names if name not in current_tags]:
+                changed.setdefault(key[0], []).append(key[1])
+        if not changed:
+            return 0, 0
+
+        # Work out which of the usage subsets each changed object is in
+        subsets = {}
+        for ctype_id, object_ids in changed.items():
+            for name, object_ids in _usage_subset_members(models_by_ctype[ctype_id], object_ids).items():
+                for object_id in object_ids:
+                    subsets.setdefault((ctype_id, object_id), []).append(name)
+
+        item_ids_for_removal = []
+        items_for_addition = []
+        for key in updated:
+            if key[1] not in changed.get(key[0], []):
+                continue
+            current_tags = current.get(key, {})
+            item_ids_for_removal.extend([item_id for name, (item_id, tag_id) in current_tags.items() \
+                                         if name not in updated[key]])
+            items_for_addition.extend([key + (name,) for name in updated[key] if name not in current_tags])
+
+        tagged_item_table = model_infos.get(TaggedItem).table
+        cursor = connection.cursor()
+
+        # Remove tags which no longer apply, if nobody else has already
+        removed_item_ids = set()
+        for chunk in _chunks(item_ids_for_removal):
+            sql = 'SELECT id FROM %s WHERE id IN (%s)' % (tagged_item_table, ','.join(['%s'] * len(chunk)))
+            if 'sqlite3' not in connection.settings_dict['ENGINE']:
+                sql += ' FOR UPDATE'
+            cursor.execute(sql, chunk)
+            chunk = [row[0] for row in cursor.fetchall()]
+            if chunk:
+                cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (
+                    tagged_item_table, ','.join(['%s'] * len(chunk))), chunk)
+                removed_item_ids.update(chunk)
+
+        # Add new tags, creating any which don't exist yet, unless someone else has already
+        added_tag_ids = {}
+        raced = {}
+        if items_for_addition:
+            tag_ids = self._get_or_create_ids(list(set([name for ctype_id, object_id, name in items_for_addition])))
+            rows = [(tag_ids[name], ctype_id, object_id) for ctype_id, object_id, name in items_for_addition]
+            inserted_rows = _insert_ignoring_duplicates(
+                'INSERT INTO %s (tag_id, content_type_id, object_id) VALUES (%%s, %%s, %%s)' % tagged_item_table,
+                rows, _existing_tagged_items)
+            for tag_id, ctype_id, object_id in inserted_rows:
+                added_tag_ids.setdefault((ctype_id, object_id), []).append(tag_id)
+            if len(inserted_rows) < len(rows):
+                for tag_id, ctype_id, object_id in set(rows) - set(inserted_rows):
+                    raced.setdefault((ctype_id, object_id), [])
+
+        # Objects someone else tagged meanwhile are re-read, for the co-occurrences with their new tags
+        for ctype_id, object_ids in _keys_by_ctype(raced).items():
+            for chunk in _chunks(object_ids):
+                items = TaggedItem._default_manager.filter(content_type__pk=ctype_id, object_id__in=chunk)
+                for object_id, tag_id in items.values_list('object_id', 'tag'):
+                    raced[(ctype_id, object_id)].append(tag_id)
+
+        usage_deltas = {}
+        pair_deltas = {}
+        object_deltas = {}
+        for key in updated:
+            if key[1] not in changed.get(key[0], []):
+                continue
+            current_items = current.get(key, {}).values()
+            removed_tag_ids = [tag_id for item_id, tag_id in current_items if item_id in removed_item_ids]
+            added = added_tag_ids.get(key, [])
+            if key in raced:
+                # count just the rows changed here, against the tags the object really has now
+                updated_tag_ids = raced[key]
+                current_tag_ids = [tag_id for tag_id in updated_tag_ids if tag_id not in added] + removed_tag_ids
+            else:
+                current_tag_ids = [tag_id for item_id, tag_id in current_items]
+                updated_tag_ids = [tag_id for tag_id in current_tag_ids if tag_id not in removed_tag_ids] + added
+            for subset in [''] + subsets.get(key, []):
+                _count_usage(usage_deltas, key[0], current_tag_ids, updated_tag_ids, subset)
+            _count_cooccurrences(pair_deltas, key[0], current_tag_ids, updated_tag_ids)
+            _count_objects(object_deltas, key[0], current_tag_ids, updated_tag_ids)
+        TagUsage.objects.update_counts(usage_deltas)
+        TagCooccurrence.objects.update_counts(pair_deltas)
+        TaggedObjectCount.objects.update_counts(object_deltas)
+        transaction.commit_unless_managed()
+        return sum([len(tag_ids) for tag_ids in added_tag_ids.values()]), len(removed_item_ids)
+
+    def _get_or_create_ids(self, tag_names):
+        """
+        Returns a dict mapping each of ``tag_names`` to its tag's id,
+        inserting the tags which don't exist yet in one batch. A tag
+        created by someone else in the meantime is quietly reused.
+        """
+        tag_ids = {}
+        for chunk in _chunks(tag_names):
+            tag_ids.update(self.filter(name__in=chunk).values_list('name', 'id'))
+        missing = [name for name in tag_names if name not in tag_ids]
+        if missing:
+            _insert_ignoring_duplicates(
+                'INSERT INTO %s (name) VALUES (%%s)' % model_infos.get(self.model).table,
+                [(name,) for name in missing])
+            for chunk in _chunks(missing):
+                tag_ids.update(self.filter(name__in=chunk).values_list('name', 'id'))
+        return tag_ids
 
     def add_tag(self, obj, tag_name):
         """
@@ -61,66 +362,44 @@ class TagManager(models.Manager):
         tag_name = tag_names[0]
         if settings.FORCE_LOWERCASE_TAGS:
             tag_name = tag_name.lower()
-        tag, created = self.get_or_create(name=tag_name)
-        ctype = ContentType.objects.get_for_model(obj)
-        TaggedItem._default_manager.get_or_create(
-            tag=tag, content_type=ctype, object_id=obj.pk)
+        if self._add_tag(obj, tag_name):
+            tag_generation.bump()
+            obj.__dict__.pop('_prefetched_tags', None)
+
+    @commit_on_success_unless_managed
+    def _add_tag(self, obj, tag_name):
+        """
+        Tags ``obj`` with ``tag_name`` - creating the tag if need be -
+        and moves the counts along with it. Returns whether the
+        ``TaggedItem`` row was inserted here, rather than already there.
+        """
+        ctype_id = model_infos.get(obj).content_type_id
+        tag_id = self._get_or_create_ids([tag_name])[tag_name]
+        if not _insert_ignoring_duplicates(
+                'INSERT INTO %s (tag_id, content_type_id, object_id) VALUES (%%s, %%s, %%s)' %
+                model_infos.get(TaggedItem).table, [(tag_id, ctype_id, obj.pk)], _existing_tagged_items):
+            return False
+        other_tag_ids = list(TaggedItem._default_manager.filter(content_type__pk=ctype_id,
+            object_id=obj.pk).exclude(tag__pk=tag_id).values_list('tag', flat=True))
+        TagUsage.objects.update_counts(dict([((ctype_id, tag_id, subset), 1) for subset in
+            [''] + _usage_subset_members(obj.__class__, [obj.pk]).keys()]))
+        deltas = {}
+        _count_cooccurrences(deltas, ctype_id, other_tag_ids, other_tag_ids + [tag_id])
+        TagCooccurrence.objects.update_counts(deltas)
+        deltas = {}
+        _count_objects(deltas, ctype_id, other_tag_ids, other_tag_ids + [tag_id])
+        TaggedObjectCount.objects.update_counts(deltas)
+        transaction.commit_unless_managed()
+        return True
 
     def get_for_object(self, obj):
         """
         Create a queryset matching all tags associated with the given
         object.
         """
-        ctype = ContentType.objects.get_for_model(obj)
-        return self.filter(items__content_type__pk=ctype.pk,
+        return self.filter(items__content_type__pk=model_infos.get(obj).content_type_id,
                            items__object_id=obj.pk)
 
-    def _get_usage(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None):
-        """
-        Perform the custom SQL query for ``usage_for_model`` and
-        ``usage_for_queryset``.
-        """
-        if min_count is not None: counts = True
-
-        model_table = qn(model._meta.db_table)
-        model_pk = '%s.%s' % (model_table, qn(model._meta.pk.column))
-        query = """
-        SELECT DISTINCT %(tag)s.id, %(tag)s.name%(count_sql)s
-        FROM
-            %(tag)s
-            INNER JOIN %(tagged_item)s
-                ON %(tag)s.id = %(tagged_item)s.tag_id
-            INNER JOIN %(model)s
-                ON %(tagged_item)s.object_id = %(model_pk)s
-            %%s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-            %%s
-        GROUP BY %(tag)s.id, %(tag)s.name
-        %%s
-        ORDER BY %(tag)s.name ASC""" % {
-            'tag': qn(self.model._meta.db_table),
-            'count_sql': counts and (', COUNT(%s)' % model_pk) or '',
-            'tagged_item': qn(TaggedItem._meta.db_table),
-            'model': model_table,
-            'model_pk': model_pk,
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-        }
-
-        min_count_sql = ''
-        if min_count is not None:
-            min_count_sql = 'HAVING COUNT(%s) >= %%s' % model_pk
-            params.append(min_count)
-
-        cursor = connection.cursor()
-        cursor.execute(query % (extra_joins, extra_criteria, min_count_sql), params)
-        tags = []
-        for row in cursor.fetchall():
-            t = self.model(*row[:2])
-            if counts:
-                t.count = row[2]
-            tags.append(t)
-        return tags
-
     def usage_for_model(self, model, counts=False, min_count=None, filters=None):
         """
         Obtain a list of tags associated with instances of the given
@@ -138,9 +417,17 @@ class TagManager(models.Manager):
         used by a subset of the Model's instances, pass a dictionary
         of field lookups to be applied to the given Model as the
         ``filters`` argument.
+
+        Without ``filters``, or with the same ``filters`` as one of the
+        model's usage subsets (see ``register_usage_subset``), the tags
+        and counts are read straight from the ``TagUsage`` table.
         """
         if filters is None: filters = {}
 
+        subset = _usage_subset_named(model, filters)
+        if subset is not None:
+            return TagUsage.objects.usage(model_infos.get(model).content_type_id, counts, min_count, subset)
+
         queryset = model._default_manager.filter()
         for f in filters.items():
             queryset.query.add_filter(f)
@@ -160,25 +447,26 @@ class TagManager(models.Manager):
         If ``min_count`` is given, only tags which have a ``count``
         greater than or equal to ``min_count`` will be returned.
         Passing a value for ``min_count`` implies ``counts=True``.
-        """
 
-        if getattr(queryset.query, 'get_compiler', None):
-            # Django 1.2+
-            compiler = queryset.query.get_compiler(using='default')
-            extra_joins = ' '.join(compiler.get_from_clause()[0][1:])
-            where, params = queryset.query.where.as_sql(
-                compiler.quote_name_unless_alias, compiler.connection
-            )
-        else:
-            # Django pre-1.2
-            extra_joins = ' '.join(queryset.query.get_from_clause()[0][1:])
-            where, params = queryset.query.where.as_sql()
+        The queryset is used as a subquery selecting the ids of the
+        objects whose tags are counted, so any filters, joins or
+        managers it uses are supported.
+        """
+        if isinstance(queryset, EmptyQuerySet):
+            return []
+        if min_count is not None: counts = True
 
-        if where:
-            extra_criteria = 'AND %s' % where
-        else:
-            extra_criteria = ''
-        return self._get_usage(queryset.model, counts, min_count, extra_joins, extra_criteria, params)
+        usage = _usage_for_objects(model_infos.get(queryset.model).content_type_id, queryset,
+                                   'tag', 'tag__name')
+        if min_count is not None:
+            usage = usage.filter(count__gte=min_count)
+        tags = []
+        for row in usage.order_by('tag__name'):
+            t = self.model(row['tag'], row['tag__name'])
+            if counts:
+                t.count = row['count']
+            tags.append(t)
+        return tags
 
     def related_for_model(self, tags, model, counts=False, min_count=None):
         """
@@ -196,48 +484,66 @@ class TagManager(models.Manager):
         if min_count is not None: counts = True
         tags = get_tag_list(tags)
         tag_count = len(tags)
-        tagged_item_table = qn(TaggedItem._meta.db_table)
-        query = """
+        queryset, model = get_queryset_and_model(model)
+        content_type_id = model_infos.get(model).content_type_id
+
+        # A single tag's related tags and their counts are kept up to date
+        # in the co-occurrence table. With more tags, any related tag has
+        # to co-occur with each of them, which rules out most candidates,
+        # and only the candidates left are counted.
+        if tag_count == 1:
+            return TagCooccurrence.objects.related_tags(content_type_id, tags[0], counts, min_count)
+        candidate_ids = tags and sorted(TagCooccurrence.objects.common_related_tag_ids(content_type_id, tags, min_count))
+        if not candidate_ids:
+            return []
+
+        tag_ids = [tag.pk for tag in tags]
+        cursor = connection.cursor()
+        related = []
+        for chunk in _chunks(candidate_ids):
+            query = statements.get(('related_for_model', tag_count, len(chunk), counts, min_count is not None),
+                                   self._related_for_model_sql, tag_count, len(chunk), counts, min_count is not None)
+            params = [content_type_id] + chunk + [content_type_id] + tag_ids + [tag_count]
+            if min_count is not None:
+                params.append(min_count)
+            cursor.execute(query, params)
+            for row in cursor.fetchall():
+                tag = self.model(*row[:2])
+                if counts is True:
+                    tag.count = row[2]
+                related.append(tag)
+        if len(candidate_ids) > BULK_CHUNK_SIZE:
+            related.sort(key=lambda tag: tag.name)
+        return related
+
+    def _related_for_model_sql(self, tag_count, candidate_count, counts, having):
+        tagged_item_table = model_infos.get(TaggedItem).table
+        return """
         SELECT %(tag)s.id, %(tag)s.name%(count_sql)s
         FROM %(tagged_item)s INNER JOIN %(tag)s ON %(tagged_item)s.tag_id = %(tag)s.id
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
+        WHERE %(tagged_item)s.content_type_id = %%s
+          AND %(tagged_item)s.tag_id IN (%(candidate_id_placeholders)s)
           AND %(tagged_item)s.object_id IN
           (
               SELECT %(tagged_item)s.object_id
               FROM %(tagged_item)s, %(tag)s
-              WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
+              WHERE %(tagged_item)s.content_type_id = %%s
                 AND %(tag)s.id = %(tagged_item)s.tag_id
                 AND %(tag)s.id IN (%(tag_id_placeholders)s)
               GROUP BY %(tagged_item)s.object_id
-              HAVING COUNT(%(tagged_item)s.object_id) = %(tag_count)s
+              HAVING COUNT(%(tagged_item)s.object_id) = %%s
           )
-          AND %(tag)s.id NOT IN (%(tag_id_placeholders)s)
         GROUP BY %(tag)s.id, %(tag)s.name
         %(min_count_sql)s
         ORDER BY %(tag)s.name ASC""" % {
-            'tag': qn(self.model._meta.db_table),
+            'tag': model_infos.get(self.model).table,
             'count_sql': counts and ', COUNT(%s.object_id)' % tagged_item_table or '',
             'tagged_item': tagged_item_table,
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
+            'candidate_id_placeholders': ','.join(['%s'] * candidate_count),
             'tag_id_placeholders': ','.join(['%s'] * tag_count),
-            'tag_count': tag_count,
-            'min_count_sql': min_count is not None and ('HAVING COUNT(%s.object_id) >= %%s' % tagged_item_table) or '',
+            'min_count_sql': having and ('HAVING COUNT(%s.object_id) >= %%s' % tagged_item_table) or '',
         }
 
-        params = [tag.pk for tag in tags] * 2
-        if min_count is not None:
-            params.append(min_count)
-
-        cursor = connection.cursor()
-        cursor.execute(query, params)
-        related = []
-        for row in cursor.fetchall():
-            tag = self.model(*row[:2])
-            if counts is True:
-                tag.count = row[2]
-            related.append(tag)
-        return related
-
     def cloud_for_model(self, model, steps=4, distribution=LOGARITHMIC,
                         filters=None, min_count=None):
         """
@@ -267,18 +573,386 @@ class TagManager(models.Manager):
                                          min_count=min_count))
         return calculate_cloud(tags, steps, distribution)
 
+# Most databases cap the number of parameters in a statement - SQLite
+# at 999 - so lookups on long lists of ids or names are split up
+BULK_CHUNK_SIZE = 500
+
+def _chunks(values, size=None):
+    """
+    Splits a list into consecutive lists of at most ``size`` items,
+    ``BULK_CHUNK_SIZE`` by default.
+    """
+    size = size or BULK_CHUNK_SIZE
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def _keys_by_ctype(keys):
+    """Groups ``(content_type_id, object_id)`` keys into a dict of object ids by content type id"""
+    object_ids_by_ctype = {}
+    for ctype_id, object_id in keys:
+        object_ids_by_ctype.setdefault(ctype_id, []).append(object_id)
+    return object_ids_by_ctype
+
+def _insert_ignoring_duplicates(sql, rows, existing=None):
+    """
+    Runs a parameterised ``INSERT`` for all of ``rows`` as one batch.
+    If that breaks a unique constraint - because a concurrent request
+    got there first - the rows are retried one at a time, each under
+    its own savepoint, skipping those which already exist.
+
+    Without savepoints (SQLite, in Django 1.2) a failed batch can't be
+    undone, and the rows before the duplicate stay inserted, so the
+    retries can't tell which rows were inserted here. If ``existing`` -
+    a function returning which of a list of rows are in the table - is
+    given, the rows it finds are left out of the batch beforehand, and
+    should one be inserted by someone else in the meantime anyway, it's
+    used again to read back which rows are in the table afterwards.
+
+    Returns a list of the rows actually inserted.
+    """
+    cursor = connection.cursor()
+    if not connection.features.uses_savepoints:
+        if existing is not None:
+            found = existing(rows)
+            rows = [row for row in rows if row not in found]
+        try:
+            cursor.executemany(sql, rows)
+            return list(rows)
+        except IntegrityError:
+            inserted = []
+            for row in rows:
+                try:
+                    cursor.execute(sql, row)
+                    inserted.append(row)
+                except IntegrityError:
+                    pass
+            if existing is not None:
+                found = existing(rows)
+                inserted = [row for row in rows if row in found]
+            return inserted
+
+    sid = transaction.savepoint()
+    try:
+        cursor.executemany(sql, rows)
+        transaction.savepoint_commit(sid)
+        return list(rows)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        inserted = []
+        for row in rows:
+            sid = transaction.savepoint()
+            try:
+                cursor.execute(sql, row)
+                transaction.savepoint_commit(sid)
+                inserted.append(row)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+        return inserted
+
+def _existing_tagged_items(rows):
+    """Returns which of the ``(tag_id, content_type_id, object_id)`` ``rows`` are in the TaggedItem table"""
+    found = set()
+    for ctype_id, object_ids in _keys_by_ctype([(ctype_id, object_id) for tag_id, ctype_id, object_id in rows]).items():
+        for chunk in _chunks(list(set(object_ids))):
+            items = TaggedItem._default_manager.filter(content_type__pk=ctype_id, object_id__in=chunk)
+            found.update([(tag_id, ctype_id, object_id) for tag_id, object_id in items.values_list('tag', 'object_id')])
+    return found.intersection(rows)
+
+def _usage_for_objects(content_type_id, queryset, *fields):
+    """
+    Returns a ``values()`` queryset of the ``TaggedItem`` rows of the
+    objects in ``queryset``, grouped by ``fields``, each with the
+    ``count`` of objects in the group.
+    """
+    return TaggedItem._default_manager.filter(content_type__pk=content_type_id,
+        object_id__in=queryset.order_by().values('pk')).values(*fields).annotate(count=Count('object_id'))
+
+# The subsets of each model's instances whose tag usage is counted
+# separately, keyed by model and then by name
+usage_subsets = {}
+
+def register_usage_subset(model, name, **filters):
+    """
+    Counts the tag usage of the instances of ``model`` which match the
+    field lookups given as ``filters`` separately, under ``name``, so
+    that ``usage_for_model`` and ``cloud_for_model`` can read it straight
+    from the ``TagUsage`` table when given the same ``filters``. Eg::
+
+       register_usage_subset(Article, 'published', published=True)
+
+    The filters should only depend on the model's own fields, as the
+    counts are moved between subsets when an instance is saved. Run
+    the ``rebuild_tag_counts`` command after registering a new subset.
+    """
+    usage_subsets.setdefault(model, {})[name] = filters
+    signals.pre_save.connect(remember_usage_subsets, model)
+    signals.post_save.connect(count_usage_subset_changes, model)
+
+def _usage_subset_named(model, filters):
+    """
+    Returns the name of the usage subset of ``model`` with exactly the
+    given ``filters`` - ``''`` for none - or ``None`` if there isn't one.
+    """
+    if not filters:
+        return ''
+    for name, subset_filters in usage_subsets.get(model, {}).items():
+        if subset_filters == filters:
+            return name
+    return None
+
+def _usage_subset_members(model, object_ids):
+    """
+    Returns a dict mapping the names of the usage subsets of ``model`` to
+    the ones of ``object_ids`` which are in them.
+    """
+    members = {}
+    for name, filters in usage_subsets.get(model, {}).items():
+        members[name] = []
+        for chunk in _chunks(object_ids):
+            members[name].extend(model._base_manager.filter(pk__in=chunk, **filters).values_list('pk', flat=True))
+    return members
+
+def _count_usage(deltas, content_type_id, old_tag_ids, new_tag_ids, subset=''):
+    """
+    Adds up in ``deltas`` how the usage counts of tags change when an
+    object of the given content type - in the given usage subset - has
+    its tags changed from ``old_tag_ids`` to ``new_tag_ids``.
+    """
+    old_tag_ids, new_tag_ids = set(old_tag_ids), set(new_tag_ids)
+    for tag_ids, others, delta in ((old_tag_ids, new_tag_ids, -1), (new_tag_ids, old_tag_ids, 1)):
+        for tag_id in tag_ids - others:
+            key = (content_type_id, tag_id, subset)
+            deltas[key] = deltas.get(key, 0) + delta
+
+def _count_cooccurrences(deltas, content_type_id, old_tag_ids, new_tag_ids):
+    """
+    Adds up in ``deltas`` how the co-occurrence counts of each ordered
+    pair of tags change when an object of the given content type has its
+    tags changed from ``old_tag_ids`` to ``new_tag_ids``.
+    """
+    old_tag_ids, new_tag_ids = set(old_tag_ids), set(new_tag_ids)
+    for tag_ids, others, delta in ((old_tag_ids, new_tag_ids, -1), (new_tag_ids, old_tag_ids, 1)):
+        for tag_id in tag_ids:
+            for related_tag_id in tag_ids:
+                # pairs which are there both before and after don't change
+                if related_tag_id != tag_id and not (tag_id in others and related_tag_id in others):
+                    key = (content_type_id, tag_id, related_tag_id)
+                    deltas[key] = deltas.get(key, 0) + delta
+
+def _count_objects(deltas, content_type_id, old_tag_ids, new_tag_ids):
+    """
+    Adds up in ``deltas`` how the count of tagged objects of the given
+    content type changes when an object has its tags changed from
+    ``old_tag_ids`` to ``new_tag_ids``.
+    """
+    if bool(old_tag_ids) != bool(new_tag_ids):
+        key = (content_type_id,)
+        deltas[key] = deltas.get(key, 0) + (new_tag_ids and 1 or -1)
+
+class CounterManager(models.Manager):
+    """
+    Keeps a table of counts, each keyed by ``key_columns``, in step with
+    the tagging write paths.
+    """
+    key_columns = ()
+
+    def update_counts(self, deltas):
+        """
+        Applies a dict of changes to the counts, keyed by tuples of the
+        ``key_columns`` values, with a ``SELECT`` of the rows already
+        there, one ``INSERT`` of the rest and one batch each of ``UPDATE``
+        and ``DELETE`` statements. Rows counted down to zero are deleted.
+        """
+        deltas = dict([(key, delta) for key, delta in deltas.items() if delta])
+        if not deltas:
+            return
+
+        table = model_infos.get(self.model).table
+        count = qn('count')
+        key_sql = ' AND '.join(['%s = %%s' % column for column in self.key_columns])
+        existing = self._existing_keys(deltas.keys())
+        missing = [key for key, delta in deltas.items() if delta > 0 and key not in existing]
+        if missing:
+            _insert_ignoring_duplicates('INSERT INTO %s (%s, %s) VALUES (%s, 0)' % (
+                table, ', '.join(self.key_columns), count, ', '.join(['%s'] * len(self.key_columns))),
+                missing)
+        cursor = connection.cursor()
+        cursor.executemany('UPDATE %s SET %s = %s + %%s WHERE %s' % (table, count, count, key_sql),
+                           [(delta,) + key for key, delta in deltas.items()])
+        emptied = [key for key, delta in deltas.items() if delta < 0]
+        if emptied:
+            cursor.executemany('DELETE FROM %s WHERE %s AND %s <= 0' % (table, key_sql, count), emptied)
+        transaction.commit_unless_managed()
+
+class TagUsageManager(CounterManager):
+    key_columns = ('content_type_id', 'tag_id', 'subset')
+
+    def _existing_keys(self, keys):
+        tag_ids_by_ctype = {}
+        for content_type_id, tag_id, subset in keys:
+            tag_ids_by_ctype.setdefault(content_type_id, set()).add(tag_id)
+        existing = set()
+        for content_type_id, tag_ids in tag_ids_by_ctype.items():
+            for chunk in _chunks(list(tag_ids)):
+                usage = self.filter(content_type__pk=content_type_id, tag__in=chunk).values_list('tag', 'subset')
+                existing.update([(content_type_id, tag_id, subset) for tag_id, subset in usage])
+        return existing
+
+    def usage(self, content_type_id, counts=False, min_count=None, subset=''):
+        """
+        Returns the tags used on objects of the given content type - or
+        just those in the named usage subset - ordered by name, as
+        ``Tag.objects.usage_for_model`` does.
+        """
+        usage = self.filter(content_type__pk=content_type_id, subset=subset, count__gte=min_count or 1)
+        tags = []
+        for tag_usage in usage.select_related('tag').order_by('tag__name'):
+            tag = tag_usage.tag
+            if counts or min_count is not None:
+                tag.count = tag_usage.count
+            tags.append(tag)
+        return tags
+
+    @commit_on_success_unless_managed
+    def rebuild(self):
+        """
+        Recounts the uses of every tag by each content type, and by each
+        of the usage subsets, from the ``TaggedItem`` table - ignoring the
+        tags of objects which no longer exist, as ``usage_for_model``
+        does - returning the number of counts.
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % model_infos.get(self.model).table)
+        content_type_ids = TaggedItem._default_manager.values_list('content_type', flat=True).distinct()
+        for content_type in ContentType.objects.filter(pk__in=list(content_type_ids)):
+            model = content_type.model_class()
+            if model is None:
+                continue
+            subsets = [('', {})] + usage_subsets.get(model, {}).items()
+            for subset, filters in subsets:
+                usage = _usage_for_objects(content_type.pk, model._base_manager.filter(**filters), 'tag')
+                cursor.executemany(
+                    'INSERT INTO %s (content_type_id, tag_id, subset, %s) VALUES (%%s, %%s, %%s, %%s)' % (
+                    model_infos.get(self.model).table, qn('count')),
+                    [(content_type.pk, row['tag'], subset, row['count']) for row in usage.order_by()])
+        transaction.commit_unless_managed()
+        return self.count()
+
+class TagCooccurrenceManager(CounterManager):
+    key_columns = ('content_type_id', 'tag_id', 'related_tag_id')
+
+    def _existing_keys(self, keys):
+        tag_ids_by_ctype = {}
+        for content_type_id, tag_id, related_tag_id in keys:
+            tag_ids_by_ctype.setdefault(content_type_id, set()).add(tag_id)
+        existing = set()
+        for content_type_id, tag_ids in tag_ids_by_ctype.items():
+            # pairs are stored both ways round, so the same tags appear on each side
+            for chunk in _chunks(list(tag_ids), max(1, BULK_CHUNK_SIZE // 2)):
+                for related_chunk in _chunks(list(tag_ids), max(1, BULK_CHUNK_SIZE // 2)):
+                    pairs = self.filter(content_type__pk=content_type_id, tag__in=chunk,
+                        related_tag__in=related_chunk).values_list('tag', 'related_tag')
+                    existing.update([(content_type_id, tag_id, related_tag_id) for tag_id, related_tag_id in pairs])
+        return existing
+
+    def related_tags(self, content_type_id, tag, counts=False, min_count=None):
+        """
+        Returns the tags used together with ``tag`` on objects of the
+        given content type, ordered by name, as ``Tag.objects.related_for_model``
+        does.
+        """
+        pairs = self.filter(content_type__pk=content_type_id, tag__pk=tag.pk, count__gte=min_count or 1)
+        related = []
+        for pair in pairs.select_related('related_tag').order_by('related_tag__name'):
+            related_tag = pair.related_tag
+            if counts:
+                related_tag.count = pair.count
+            related.append(related_tag)
+        return related
+
+    def common_related_tag_ids(self, content_type_id, tags, min_count=None):
+        """
+        Returns the ids of the tags which are used together with each of
+        ``tags`` - at least ``min_count`` times - on objects of the given
+        content type.
+        """
+        tag_ids = [tag.pk for tag in tags]
+        related = {}
+        pairs = self.filter(content_type__pk=content_type_id, tag__in=tag_ids, count__gte=min_count or 1)
+        for tag_id, related_tag_id in pairs.values_list('tag', 'related_tag'):
+            related.setdefault(tag_id, set()).add(related_tag_id)
+        common = related.get(tag_ids[0], set())
+        for tag_id in tag_ids[1:]:
+            common = common & related.get(tag_id, set())
+        return common - set(tag_ids)
+
+    @commit_on_success_unless_managed
+    def rebuild(self):
+        """
+        Recounts every pair of tags used together on the same object from
+        the ``TaggedItem`` table, returning the number of pairs.
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % model_infos.get(self.model).table)
+        cursor.execute(REBUILD_COOCCURRENCES_SQL % {
+            'cooccurrence': model_infos.get(self.model).table,
+            'tagged_item': model_infos.get(TaggedItem).table,
+            'count': qn('count'),
+        })
+        transaction.commit_unless_managed()
+        return self.count()
+
+REBUILD_COOCCURRENCES_SQL = """
+INSERT INTO %(cooccurrence)s (content_type_id, tag_id, related_tag_id, %(count)s)
+SELECT tagged.content_type_id, tagged.tag_id, related.tag_id, COUNT(*)
+FROM %(tagged_item)s tagged
+    INNER JOIN %(tagged_item)s related
+        ON related.content_type_id = tagged.content_type_id
+        AND related.object_id = tagged.object_id
+        AND related.tag_id != tagged.tag_id
+GROUP BY tagged.content_type_id, tagged.tag_id, related.tag_id"""
+
+class TaggedObjectCountManager(CounterManager):
+    key_columns = ('content_type_id',)
+
+    def _existing_keys(self, keys):
+        content_type_ids = [content_type_id for content_type_id, in keys]
+        return set([(content_type_id,) for content_type_id in
+                    self.filter(content_type__pk__in=content_type_ids).values_list('content_type', flat=True)])
+
+    @commit_on_success_unless_managed
+    def rebuild(self):
+        """
+        Recounts the objects of each content type which have any tags
+        from the ``TaggedItem`` table - ignoring objects which no longer
+        exist, as ``TagUsage.objects.rebuild()`` does - returning the
+        number of content types counted.
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % model_infos.get(self.model).table)
+        content_type_ids = TaggedItem._default_manager.values_list('content_type', flat=True).distinct()
+        for content_type in ContentType.objects.filter(pk__in=list(content_type_ids)):
+            model = content_type.model_class()
+            if model is None:
+                continue
+            counts = TaggedItem._default_manager.filter(content_type__pk=content_type.pk,
+                object_id__in=model._base_manager.order_by().values('pk')).values('content_type').annotate(
+                count=Count('object_id', distinct=True))
+            cursor.executemany('INSERT INTO %s (content_type_id, %s) VALUES (%%s, %%s)' % (
+                model_infos.get(self.model).table, qn('count')),
+                [(content_type.pk, row['count']) for row in counts.order_by()])
+        transaction.commit_unless_managed()
+        return self.count()
+
 class TaggedItemManager(models.Manager):
     """
     FIXME There's currently no way to get the ``GROUP BY`` and ``HAVING``
           SQL clauses required by many of this manager's methods into
           Django's ORM.
 
-          For now, we manually execute a query to retrieve the PKs of
-          objects we're interested in, then use the ORM's ``__in``
-          lookup to return a ``QuerySet``.
-
-          Now that the queryset-refactor branch is in the trunk, this can be
-          tidied up significantly.
+          ``get_intersection_by_model`` and ``get_union_by_model`` add
+          them to the ``QuerySet`` they return as a raw subquery.
+          ``get_related`` ranks the objects we're interested in itself,
+          from a few bounded queries.
     """
     def get_by_model(self, queryset_or_model, tags):
         """
@@ -299,25 +973,27 @@ class TaggedItemManager(models.Manager):
             return self.get_intersection_by_model(queryset_or_model, tags)
 
         queryset, model = get_queryset_and_model(queryset_or_model)
-        content_type = ContentType.objects.get_for_model(model)
-        opts = self.model._meta
-        tagged_item_table = qn(opts.db_table)
         return queryset.extra(
-            tables=[opts.db_table],
-            where=[
-                '%s.content_type_id = %%s' % tagged_item_table,
-                '%s.tag_id = %%s' % tagged_item_table,
-                '%s.%s = %s.object_id' % (qn(model._meta.db_table),
-                                          qn(model._meta.pk.column),
-                                          tagged_item_table)
-            ],
-            params=[content_type.pk, tag.pk],
+            tables=[self.model._meta.db_table],
+            where=statements.get(('by_model', model), self._by_model_sql, model),
+            params=[model_infos.get(model).content_type_id, tag.pk],
         )
 
+    def _by_model_sql(self, model):
+        tagged_item_table = model_infos.get(self.model).table
+        return [
+            '%s.content_type_id = %%s' % tagged_item_table,
+            '%s.tag_id = %%s' % tagged_item_table,
+            '%s = %s.object_id' % (model_infos.get(model).pk, tagged_item_table),
+        ]
+
     def get_intersection_by_model(self, queryset_or_model, tags):
         """
         Create a ``QuerySet`` containing instances of the specified
         model associated with *all* of the given list of tags.
+
+        The ids of the tagged objects are selected by a subquery, so
+        nothing is run until the ``QuerySet`` is evaluated.
         """
         tags = get_tag_list(tags)
         tag_count = len(tags)
@@ -326,37 +1002,21 @@ class TaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
-        model_table = qn(model._meta.db_table)
-        # This query selects the ids of all objects which have all the
+        # The subquery selects the ids of all objects which have all the
         # given tags.
-        query = """
-        SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
-        GROUP BY %(model_pk)s
-        HAVING COUNT(%(model_pk)s) = %(tag_count)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
-            'tagged_item': qn(self.model._meta.db_table),
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
-            'tag_count': tag_count,
-        }
-
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
+        return queryset.extra(
+            where=[statements.get(('intersection', model, tag_count),
+                                  self._object_ids_sql, model, tag_count, True)],
+            params=[model_infos.get(model).content_type_id] + [tag.pk for tag in tags] + [tag_count],
+        )
 
     def get_union_by_model(self, queryset_or_model, tags):
         """
         Create a ``QuerySet`` containing instances of the specified
         model associated with *any* of the given list of tags.
+
+        The ids of the tagged objects are selected by a subquery, so
+        nothing is run until the ``QuerySet`` is evaluated.
         """
         tags = get_tag_list(tags)
         tag_count = len(tags)
@@ -365,90 +1025,207 @@ class TaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
-        model_table = qn(model._meta.db_table)
-        # This query selects the ids of all objects which have any of
+        # The subquery selects the ids of all objects which have any of
         # the given tags.
-        query = """
-        SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
-        GROUP BY %(model_pk)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
-            'tagged_item': qn(self.model._meta.db_table),
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
+        return queryset.extra(
+            where=[statements.get(('union', model, tag_count),
+                                  self._object_ids_sql, model, tag_count, False)],
+            params=[model_infos.get(model).content_type_id] + [tag.pk for tag in tags],
+        )
+
+    def _object_ids_sql(self, model, tag_count, intersection):
+        query = """%(model_pk)s IN (
+            SELECT %(tagged_item)s.object_id
+            FROM %(tagged_item)s
+            WHERE %(tagged_item)s.content_type_id = %%s
+              AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)""" % {
+            'model_pk': model_infos.get(model).pk,
+            'tagged_item': model_infos.get(self.model).table,
             'tag_id_placeholders': ','.join(['%s'] * tag_count),
         }
+        if intersection:
+            # Each tag is used at most once per object, so an object has
+            # them all if it has as many of them as were given
+            query += """
+            GROUP BY %(tagged_item)s.object_id
+            HAVING COUNT(%(tagged_item)s.object_id) = %%s""" % {
+                'tagged_item': model_infos.get(self.model).table,
+            }
+        return query + ')'
 
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
-
-    def get_related(self, obj, queryset_or_model, num=None):
+    def get_related(self, obj, queryset_or_model, num=None, max_df=None, max_candidates=None):
         """
         Retrieve a list of instances of the specified model which share
-        tags with the model instance ``obj``, ordered by the number of
-        shared tags in descending order.
+        tags with the model instance ``obj``, ordered by how much they
+        have in common with it, in descending order.
+
+        Each shared tag counts for more the rarer it is among the
+        model's instances - ``log(1 + N / df)``, where ``N`` is the number
+        of instances with any tags and ``df`` how many have the tag, as
+        read from the ``TaggedObjectCount`` and ``TagUsage`` tables - and
+        the total is set as a ``score`` attribute on each instance returned.
 
         If ``num`` is given, a maximum of ``num`` instances will be
         returned.
+
+        If ``max_df`` is given, tags used on more than that fraction of
+        the model's instances are ignored altogether.
+
+        Candidates are gathered from ``obj``'s rarest tags first, and no
+        more than ``max_candidates`` (``settings.RELATED_MAX_CANDIDATES``
+        by default) uses of them are read, so the work done stays bounded
+        however common its tags are. Instances which only share tags
+        with ``obj`` that were left over once that many were read are
+        not considered. If ``obj``'s rarest tag alone is used more than
+        that many times, the instances with the lowest ids are read.
         """
+        return self.get_related_in_bulk([obj], queryset_or_model, num, max_df, max_candidates)[obj.pk]
+
+    def get_related_in_bulk(self, objs, queryset_or_model, num=None, max_df=None, max_candidates=None):
+        """
+        Does what ``get_related`` does for each of ``objs`` - instances of
+        one model - at once, returning a dict mapping each object's pk to
+        its list of related instances.
+
+        The number of queries grows with how many ``BULK_CHUNK_SIZE``
+        chunks the objects and their candidates take, not with how many
+        objects there are, and the uses of each candidate tag are only
+        read once however many of the objects have it.
+        """
+        objs = list(objs)
+        related = dict([(obj.pk, []) for obj in objs])
+        if not objs:
+            return related
         queryset, model = get_queryset_and_model(queryset_or_model)
-        model_table = qn(model._meta.db_table)
-        content_type = ContentType.objects.get_for_model(obj)
-        related_content_type = ContentType.objects.get_for_model(model)
-        query = """
-        SELECT %(model_pk)s, COUNT(related_tagged_item.object_id) AS %(count)s
-        FROM %(model)s, %(tagged_item)s, %(tag)s, %(tagged_item)s related_tagged_item
-        WHERE %(tagged_item)s.object_id = %%s
-          AND %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tag)s.id = %(tagged_item)s.tag_id
-          AND related_tagged_item.content_type_id = %(related_content_type_id)s
-          AND related_tagged_item.tag_id = %(tagged_item)s.tag_id
-          AND %(model_pk)s = related_tagged_item.object_id"""
-        if content_type.pk == related_content_type.pk:
-            # Exclude the given instance itself if determining related
-            # instances for the same model.
-            query += """
-          AND related_tagged_item.object_id != %(tagged_item)s.object_id"""
-        query += """
-        GROUP BY %(model_pk)s
-        ORDER BY %(count)s DESC
-        %(limit_offset)s"""
-        query = query % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'count': qn('count'),
-            'model': model_table,
-            'tagged_item': qn(self.model._meta.db_table),
-            'tag': qn(self.model._meta.get_field('tag').rel.to._meta.db_table),
-            'content_type_id': content_type.pk,
-            'related_content_type_id': related_content_type.pk,
-            # Hardcoding this for now just to get tests working again - this
-            # should now be handled by the query object.
-            'limit_offset': num is not None and 'LIMIT %s' or '',
-        }
+        if max_candidates is None:
+            max_candidates = settings.RELATED_MAX_CANDIDATES
+        content_type_id = model_infos.get(objs[0]).content_type_id
+        related_content_type_id = model_infos.get(model).content_type_id
+        # Exclude each instance itself if determining related instances
+        # for the same model.
+        same_model = content_type_id == related_content_type_id
 
         cursor = connection.cursor()
-        params = [obj.pk]
-        if num is not None:
-            params.append(num)
-        cursor.execute(query, params)
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            # Use in_bulk here instead of an id__in lookup, because id__in would
-            # clobber the ordering.
-            object_dict = queryset.in_bulk(object_ids)
-            return [object_dict[object_id] for object_id in object_ids \
-                    if object_id in object_dict]
-        else:
-            return []
+        weights = {}
+        tags_by_object = {}
+        for chunk in _chunks(related.keys()):
+            cursor.execute(statements.get(('related_tags', len(chunk)), self._related_tags_sql, len(chunk)),
+                           [related_content_type_id, related_content_type_id, content_type_id] + chunk)
+            for object_id, tag_id, document_frequency, total in cursor.fetchall():
+                # until rebuild_tag_counts has been run, there may be no count of the tagged instances
+                total = max(total, document_frequency)
+                if same_model:
+                    document_frequency -= 1
+                    total -= 1
+                if document_frequency <= 0 or (max_df is not None and document_frequency > max_df * total):
+                    continue
+                weights[tag_id] = math.log(1 + float(total) / document_frequency)
+                tags_by_object.setdefault(object_id, []).append((document_frequency, tag_id))
+
+        # Gather each object's candidates from its rarest tags, until
+        # reading the next one's uses would take it over max_candidates
+        candidate_tag_ids = {}
+        other_tag_ids = {}
+        capped_tag_ids = set()
+        for object_id, document_frequencies in tags_by_object.items():
+            document_frequencies.sort()
+            gathered = 0
+            for i, (document_frequency, tag_id) in enumerate(document_frequencies):
+                if i and gathered + document_frequency > max_candidates:
+                    break
+                gathered += document_frequency
+            else:
+                i = len(document_frequencies)
+            candidate_tag_ids[object_id] = [tag_id for document_frequency, tag_id in document_frequencies[:i]]
+            other_tag_ids[object_id] = set([tag_id for document_frequency, tag_id in document_frequencies[i:]])
+            if gathered > max_candidates:
+                # its rarest tag alone is used too often, so only the uses
+                # on the instances with the lowest ids are read
+                capped_tag_ids.add(document_frequencies[0][1])
+
+        tagged_items = self.filter(content_type__pk=related_content_type_id).order_by()
+        uses = {}
+        uncapped_tag_ids = set([tag_id for tag_ids in candidate_tag_ids.values() for tag_id in tag_ids])
+        for chunk in _chunks(list(uncapped_tag_ids - capped_tag_ids)):
+            for object_id, tag_id in tagged_items.filter(tag__in=chunk).values_list('object_id', 'tag'):
+                uses.setdefault(tag_id, []).append(object_id)
+        for tag_id in capped_tag_ids:
+            # one more, in case it's one of the objects themselves
+            uses[tag_id] = list(tagged_items.filter(tag__pk=tag_id).order_by('object_id').values_list(
+                'object_id', flat=True)[:max_candidates + 1])
+
+        scores = {}
+        for object_id, tag_ids in candidate_tag_ids.items():
+            object_scores = scores[object_id] = {}
+            for tag_id in tag_ids:
+                candidate_ids = [candidate_id for candidate_id in uses.get(tag_id, [])
+                                 if not (same_model and candidate_id == object_id)][:max_candidates]
+                for candidate_id in candidate_ids:
+                    object_scores[candidate_id] = object_scores.get(candidate_id, 0) + weights[tag_id]
+
+        # Score the candidates on the objects' other tags too
+        all_other_tag_ids = list(set([tag_id for tag_ids in other_tag_ids.values() for tag_id in tag_ids]))
+        if all_other_tag_ids:
+            other_uses = {}
+            all_candidate_ids = list(set([candidate_id for object_scores in scores.values()
+                                          for candidate_id in object_scores]))
+            for tag_chunk in _chunks(all_other_tag_ids):
+                for chunk in _chunks(all_candidate_ids):
+                    for candidate_id, tag_id in tagged_items.filter(tag__in=tag_chunk,
+                            object_id__in=chunk).values_list('object_id', 'tag'):
+                        other_uses.setdefault(candidate_id, []).append(tag_id)
+            for object_id, object_scores in scores.items():
+                for candidate_id in object_scores:
+                    for tag_id in other_uses.get(candidate_id, []):
+                        if tag_id in other_tag_ids[object_id]:
+                            object_scores[candidate_id] += weights[tag_id]
 
+        # Fetch the best-scoring candidates which are in the queryset, a
+        # page per object at a time - in_bulk rather than an id__in lookup,
+        # because id__in would clobber the ordering.
+        ranked = {}
+        for object_id, object_scores in scores.items():
+            ranked[object_id] = sorted(object_scores,
+                key=lambda candidate_id: (-object_scores[candidate_id], candidate_id))
+        page_size = num and min(num, BULK_CHUNK_SIZE) or BULK_CHUNK_SIZE
+        while ranked:
+            pages = {}
+            for object_id, candidate_ids in ranked.items():
+                pages[object_id], ranked[object_id] = candidate_ids[:page_size], candidate_ids[page_size:]
+            instances = {}
+            for chunk in _chunks(list(set([candidate_id for page in pages.values() for candidate_id in page]))):
+                instances.update(queryset.in_bulk(chunk))
+            for object_id, page in pages.items():
+                for candidate_id in page:
+                    if candidate_id in instances:
+                        # a copy each, as an instance can score differently for each object
+                        instance = copy.copy(instances[candidate_id])
+                        instance.score = scores[object_id][candidate_id]
+                        related[object_id].append(instance)
+                if num is not None and len(related[object_id]) >= num:
+                    related[object_id] = related[object_id][:num]
+                    del ranked[object_id]
+                elif not ranked[object_id]:
+                    del ranked[object_id]
+        return related
+
+    def _related_tags_sql(self, object_count):
+        return """
+        SELECT %(tagged_item)s.object_id, %(tagged_item)s.tag_id, COALESCE(%(usage)s.%(count)s, 0),
+            COALESCE((SELECT %(count)s FROM %(counts)s WHERE content_type_id = %%s), 0)
+        FROM %(tagged_item)s
+            LEFT OUTER JOIN %(usage)s
+                ON %(usage)s.tag_id = %(tagged_item)s.tag_id
+                AND %(usage)s.content_type_id = %%s
+                AND %(usage)s.subset = ''
+        WHERE %(tagged_item)s.content_type_id = %%s
+          AND %(tagged_item)s.object_id IN (%(object_id_placeholders)s)""" % {
+            'tagged_item': model_infos.get(self.model).table,
+            'usage': model_infos.get(TagUsage).table,
+            'counts': model_infos.get(TaggedObjectCount).table,
+            'count': qn('count'),
+            'object_id_placeholders': ','.join(['%s'] * object_count),
+        }
 ##########
 # Models #
 ##########
@@ -488,3 +1265,137 @@ class TaggedItem(models.Model):
 
     def __unicode__(self):
         return u'%s [%s]' % (self.object, self.tag)
+
+class TagUsage(models.Model):
+    """
+    How many objects of a content type have a tag - counting all of them
+    for a blank ``subset``, or those in the named usage subset (see
+    ``register_usage_subset``).
+
+    Kept up to date by ``TagManager.update_tags``, ``update_tags_bulk``
+    and ``add_tag`` - the ``rebuild_tag_counts`` management command
+    recounts everything, eg after ``TaggedItem`` rows have been changed
+    by other means.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='usage')
+    subset       = models.CharField(_('subset'), max_length=50, blank=True, default='')
+    count        = models.PositiveIntegerField(_('count'), default=0)
+
+    objects = TagUsageManager()
+
+    class Meta:
+        unique_together = (('content_type', 'tag', 'subset'),)
+        verbose_name = _('tag usage')
+        verbose_name_plural = _('tag usage')
+
+    def __unicode__(self):
+        return u'%s [%s]' % (self.tag, self.count)
+
+class TagCooccurrence(models.Model):
+    """
+    How many objects of a content type have both of a pair of tags.
+    Each pair is held both ways round, so a tag's related tags can be
+    read straight off the rows for it.
+
+    Kept up to date by ``TagManager.update_tags``, ``update_tags_bulk``
+    and ``add_tag`` - the ``rebuild_tag_counts`` management command
+    recounts everything, eg after ``TaggedItem`` rows have been changed
+    by other means.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='cooccurrences')
+    related_tag  = models.ForeignKey(Tag, verbose_name=_('related tag'), related_name='+')
+    count        = models.PositiveIntegerField(_('count'), default=0)
+
+    objects = TagCooccurrenceManager()
+
+    class Meta:
+        unique_together = (('content_type', 'tag', 'related_tag'),)
+        verbose_name = _('tag co-occurrence')
+        verbose_name_plural = _('tag co-occurrences')
+
+    def __unicode__(self):
+        return u'%s + %s [%s]' % (self.tag, self.related_tag, self.count)
+
+class TaggedObjectCount(models.Model):
+    """
+    How many objects of a content type have any tags at all - the ``N``
+    that ``TaggedItem.objects.get_related`` weighs tags by.
+
+    Kept up to date by ``TagManager.update_tags``, ``update_tags_bulk``
+    and ``add_tag`` - the ``rebuild_tag_counts`` management command
+    recounts everything, eg after ``TaggedItem`` rows have been changed
+    by other means.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'), unique=True)
+    count        = models.PositiveIntegerField(_('count'), default=0)
+
+    objects = TaggedObjectCountManager()
+
+    class Meta:
+        verbose_name = _('tagged object count')
+        verbose_name_plural = _('tagged object counts')
+
+    def __unicode__(self):
+        return u'%s [%s]' % (self.content_type, self.count)
+
+def delete_tags_of_deleted_object(sender, instance, **kwargs):
+    """
+    Untags an object which is being deleted, so it's no longer counted
+    in the tag usage and co-occurrence tables. Connected for models with
+    a ``TagField`` or registered with ``tagging.register``.
+    """
+    Tag.objects.update_tags(instance, None)
+
+def remember_usage_subsets(sender, instance, **kwargs):
+    """
+    Notes which usage subsets an object is in, and its tags, before it's
+    saved.
+    """
+    if instance.pk is None:
+        instance._usage_subsets_before = ([], [])
+        return
+    subsets = [name for name, object_ids in _usage_subset_members(sender, [instance.pk]).items() if object_ids]
+    tag_ids = TaggedItem._default_manager.filter(content_type__pk=model_infos.get(sender).content_type_id,
+        object_id=instance.pk).values_list('tag', flat=True)
+    instance._usage_subsets_before = (subsets, list(tag_ids))
+
+def count_usage_subset_changes(sender, instance, **kwargs):
+    """
+    Moves the tags an object had before it was saved between the usage
+    subsets it has joined or left. Any tags changed by the save itself
+    are counted in the subsets the object is in afterwards.
+    """
+    subsets_before, tag_ids = instance.__dict__.pop('_usage_subsets_before', ([], []))
+    subsets = [name for name, object_ids in _usage_subset_members(sender, [instance.pk]).items() if object_ids]
+    content_type_id = model_infos.get(sender).content_type_id
+    deltas = {}
+    for names, delta in (([n for n in subsets if n not in subsets_before], 1),
+                         ([n for n in subsets_before if n not in subsets], -1)):
+        for name in names:
+            for tag_id in tag_ids:
+                deltas[(content_type_id, tag_id, name)] = delta
+    if deltas:
+        TagUsage.objects.update_counts(deltas)
+        tag_generation.bump()
+
+def forget_model_infos(sender, **kwargs):
+    """
+    Content types have changed, so the ``ModelInfo`` cache may be stale.
+    """
+    model_infos.clear()
+
+models.signals.post_save.connect(forget_model_infos, sender=ContentType)
+models.signals.post_delete.connect(forget_model_infos, sender=ContentType)
+
+def forget_tag_ids(sender, instance, **kwargs):
+    """
+    A tag has been renamed or deleted, so its id is no longer cached
+    under its old name, and anything cached with it is out of date.
+    """
+    tag_ids.discard_values(instance.pk)
+    tag_generation.bump()
+
+models.signals.post_save.connect(forget_tag_ids, sender=Tag)
+models.signals.post_delete.connect(forget_tag_ids, sender=Tag)
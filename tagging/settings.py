@@ -11,3 +11,16 @@ MAX_TAG_LENGTH = getattr(settings, 'MAX_TAG_LENGTH', 50)
 # Whether to force all tags to lowercase before they are saved to the
 # database.
 FORCE_LOWERCASE_TAGS = getattr(settings, 'FORCE_LOWERCASE_TAGS', False)
+
+# The most objects ``TaggedItemManager.get_related`` will consider when
+# looking for an object's nearest neighbours - see its docstring.
+RELATED_MAX_CANDIDATES = getattr(settings, 'RELATED_MAX_CANDIDATES', 1000)
+
+# How many distinct tag strings to keep parsed tag names for.
+PARSED_TAGS_CACHE_SIZE = getattr(settings, 'PARSED_TAGS_CACHE_SIZE', 1000)
+
+# How many tag names to keep the ids of, and for how many seconds -
+# changes to tags made in other processes are picked up at the latest
+# once an entry expires.
+TAG_IDS_CACHE_SIZE = getattr(settings, 'TAG_IDS_CACHE_SIZE', 1000)
+TAG_IDS_CACHE_TIMEOUT = getattr(settings, 'TAG_IDS_CACHE_TIMEOUT', 300)
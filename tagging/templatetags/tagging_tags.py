@@ -1,37 +1,77 @@
+from django.core.cache import cache
 from django.db.models import get_model
+from django.db.models.loading import app_cache_ready
 from django.template import Library, Node, TemplateSyntaxError, Variable, resolve_variable
+from django.utils.hashcompat import md5_constructor
 from django.utils.translation import ugettext as _
 
-from tagging.models import Tag, TaggedItem
+from tagging.models import Tag, TaggedItem, tag_generation, usage_subsets
 from tagging.utils import LINEAR, LOGARITHMIC
 
 register = Library()
 
+class ModelReference(object):
+    """
+    A model given to a template tag in ``[appname].[modelname]`` format,
+    looked up once when the tag is compiled - or when it's first
+    rendered, if the models haven't all been loaded by then.
+    """
+    def __init__(self, name, invalid_message):
+        self.name = name
+        self.invalid_message = invalid_message
+        self.model = None
+        if app_cache_ready():
+            self.resolve()
+
+    def resolve(self):
+        if self.model is None:
+            bits = self.name.split('.')
+            if len(bits) == 2:
+                self.model = get_model(*bits)
+            if self.model is None:
+                raise TemplateSyntaxError(self.invalid_message % self.name)
+        return self.model
+
 class TagsForModelNode(Node):
     def __init__(self, model, context_var, counts):
-        self.model = model
+        self.model = ModelReference(model, _('tags_for_model tag was given an invalid model: %s'))
         self.context_var = context_var
         self.counts = counts
 
     def render(self, context):
-        model = get_model(*self.model.split('.'))
-        if model is None:
-            raise TemplateSyntaxError(_('tags_for_model tag was given an invalid model: %s') % self.model)
-        context[self.context_var] = Tag.objects.usage_for_model(model, counts=self.counts)
+        context[self.context_var] = Tag.objects.usage_for_model(self.model.resolve(), counts=self.counts)
         return ''
 
 class TagCloudForModelNode(Node):
     def __init__(self, model, context_var, **kwargs):
-        self.model = model
+        self.model = ModelReference(model, _('tag_cloud_for_model tag was given an invalid model: %s'))
         self.context_var = context_var
         self.kwargs = kwargs
 
     def render(self, context):
-        model = get_model(*self.model.split('.'))
-        if model is None:
-            raise TemplateSyntaxError(_('tag_cloud_for_model tag was given an invalid model: %s') % self.model)
-        context[self.context_var] = \
-            Tag.objects.cloud_for_model(model, **self.kwargs)
+        model = self.model.resolve()
+        kwargs = dict(self.kwargs)
+        timeout = kwargs.pop('cache', None)
+        subset = kwargs.pop('subset', None)
+        if subset is not None:
+            try:
+                kwargs['filters'] = usage_subsets[model][subset]
+            except KeyError:
+                raise TemplateSyntaxError(_('tag_cloud_for_model tag was given an invalid usage subset: %s') % subset)
+        if timeout is None:
+            cloud = Tag.objects.cloud_for_model(model, **kwargs)
+        else:
+            # Cached under the current tag generation, which every change
+            # to tags replaces
+            options = [(name, isinstance(value, dict) and sorted(value.items()) or value)
+                       for name, value in sorted(kwargs.items())]
+            key = 'tagging:cloud:%s' % md5_constructor(
+                repr((tag_generation.get(), self.model.name, options))).hexdigest()
+            cloud = cache.get(key)
+            if cloud is None:
+                cloud = Tag.objects.cloud_for_model(model, **kwargs)
+                cache.set(key, cloud, timeout)
+        context[self.context_var] = cloud
         return ''
 
 class TagsForObjectNode(Node):
@@ -48,14 +88,11 @@ class TaggedObjectsNode(Node):
     def __init__(self, tag, model, context_var):
         self.tag = Variable(tag)
         self.context_var = context_var
-        self.model = model
+        self.model = ModelReference(model, _('tagged_objects tag was given an invalid model: %s'))
 
     def render(self, context):
-        model = get_model(*self.model.split('.'))
-        if model is None:
-            raise TemplateSyntaxError(_('tagged_objects tag was given an invalid model: %s') % self.model)
         context[self.context_var] = \
-            TaggedItem.objects.get_by_model(model, self.tag.resolve(context))
+            TaggedItem.objects.get_by_model(self.model.resolve(), self.tag.resolve(context))
         return ''
 
 def do_tags_for_model(parser, token):
@@ -129,16 +166,27 @@ def do_tag_cloud_for_model(parser, token):
           One of ``linear`` or ``log``. Defines the font-size
           distribution algorithm to use when generating the tag cloud.
 
+       ``subset``
+          The name of one of the model's usage subsets (see
+          ``tagging.models.register_usage_subset``). Limits the cloud
+          to the instances in that subset.
+
+       ``cache``
+          Integer. Caches the cloud for up to that many seconds, or
+          until tags are next changed.
+
     Examples::
 
        {% tag_cloud_for_model products.Widget as widget_tags %}
        {% tag_cloud_for_model products.Widget as widget_tags with steps=9 min_count=3 distribution=log %}
+       {% tag_cloud_for_model products.Widget as widget_tags with subset=published %}
+       {% tag_cloud_for_model products.Widget as widget_tags with steps=6 cache=600 %}
 
     """
     bits = token.contents.split()
     len_bits = len(bits)
-    if len_bits != 4 and len_bits not in range(6, 9):
-        raise TemplateSyntaxError(_('%s tag requires either three or between five and seven arguments') % bits[0])
+    if len_bits != 4 and len_bits not in range(6, 11):
+        raise TemplateSyntaxError(_('%s tag requires either three or between five and nine arguments') % bits[0])
     if bits[2] != 'as':
         raise TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
     kwargs = {}
@@ -148,7 +196,7 @@ def do_tag_cloud_for_model(parser, token):
         for i in range(5, len_bits):
             try:
                 name, value = bits[i].split('=')
-                if name == 'steps' or name == 'min_count':
+                if name == 'steps' or name == 'min_count' or name == 'cache':
                     try:
                         kwargs[str(name)] = int(value)
                     except ValueError:
@@ -166,6 +214,8 @@ def do_tag_cloud_for_model(parser, token):
                             'option': name,
                             'value': value,
                         })
+                elif name == 'subset':
+                    kwargs[str(name)] = value
                 else:
                     raise TemplateSyntaxError(_("%(tag)s tag was given an invalid option: '%(option)s'") % {
                         'tag': bits[0],
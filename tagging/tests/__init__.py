@@ -0,0 +1,13 @@
+from django.test import TransactionTestCase
+
+from tagging.utils import tag_ids
+
+class TagCacheTestCase(TransactionTestCase):
+    """
+    For tests of the tag id cache, which is only filled outside of
+    uncommitted transactions. Forgets the ids of tags deleted by the
+    flush before each test, which sends no signals.
+    """
+    def _pre_setup(self):
+        super(TagCacheTestCase, self)._pre_setup()
+        tag_ids.clear()
@@ -0,0 +1,224 @@
+"""
+Rough timings of the tagging app's busier code paths, for checking
+optimisations against. These aren't part of the test suite - run them
+against a throwaway test database with a settings module that has
+``tagging.tests`` in ``INSTALLED_APPS``, eg::
+
+    DJANGO_SETTINGS_MODULE=tagging.tests.settings python -m tagging.tests.benchmarks [name ...]
+"""
+import sys
+import time
+import timeit
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """
+    Registers a benchmark to run from the command line.
+    """
+    BENCHMARKS.append(func)
+    return func
+
+def timed(func, *args, **kwargs):
+    """
+    Returns how many seconds calling ``func`` took, and its result.
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def best_of(func, *args, **kwargs):
+    """
+    Returns the fewest seconds calling ``func`` took over ``repeat``
+    runs (default 5) - for code which can be run again and again, as
+    the quickest run is the one least disturbed by everything else.
+    """
+    repeat = kwargs.pop('repeat', 5)
+    return min(timeit.Timer(lambda: func(*args, **kwargs)).repeat(repeat, 1))
+
+def report(label, seconds, count=None):
+    if count:
+        print '    %-40s %8.3fs  %8.1fus each' % (label, seconds, seconds * 1000000 / count)
+    else:
+        print '    %-40s %8.3fs' % (label, seconds)
+
+@benchmark
+def update_tags_bulk(objects=2000, tags_per_object=5, vocabulary=500):
+    """
+    Tagging a batch of new objects one at a time with ``update_tags``,
+    against all at once with ``update_tags_bulk``, then retagging them.
+    """
+    from django.db import transaction
+    from tagging.models import Tag, TaggedItem
+    from tagging.tests.models import Parrot, Link
+
+    def tag_string(i, offset=0):
+        return ' '.join(['tag%s' % ((i * 7 + j + offset) % vocabulary)
+                         for j in range(tags_per_object)])
+
+    def create(model, field):
+        objs = [model.objects.create(**{field: 'benchmark %s' % i}) for i in range(objects)]
+        transaction.commit_unless_managed()
+        return objs
+
+    def reset():
+        TaggedItem.objects.all().delete()
+        Tag.objects.all().delete()
+
+    def one_at_a_time(objs, offset=0):
+        for i, obj in enumerate(objs):
+            Tag.objects.update_tags(obj, tag_string(i, offset))
+
+    def all_at_once(objs, offset=0):
+        return Tag.objects.update_tags_bulk([(obj, tag_string(i, offset)) for i, obj in enumerate(objs)])
+
+    parrots, links = create(Parrot, 'state'), create(Link, 'name')
+    print '  %s objects, %s tags each, %s distinct tags' % (objects, tags_per_object, vocabulary)
+    reset()
+    report('update_tags, new tags', timed(one_at_a_time, parrots)[0], objects)
+    report('update_tags, retagging', timed(one_at_a_time, parrots, 3)[0], objects)
+    reset()
+    seconds, (inserted, removed) = timed(all_at_once, links)
+    report('update_tags_bulk, new tags', seconds, objects)
+    seconds, (inserted, removed) = timed(all_at_once, links, 3)
+    report('update_tags_bulk, retagging', seconds, objects)
+    print '    (retagging inserted %s and removed %s tagged items)' % (inserted, removed)
+
+@benchmark
+def resolve_model(calls=100000):
+    """
+    Per-call cost of resolving a model's content type id and quoted table
+    and primary key names, by looking each up as the tagging queries used
+    to and from the shared ``ModelInfo`` cache.
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection
+    from tagging.models import model_infos
+    from tagging.tests.models import Parrot
+
+    qn = connection.ops.quote_name
+    parrot = Parrot.objects.create(state='resolved')
+
+    def looked_up():
+        for i in xrange(calls):
+            content_type_id = ContentType.objects.get_for_model(parrot).pk
+            model_table = qn(Parrot._meta.db_table)
+            model_pk = '%s.%s' % (model_table, qn(Parrot._meta.pk.column))
+
+    def cached():
+        for i in xrange(calls):
+            info = model_infos.get(parrot)
+            content_type_id, model_table, model_pk = info.content_type_id, info.table, info.pk
+
+    report('get_for_model and qn()', best_of(looked_up), calls)
+    report('model_infos.get()', best_of(cached), calls)
+
+@benchmark
+def parse_tag_input(calls=2000, words=200):
+    """
+    Parsing long tag strings full of quoted multiple word tags and
+    commas, with ``parse_tag_input`` and the character-at-a-time parser
+    it replaced.
+    """
+    from tagging.tests.tests import character_parse_tag_input
+    from tagging.utils import parse_tag_input
+
+    inputs = {
+        'spaces': u' '.join([u'tag%s' % i for i in range(words)]),
+        'quoted': u' '.join([u'"multiple word tag %s"' % i for i in range(words)]),
+        'quoted, commas': u', '.join([u'"tag, with comma %s", loose %s' % (i, i) for i in range(words)]),
+        'unclosed quote': u'"' + u' '.join([u'tag%s,' % i for i in range(words)]),
+    }
+
+    def parse_all(parse, input):
+        for i in xrange(calls):
+            parse(input)
+
+    print '  %s calls, %s words' % (calls, words)
+    for name, input in sorted(inputs.items()):
+        report('character parser, %s' % name, best_of(parse_all, character_parse_tag_input, input), calls)
+        report('parse_tag_input, %s' % name, best_of(parse_all, parse_tag_input, input), calls)
+
+@benchmark
+def calculate_cloud(sizes=(5000, 20000), steps=6):
+    """
+    Sizing tag clouds of thousands of tags with ``calculate_cloud`` -
+    with and without NumPy, if it's installed - and with the version
+    which checked every threshold for every tag.
+    """
+    import random
+    from tagging.models import Tag
+    from tagging.tests.tests import threshold_scan_calculate_cloud
+    from tagging import utils
+
+    rng = random.Random(0)
+    print '  %s steps%s' % (steps, utils.numpy is None and ', without NumPy' or ', with NumPy')
+    for size in sizes:
+        tags = [Tag(name='tag%s' % i) for i in range(size)]
+        for tag in tags:
+            tag.count = int(rng.paretovariate(1.2))
+        for distribution, name in ((utils.LOGARITHMIC, 'log'), (utils.LINEAR, 'linear')):
+            report('threshold scan, %s tags, %s' % (size, name),
+                   best_of(threshold_scan_calculate_cloud, tags, steps, distribution, repeat=20), size)
+            report('calculate_cloud, %s tags, %s' % (size, name),
+                   best_of(utils.calculate_cloud, tags, steps, distribution, repeat=20), size)
+            if utils.numpy is not None:
+                numpy, utils.numpy = utils.numpy, None
+                try:
+                    report('  without NumPy', best_of(utils.calculate_cloud, tags, steps, distribution,
+                                                      repeat=20), size)
+                finally:
+                    utils.numpy = numpy
+
+@benchmark
+def template_tags(renders=2000, objects=50):
+    """
+    Rendering each of the tagging template tags from a compiled template,
+    against the cost of looking up their model by name on every render
+    as they used to.
+    """
+    from django.db.models import get_model
+    from django.template import Context, Template
+    from tagging.models import Tag
+    from tagging.tests.models import FormTest
+
+    for i in range(objects):
+        FormTest.objects.create(tags='tag%s tag%s common' % (i % 10, i % 7))
+    obj = FormTest.objects.all()[0]
+    tag = Tag.objects.get(name='common')
+    templates = [
+        ('tags_for_model', '{% tags_for_model tests.FormTest as tags with counts %}'),
+        ('tag_cloud_for_model', '{% tag_cloud_for_model tests.FormTest as tags %}'),
+        ('tag_cloud_for_model, cached', '{% tag_cloud_for_model tests.FormTest as tags with cache=60 %}'),
+        ('tags_for_object', '{% tags_for_object obj as tags %}'),
+        ('tagged_objects', '{% tagged_objects tag in tests.FormTest as objects %}'),
+    ]
+
+    def render(template):
+        context = Context({'obj': obj, 'tag': tag})
+        for i in xrange(renders):
+            template.render(context)
+
+    def looked_up():
+        for i in xrange(renders):
+            get_model(*'tests.FormTest'.split('.'))
+
+    print '  %s renders, %s tagged objects' % (renders, objects)
+    for name, source in templates:
+        report(name, best_of(render, Template('{% load tagging_tags %}' + source)), renders)
+    report('get_model() per render, as before', best_of(looked_up), renders)
+
+def main(names):
+    from django.db import connection
+    selected = [func for func in BENCHMARKS if not names or func.__name__ in names]
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        for func in selected:
+            print '%s: %s' % (func.__name__, ' '.join(func.__doc__.split()))
+            func()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
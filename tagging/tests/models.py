@@ -1,11 +1,14 @@
 from django.db import models
 
 from tagging.fields import TagField
+from tagging.models import register_usage_subset
 
 class Perch(models.Model):
     size = models.IntegerField()
     smelly = models.BooleanField(default=True)
 
+register_usage_subset(Perch, 'smelly', smelly=True)
+
 class Parrot(models.Model):
     state = models.CharField(max_length=50)
     perch = models.ForeignKey(Perch, null=True)
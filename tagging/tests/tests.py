@@ -1,15 +1,120 @@
 # -*- coding: utf-8 -*-
 
+import math
 import os
+import random
+import threading
 from django import forms
+from django.conf import settings as django_settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.db.models import Q
-from django.test import TestCase
+from django.template import Context, Template, TemplateSyntaxError
+from django.test import TestCase, TransactionTestCase
+from django.utils.encoding import force_unicode
 from tagging.forms import TagField
 from tagging import settings
-from tagging.models import Tag, TaggedItem
+from tagging.generic import prefetch_tags
+from tagging.managers import TagDescriptor
+from tagging.templatetags import tagging_tags
+from tagging.models import Tag, TagCooccurrence, TaggedItem, TaggedObjectCount, TagUsage, model_infos, statements
+from tagging.models import tag_generation
+from tagging.tests import TagCacheTestCase
 from tagging.tests.models import Article, Link, Perch, Parrot, FormTest
-from tagging.utils import calculate_cloud, edit_string_for_tags, get_tag_list, get_tag, parse_tag_input
-from tagging.utils import LINEAR
+from tagging.utils import calculate_cloud, edit_string_for_tags, get_tag_list, get_tag, parse_tag_input, split_strip
+from tagging.utils import parsed_tags, tag_ids, LRUCache
+from tagging.utils import LINEAR, LOGARITHMIC
+from tagging import utils
+
+def threshold_scan_calculate_cloud(tags, steps=4, distribution=LOGARITHMIC):
+    """
+    The ``calculate_cloud`` which checked every threshold for every tag,
+    kept to check that the current one sizes tags identically.
+    """
+    if len(tags) > 0:
+        counts = [tag.count for tag in tags]
+        min_weight = float(min(counts))
+        max_weight = float(max(counts))
+        thresholds = utils._calculate_thresholds(min_weight, max_weight, steps)
+        for tag in tags:
+            font_set = False
+            tag_weight = utils._calculate_tag_weight(tag.count, max_weight, distribution)
+            for i in range(steps):
+                if not font_set and tag_weight <= thresholds[i]:
+                    tag.font_size = i + 1
+                    font_set = True
+    return tags
+
+
+def count_queries(func, *args, **kwargs):
+    """ Returns the result of calling ``func`` and how many queries it ran. """
+    old_debug, django_settings.DEBUG = django_settings.DEBUG, True
+    try:
+        connection.queries = []
+        result = func(*args, **kwargs)
+        return result, len(connection.queries)
+    finally:
+        django_settings.DEBUG = old_debug
+
+def character_parse_tag_input(input):
+    """
+    The character-at-a-time ``parse_tag_input`` which the current one
+    replaced, kept to check that they agree.
+    """
+    if not input:
+        return []
+
+    input = force_unicode(input)
+
+    if u',' not in input and u'"' not in input:
+        words = list(set(split_strip(input, u' ')))
+        words.sort()
+        return words
+
+    words = []
+    buffer = []
+    to_be_split = []
+    saw_loose_comma = False
+    open_quote = False
+    i = iter(input)
+    try:
+        while 1:
+            c = i.next()
+            if c == u'"':
+                if buffer:
+                    to_be_split.append(u''.join(buffer))
+                    buffer = []
+                open_quote = True
+                c = i.next()
+                while c != u'"':
+                    buffer.append(c)
+                    c = i.next()
+                if buffer:
+                    word = u''.join(buffer).strip()
+                    if word:
+                        words.append(word)
+                    buffer = []
+                open_quote = False
+            else:
+                if not saw_loose_comma and c == u',':
+                    saw_loose_comma = True
+                buffer.append(c)
+    except StopIteration:
+        if buffer:
+            if open_quote and u',' in buffer:
+                saw_loose_comma = True
+            to_be_split.append(u''.join(buffer))
+    if to_be_split:
+        if saw_loose_comma:
+            delimiter = u','
+        else:
+            delimiter = u' '
+        for chunk in to_be_split:
+            words.extend(split_strip(chunk, delimiter))
+    words = list(set(words))
+    words.sort()
+    return words
 
 #############
 # Utilities #
@@ -74,6 +179,104 @@ class TestParseTagInput(TestCase):
         self.assertEquals(parse_tag_input('a-one "a-two" and "a-three'),
             [u'a-one', u'a-three', u'a-two', u'and'])
         
+    def test_matches_character_parser(self):
+        """ Random input parses as it did one character at a time. """
+        rng = random.Random(4321)
+        alphabet = [u'a', u'b', u'\xe9', u' ', u' ', u'\t', u',', u'"', u'"']
+        for i in range(5000):
+            input = u''.join([rng.choice(alphabet) for j in range(rng.randint(0, 24))])
+            self.assertEquals(parse_tag_input(input), character_parse_tag_input(input), repr(input))
+
+class TestLRUCache(TestCase):
+    def test_least_recently_used_entry_is_dropped(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEquals(len(cache), 2)
+
+    def test_entries_expire(self):
+        cache = LRUCache(2, timeout=10)
+        now = [1000]
+        cache.clock = lambda: now[0]
+        cache.set('a', 1)
+        now[0] += 9
+        self.assertEquals(cache.get('a'), 1)
+        now[0] += 1
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+
+    def test_discard_values(self):
+        cache = LRUCache(3)
+        cache.set('a', 1)
+        cache.set('A', 1)
+        cache.set('b', 2)
+        cache.discard_values(1)
+        self.assertEquals((cache.get('a'), cache.get('A'), cache.get('b')), (None, None, 2))
+
+    def test_shared_between_threads(self):
+        cache = LRUCache(50)
+        errors = []
+        def work(offset):
+            try:
+                for i in range(2000):
+                    key = (i * 7 + offset) % 80
+                    cache.set(key, key)
+                    value = cache.get(key)
+                    if value is not None and value != key:
+                        errors.append((key, value))
+                    if not i % 100:
+                        cache.discard_values(offset)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.failUnless(len(cache) <= 50)
+        self.assertEquals(len(cache._entries), len([key for key in range(80) if cache.get(key) is not None]))
+
+class TestTagCaches(TagCacheTestCase):
+    def setUp(self):
+        self.cheese = Tag.objects.create(name='cheese')
+        self.toast = Tag.objects.create(name='toast')
+
+    def test_parsed_tags_are_copies(self):
+        parsed_tags.clear()
+        parse_tag_input('cheese "on toast"').append(u'jam')
+        self.assertEquals(parse_tag_input('cheese "on toast"'), [u'cheese', u'on toast'])
+        self.assertEquals(len(parsed_tags), 1)
+
+    def test_tag_ids_are_cached(self):
+        tags, queries = count_queries(get_tag_list, 'cheese toast')
+        self.assertEquals((tags, queries), ([self.cheese, self.toast], 1))
+        tags, queries = count_queries(get_tag_list, 'toast, cheese')
+        self.assertEquals((tags, queries), ([self.cheese, self.toast], 0))
+        tag, queries = count_queries(get_tag, 'cheese')
+        self.assertEquals((tag, queries), (self.cheese, 0))
+        tags, queries = count_queries(get_tag_list, 'cheese mouse')
+        self.assertEquals((tags, queries), ([self.cheese], 1))
+
+    def test_changed_tags_are_forgotten(self):
+        get_tag_list('cheese toast')
+        self.cheese.name = 'brie'
+        self.cheese.save()
+        self.assertEquals(get_tag('cheese'), None)
+        self.assertEquals(get_tag('brie'), self.cheese)
+        self.toast.delete()
+        self.assertEquals(get_tag_list('toast brie'), [self.cheese])
+
+class TestUncommittedTagIds(TestCase):
+    def test_tag_ids_are_not_cached_until_committed(self):
+        cheese = Tag.objects.create(name='cheese')
+        tags, queries = count_queries(get_tag_list, 'cheese')
+        self.assertEquals((tags, queries), ([cheese], 1))
+        self.assertEquals(tag_ids.get(u'cheese'), None)
+
 class TestNormalisedTagListInput(TestCase):
     def setUp(self):
         self.cheese = Tag.objects.create(name='cheese')
@@ -201,6 +404,27 @@ class TestCalculateCloud(TestCase):
         self.assertEquals(sizes[4], 2)
         self.assertEquals(sizes[5], 4)
     
+    def test_matches_threshold_scan(self):
+        rng = random.Random(1234)
+        clouds = [[tag.count for tag in self.tags], [1], [3, 3, 3], [1, 2]]
+        for i in range(100):
+            clouds.append([rng.choice([1, 2, 3, rng.randint(1, 10000)]) for j in range(rng.randint(1, 60))])
+        for counts in clouds:
+            for steps in range(1, 10):
+                for distribution in (LINEAR, LOGARITHMIC):
+                    sizes = []
+                    for calculate in (calculate_cloud, threshold_scan_calculate_cloud):
+                        tags = [Tag(name='tag%s' % i) for i in range(len(counts))]
+                        for tag, count in zip(tags, counts):
+                            tag.count = count
+                        sizes.append([getattr(tag, 'font_size', None) for tag in calculate(tags, steps, distribution)])
+                    self.assertEquals(sizes[0], sizes[1], (counts, steps, distribution))
+                    if utils.numpy is not None:
+                        max_weight = float(max(counts))
+                        thresholds = utils._calculate_thresholds(float(min(counts)), max_weight, steps)
+                        self.assertEquals(utils._numpy_calculate_font_sizes(counts, max_weight, thresholds, distribution),
+                                          utils._calculate_font_sizes(counts, max_weight, thresholds, distribution))
+
     def test_invalid_distribution(self):
         try:
             calculate_cloud(self.tags, steps=5, distribution='cheese')
@@ -331,6 +555,397 @@ class TestBasicTagging(TestCase):
         tags = Tag.objects.get_for_object(self.dead_parrot)
         self.assertEquals(len(tags), 0)
 
+    def test_update_tags_runs_constant_queries(self):
+        Tag.objects.create(name='one')
+        many = ' '.join(['tag%s' % i for i in range(10)])
+        result, queries = count_queries(Tag.objects.update_tags, self.dead_parrot, 'one ' + many)
+        self.assertEquals(len(Tag.objects.get_for_object(self.dead_parrot)), 11)
+        self.failUnless(queries <= 15, queries)
+
+        result, queries = count_queries(Tag.objects.update_tags, self.dead_parrot, 'one ' + many)
+        self.assertEquals(queries, 1)
+
+        result, queries = count_queries(Tag.objects.update_tags, self.dead_parrot, 'two')
+        self.assertEquals([tag.name for tag in Tag.objects.get_for_object(self.dead_parrot)], [u'two'])
+        self.failUnless(queries <= 15, queries)
+
+    def test_update_tags_when_someone_else_created_the_tag_first(self):
+        # simulate losing the race: the tag appears between the lookup and the insert
+        original = Tag.objects.filter
+        def filter_then_race(*args, **kwargs):
+            result = list(original(*args, **kwargs))
+            if kwargs.get('name__in') == [u'racy'] and not Tag.objects.all().filter(name='racy'):
+                Tag.objects.create(name='racy')
+            return original(*args, **kwargs).filter(pk__in=[t.pk for t in result])
+        Tag.objects.filter = filter_then_race
+        try:
+            Tag.objects.update_tags(self.dead_parrot, 'racy')
+        finally:
+            del Tag.objects.filter
+        self.assertEquals([tag.name for tag in Tag.objects.get_for_object(self.dead_parrot)], [u'racy'])
+        self.assertEquals(Tag.objects.filter(name='racy').count(), 1)
+
+class TestBulkTagging(TestCase):
+    def setUp(self):
+        self.parrots = [Parrot.objects.create(state='state %s' % i) for i in range(20)]
+        self.link = Link.objects.create(name='link')
+
+    def test_update_tags_bulk(self):
+        Tag.objects.update_tags(self.parrots[0], 'foo bar')
+        Tag.objects.update_tags(self.link, 'foo')
+        tag_names_by_object = dict([(parrot, 'bar baz') for parrot in self.parrots])
+        tag_names_by_object[self.link] = 'foo link'
+        inserted, removed = Tag.objects.update_tags_bulk(tag_names_by_object)
+        self.assertEquals((inserted, removed), (19 * 2 + 1 + 1, 1))
+
+        for parrot in self.parrots:
+            self.assertEquals([tag.name for tag in Tag.objects.get_for_object(parrot)], [u'bar', u'baz'])
+        self.assertEquals([tag.name for tag in Tag.objects.get_for_object(self.link)], [u'foo', u'link'])
+        self.assertEquals(Tag.objects.count(), 4)
+
+    def test_update_tags_bulk_accepts_pairs(self):
+        inserted, removed = Tag.objects.update_tags_bulk([(self.parrots[0], 'foo'), (self.parrots[1], None)])
+        self.assertEquals((inserted, removed), (1, 0))
+        self.assertEquals(Tag.objects.update_tags_bulk([(self.parrots[0], 'foo')]), (0, 0))
+        self.assertEquals(Tag.objects.update_tags_bulk([(self.parrots[0], '')]), (0, 1))
+
+    def test_update_tags_bulk_runs_constant_queries(self):
+        result, few = count_queries(Tag.objects.update_tags_bulk,
+            [(parrot, 'one two') for parrot in self.parrots[:2]])
+        result, many = count_queries(Tag.objects.update_tags_bulk,
+            [(parrot, 'two three') for parrot in self.parrots])
+        self.assertEquals(result, (2 + 18 * 2, 2))
+        # including locking the tagged items about to be deleted, and
+        # counting the newly tagged parrots
+        self.failUnless(few <= many <= 18, (few, many))
+
+    def test_update_tags_bulk_when_someone_else_added_the_tag_first(self):
+        # simulate losing the race: the tagged item appears between reading the tags and the insert
+        parrot = self.parrots[0]
+        Tag.objects.update_tags(parrot, 'foo')
+        original = Tag.objects._get_or_create_ids
+        def get_ids_then_race(tag_names):
+            tag_ids = original(tag_names)
+            Tag.objects._get_or_create_ids = original
+            Tag.objects.add_tag(parrot, 'bar')
+            return tag_ids
+        Tag.objects._get_or_create_ids = get_ids_then_race
+        try:
+            result = Tag.objects.update_tags_bulk([(parrot, 'foo bar baz')])
+        finally:
+            del Tag.objects._get_or_create_ids
+        self.assertEquals(result, (1, 0))
+        self.assertEquals([tag.name for tag in Tag.objects.get_for_object(parrot)], [u'bar', u'baz', u'foo'])
+
+        usage = sorted(TagUsage.objects.values_list('tag__name', 'subset', 'count'))
+        pairs = sorted(TagCooccurrence.objects.values_list('tag__name', 'related_tag__name', 'count'))
+        self.assertEquals(usage, [(u'bar', u'', 1), (u'baz', u'', 1), (u'foo', u'', 1)])
+        TagUsage.objects.rebuild()
+        TagCooccurrence.objects.rebuild()
+        self.assertEquals(usage, sorted(TagUsage.objects.values_list('tag__name', 'subset', 'count')))
+        self.assertEquals(pairs, sorted(TagCooccurrence.objects.values_list('tag__name', 'related_tag__name', 'count')))
+
+    def test_inserting_reports_just_the_rows_inserted(self):
+        from tagging.models import _insert_ignoring_duplicates
+        Tag.objects.create(name='dup')
+        def existing(rows):
+            return set([(name,) for name in Tag.objects.filter(name__in=[row[0] for row in rows]).values_list(
+                'name', flat=True)])
+        inserted = _insert_ignoring_duplicates('INSERT INTO %s (name) VALUES (%%s)' % Tag._meta.db_table,
+            [(u'x',), (u'dup',)], existing)
+        self.assertEquals(inserted, [(u'x',)])
+        self.assertEquals(sorted(Tag.objects.values_list('name', flat=True)), [u'dup', u'x'])
+
+    def test_update_tags_bulk_chunks_long_lists(self):
+        from tagging import models as tagging_models
+        old_chunk_size = tagging_models.BULK_CHUNK_SIZE
+        tagging_models.BULK_CHUNK_SIZE = 3
+        try:
+            result, queries = count_queries(Tag.objects.update_tags_bulk,
+                [(parrot, 'a b c d e') for parrot in self.parrots])
+            # the tagged items (checked again before inserting, without
+            # savepoints), then the usage of 5 tags in chunks of 3, their
+            # co-occurrences in pairs of chunks of 1 and the count of
+            # tagged parrots
+            checks = (not connection.features.uses_savepoints) and 7 or 0
+            self.assertEquals(queries, (7 + 2 + 1 + 2 + 1 + checks) + (2 + 2) + (5 * 5 + 2) + 3)
+            self.assertEquals(TaggedItem.objects.count(), 100)
+            self.assertEquals(Tag.objects.update_tags_bulk([(parrot, 'a') for parrot in self.parrots]), (0, 80))
+        finally:
+            tagging_models.BULK_CHUNK_SIZE = old_chunk_size
+
+class TestBulkTaggingTransactions(TransactionTestCase):
+    def test_update_tags_joins_a_managed_transaction(self):
+        parrot = Parrot.objects.create(state='rolled back')
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            Tag.objects.update_tags(parrot, 'foo bar')
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+        self.assertEquals(list(Tag.objects.get_for_object(parrot)), [])
+        self.assertEquals(TagUsage.objects.count(), 0)
+
+        # outside one, the changes are committed straight away
+        Tag.objects.update_tags(parrot, 'foo bar')
+        transaction.rollback()
+        self.assertEquals([tag.name for tag in Tag.objects.get_for_object(parrot)], [u'bar', u'foo'])
+        self.assertEquals(sorted(TagUsage.objects.values_list('tag__name', 'count')), [(u'bar', 1), (u'foo', 1)])
+
+    def test_tag_generation_is_bumped_again_after_a_managed_commit(self):
+        from tagging.middleware import TagGenerationMiddleware
+        parrot = Parrot.objects.create(state='committed later')
+        before = tag_generation.get()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            Tag.objects.update_tags(parrot, 'foo')
+            # what a concurrent render would cache its cloud under
+            during = tag_generation.get()
+            self.assertNotEquals(during, before)
+            transaction.commit()
+        finally:
+            transaction.leave_transaction_management()
+        TagGenerationMiddleware().process_response(None, None)
+        self.failIf(tag_generation.get() in (before, during))
+
+        # outside one, there's nothing left to do after the commit
+        Tag.objects.update_tags(parrot, 'bar')
+        after = tag_generation.get()
+        TagGenerationMiddleware().process_response(None, None)
+        self.assertEquals(tag_generation.get(), after)
+
+class TestTagCooccurrence(TestCase):
+    def setUp(self):
+        self.parrots = [Parrot.objects.create(state='state %s' % i) for i in range(6)]
+        self.link = Link.objects.create(name='link')
+
+    def counts(self):
+        return sorted(TagCooccurrence.objects.values_list('content_type', 'tag__name', 'related_tag__name', 'count'))
+
+    def assertCountsMatchRebuild(self):
+        counts = self.counts()
+        TagCooccurrence.objects.rebuild()
+        self.assertEquals(counts, self.counts())
+        return counts
+
+    def test_counts_follow_tag_changes(self):
+        Tag.objects.update_tags(self.parrots[0], 'a b c')
+        Tag.objects.update_tags(self.parrots[1], 'a b')
+        Tag.objects.update_tags(self.link, 'a b')
+        parrot_type = ContentType.objects.get_for_model(Parrot).pk
+        self.assertEquals([c for c in self.assertCountsMatchRebuild() if c[0] == parrot_type], [
+            (parrot_type, u'a', u'b', 2), (parrot_type, u'a', u'c', 1),
+            (parrot_type, u'b', u'a', 2), (parrot_type, u'b', u'c', 1),
+            (parrot_type, u'c', u'a', 1), (parrot_type, u'c', u'b', 1),
+        ])
+
+        Tag.objects.update_tags(self.parrots[0], 'b c d')
+        self.assertCountsMatchRebuild()
+        Tag.objects.add_tag(self.parrots[1], 'c')
+        Tag.objects.add_tag(self.parrots[1], 'c')
+        self.assertCountsMatchRebuild()
+        Tag.objects.update_tags_bulk([(parrot, ' '.join('abcdef'[i:i + 3])) for i, parrot in enumerate(self.parrots)])
+        self.assertCountsMatchRebuild()
+        Tag.objects.update_tags_bulk([(parrot, None) for parrot in self.parrots])
+        self.assertEquals(len(self.assertCountsMatchRebuild()), 2)
+
+    def test_related_for_a_single_tag_is_one_query(self):
+        for i, parrot in enumerate(self.parrots):
+            Tag.objects.update_tags(parrot, ' '.join('abcdef'[i:i + 3]))
+        c = Tag.objects.get(name='c')
+        related, queries = count_queries(Tag.objects.related_for_model, c, Parrot, counts=True)
+        self.assertEquals(queries, 1)
+        self.assertEquals([(tag.name, tag.count) for tag in related], [(u'a', 1), (u'b', 2), (u'd', 2), (u'e', 1)])
+        related = Tag.objects.related_for_model(c, Parrot, min_count=2)
+        self.assertEquals([(tag.name, tag.count) for tag in related], [(u'b', 2), (u'd', 2)])
+
+    def test_related_for_tags_with_nothing_in_common(self):
+        for i, parrot in enumerate(self.parrots):
+            Tag.objects.update_tags(parrot, ' '.join('abcdef'[i:i + 3]))
+        tags = list(Tag.objects.filter(name__in=['a', 'f']))
+        related, queries = count_queries(Tag.objects.related_for_model, tags, Parrot)
+        self.assertEquals((related, queries), ([], 1))
+
+    def test_rebuild_command(self):
+        Tag.objects.update_tags(self.parrots[0], 'a b c')
+        counts = self.counts()
+        TagCooccurrence.objects.all().delete()
+        call_command('rebuild_tag_counts', verbosity=0)
+        self.assertEquals(self.counts(), counts)
+
+class TestTagUsageCounts(TestCase):
+    def setUp(self):
+        for tags in ('a b c', 'b c', 'c', 'c d', ''):
+            FormTest.objects.create(tags=tags)
+        Tag.objects.update_tags(Parrot.objects.create(state='dead'), 'a d')
+
+    def usage(self, **kwargs):
+        return [(tag.name, getattr(tag, 'count', None)) for tag in Tag.objects.usage_for_model(FormTest, **kwargs)]
+
+    def live_usage(self, **kwargs):
+        return [(tag.name, getattr(tag, 'count', None)) for tag in Tag.objects.usage_for_queryset(FormTest.objects.all(), **kwargs)]
+
+    def test_usage_is_read_from_the_counts(self):
+        usage, queries = count_queries(self.usage, counts=True)
+        self.assertEquals(queries, 1)
+        self.assertEquals(usage, [(u'a', 1), (u'b', 2), (u'c', 4), (u'd', 1)])
+        self.assertEquals(usage, self.live_usage(counts=True))
+        self.assertEquals(self.usage(), self.live_usage())
+        self.assertEquals(self.usage(min_count=2), self.live_usage(min_count=2))
+        cloud, queries = count_queries(Tag.objects.cloud_for_model, FormTest)
+        self.assertEquals(queries, 1)
+
+    def test_counts_follow_changes(self):
+        f = FormTest.objects.get(tags='c d')
+        f.tags = 'a e'
+        f.save()
+        Tag.objects.add_tag(f, 'f')
+        FormTest.objects.get(tags='b c').delete()
+        Tag.objects.update_tags_bulk([(f, 'a b')])
+        expected = self.live_usage(counts=True)
+        self.assertEquals(self.usage(counts=True), expected)
+        self.assertEquals(expected, [(u'a', 2), (u'b', 2), (u'c', 2)])
+        self.assertEquals(FormTest.tags, u'a b c')
+        counts = sorted(TagUsage.objects.values_list('content_type', 'tag', 'count'))
+        objects = sorted(TaggedObjectCount.objects.values_list('content_type', 'count'))
+        self.failUnless((model_infos.get(FormTest).content_type_id, 3) in objects, objects)
+        call_command('rebuild_tag_counts', verbosity=0)
+        self.assertEquals(sorted(TagUsage.objects.values_list('content_type', 'tag', 'count')), counts)
+        self.assertEquals(sorted(TaggedObjectCount.objects.values_list('content_type', 'count')), objects)
+
+    def test_rebuild_ignores_deleted_objects(self):
+        f = FormTest.objects.get(tags='c d')
+        FormTest.objects.filter(pk=f.pk).delete()
+        TagUsage.objects.rebuild()
+        self.assertEquals(self.usage(counts=True), self.live_usage(counts=True))
+
+class TestUsageSubsets(TestCase):
+    def setUp(self):
+        for size, smelly, tags in ((1, True, 'a b'), (2, True, 'b c'), (3, False, 'b d'), (4, False, '')):
+            Tag.objects.update_tags(Perch.objects.create(size=size, smelly=smelly), tags)
+
+    def usage(self, **kwargs):
+        return [(tag.name, tag.count) for tag in Tag.objects.usage_for_model(Perch, counts=True, **kwargs)]
+
+    def live_usage(self, queryset):
+        return [(tag.name, tag.count) for tag in Tag.objects.usage_for_queryset(queryset, counts=True)]
+
+    def test_subset_is_read_from_the_counts(self):
+        usage, queries = count_queries(self.usage, filters={'smelly': True})
+        self.assertEquals(queries, 1)
+        self.assertEquals(usage, [(u'a', 1), (u'b', 2), (u'c', 1)])
+        self.assertEquals(usage, self.live_usage(Perch.objects.filter(smelly=True)))
+        self.assertEquals(self.usage(), [(u'a', 1), (u'b', 3), (u'c', 1), (u'd', 1)])
+
+    def test_other_filters_are_counted_in_one_query(self):
+        usage, queries = count_queries(self.usage, filters={'size__gt': 1})
+        self.assertEquals(queries, 1)
+        self.assertEquals(usage, [(u'b', 2), (u'c', 1), (u'd', 1)])
+
+    def test_subset_counts_follow_changes(self):
+        perch = Perch.objects.get(size=3)
+        perch.smelly = True
+        perch.save()
+        perch = Perch.objects.get(size=1)
+        perch.smelly = False
+        perch.save()
+        Tag.objects.update_tags(perch, 'a e')
+        perch = Perch.objects.get(size=4)
+        perch.smelly = True
+        perch.save()
+        Tag.objects.add_tag(perch, 'f')
+        Tag.objects.update_tags_bulk([(Perch.objects.get(size=2), 'c d')])
+        Tag.objects.update_tags(Perch.objects.get(size=3), None)
+        expected = self.live_usage(Perch.objects.filter(smelly=True))
+        self.assertEquals(expected, [(u'c', 1), (u'd', 1), (u'f', 1)])
+        self.assertEquals(self.usage(filters={'smelly': True}), expected)
+        counts = sorted(TagUsage.objects.values_list('content_type', 'tag', 'subset', 'count'))
+        call_command('rebuild_tag_counts', verbosity=0)
+        self.assertEquals(sorted(TagUsage.objects.values_list('content_type', 'tag', 'subset', 'count')), counts)
+
+    def test_empty_querysets(self):
+        self.assertEquals(Tag.objects.usage_for_queryset(Perch.objects.none()), [])
+        self.assertEquals(Tag.objects.usage_for_queryset(Perch.objects.filter(pk__in=[])), [])
+        self.assertEquals(self.live_usage(Perch.objects.filter(size__gt=10)), [])
+
+class TestTagCloudCache(TestCase):
+    def setUp(self):
+        tag_generation.bump()
+        for tags in ('a b c', 'b c', 'c'):
+            FormTest.objects.create(tags=tags)
+
+    def render(self, options=''):
+        return Template('{% load tagging_tags %}'
+            '{% tag_cloud_for_model tests.FormTest as cloud with steps=3 ' + options + ' %}'
+            '{% for tag in cloud %}{{ tag.name }}={{ tag.font_size }} {% endfor %}').render(Context())
+
+    def test_cloud_is_cached(self):
+        self.assertEquals(self.render(), u'a=1 b=2 c=3 ')
+        output, queries = count_queries(self.render, 'cache=60')
+        self.assertEquals((output, queries), (u'a=1 b=2 c=3 ', 1))
+        output, queries = count_queries(self.render, 'cache=60')
+        self.assertEquals((output, queries), (u'a=1 b=2 c=3 ', 0))
+        output, queries = count_queries(self.render, 'cache=60 min_count=2')
+        self.assertEquals((output, queries), (u'b=1 c=3 ', 1))
+
+    def test_tag_changes_retire_cached_clouds(self):
+        self.render('cache=60')
+        Tag.objects.update_tags(FormTest.objects.get(tags='c'), 'a d')
+        self.assertEquals(self.render('cache=60'), u'a=3 b=3 c=3 d=1 ')
+        Tag.objects.add_tag(FormTest.objects.get(tags='b c'), 'd')
+        self.assertEquals(self.render('cache=60'), u'a=1 b=1 c=1 d=1 ')
+        tag = Tag.objects.get(name='d')
+        tag.name = 'e'
+        tag.save()
+        self.assertEquals(self.render('cache=60'), u'a=1 b=1 c=1 e=1 ')
+
+class TestTemplateTagModels(TestCase):
+    def test_models_are_resolved_when_compiled(self):
+        template = Template('{% load tagging_tags %}{% tags_for_model tests.FormTest as tags %}')
+        self.failUnless(template.nodelist[-1].model.model is FormTest)
+        for tag in ('tags_for_model tests.Cheese as tags', 'tag_cloud_for_model FormTest as tags',
+                    'tagged_objects tag in tests.FormTest.tags as objects'):
+            self.assertRaises(TemplateSyntaxError, Template, '{% load tagging_tags %}{% ' + tag + ' %}')
+
+    def test_models_are_resolved_when_rendered_before_they_are_loaded(self):
+        FormTest.objects.create(tags='cheese')
+        old_app_cache_ready, tagging_tags.app_cache_ready = tagging_tags.app_cache_ready, lambda: False
+        try:
+            template = Template('{% load tagging_tags %}{% tags_for_model tests.FormTest as tags %}'
+                '{% for tag in tags %}{{ tag.name }}{% endfor %}')
+            invalid = Template('{% load tagging_tags %}{% tags_for_model tests.Cheese as tags %}')
+        finally:
+            tagging_tags.app_cache_ready = old_app_cache_ready
+        self.assertEquals(template.nodelist[-2].model.model, None)
+        self.assertEquals(template.render(Context()), u'cheese')
+        self.failUnless(template.nodelist[-2].model.model is FormTest)
+        self.assertRaises(TemplateSyntaxError, invalid.render, Context())
+
+class TestModelInfoCache(TestCase):
+    def setUp(self):
+        model_infos.clear()
+
+    def test_model_info(self):
+        info = model_infos.get(Parrot)
+        self.assertEquals(info.content_type_id, ContentType.objects.get_for_model(Parrot).pk)
+        self.assertEquals(info.table, connection.ops.quote_name(Parrot._meta.db_table))
+        self.assertEquals(info.pk, '%s.%s' % (info.table, connection.ops.quote_name('id')))
+        self.failUnless(model_infos.get(Parrot(state='dead')) is info)
+
+    def test_warmed_in_one_query(self):
+        info, queries = count_queries(model_infos.get, Parrot)
+        self.assertEquals(queries, 1)
+        infos, queries = count_queries(lambda: [model_infos.get(model) for model in (Link, Article, Tag, TaggedItem)])
+        self.assertEquals(queries, 0)
+
+    def test_content_type_changes_empty_the_cache(self):
+        model_infos.get(Parrot)
+        ContentType.objects.get_for_model(Parrot).save()
+        info, queries = count_queries(model_infos.get, Parrot)
+        self.assertEquals(queries, 1)
+
 class TestModelTagField(TestCase):
     """ Test the 'tags' field on models. """
     
@@ -370,6 +985,39 @@ class TestModelTagField(TestCase):
         tags = Tag.objects.get_for_object(f1)
         self.assertEquals(len(tags), 0)
         
+class TestPrefetchTags(TestCase):
+    def setUp(self):
+        for i in range(20):
+            FormTest.objects.create(tags=u'common tag%s' % i)
+        FormTest.objects.create()
+        self.parrot = Parrot.objects.create(state='pining')
+        Tag.objects.update_tags(self.parrot, 'blue norwegian')
+
+    def test_prefetch_fills_tag_fields(self):
+        expected = [FormTest.objects.get(pk=f.pk).tags for f in FormTest.objects.all()]
+        objects, queries = count_queries(prefetch_tags, FormTest.objects.all())
+        self.assertEquals(queries, 2)  # the objects and their tags
+        tags, queries = count_queries(lambda: [f.tags for f in objects])
+        self.assertEquals(queries, 0)
+        self.assertEquals(tags, expected)
+        self.assertEquals(tags[0], u'common tag0')
+        self.assertEquals(tags[-1], u'')
+
+    def test_prefetch_mixed_models(self):
+        f1 = FormTest.objects.all()[0]
+        objects, queries = count_queries(prefetch_tags, [f1, self.parrot])
+        self.assertEquals(queries, 2)
+        self.assertEquals([tag.name for tag in self.parrot._prefetched_tags], [u'blue', u'norwegian'])
+
+    def test_descriptor_uses_prefetched_tags(self):
+        descriptor = TagDescriptor()
+        prefetch_tags([self.parrot])
+        tags, queries = count_queries(descriptor.__get__, self.parrot, Parrot)
+        self.assertEquals(queries, 0)
+        self.assertEquals([tag.name for tag in tags], [u'blue', u'norwegian'])
+        Tag.objects.update_tags(self.parrot, 'dead')
+        self.assertEquals([tag.name for tag in descriptor.__get__(self.parrot, Parrot)], [u'dead'])
+
 class TestSettings(TestCase):
     def setUp(self):
         self.original_force_lower_case_tags = settings.FORCE_LOWERCASE_TAGS
@@ -580,7 +1228,24 @@ class TestTagsRelatedForModel(TestCase):
         related_tags = Tag.objects.related_for_model(['bar', 'ter', 'baz'], Parrot, counts=True)
         relevant_attribute_list = [(tag.name, tag.count) for tag in related_tags]
         self.assertEquals(len(relevant_attribute_list), 0)
-        
+
+    def test_related_for_model_only_counts_common_related_tags(self):
+        parrot = Parrot.objects.create(state='chunked')
+        Tag.objects.update_tags(parrot, 'bar ter baz foo zed')
+        expected = [(tag.name, tag.count) for tag in Tag.objects.related_for_model(['bar', 'ter'], Parrot, counts=True)]
+        self.assertEquals(expected, [(u'baz', 2), (u'foo', 1), (u'zed', 1)])
+        from tagging import models as tagging_models
+        old_chunk_size = tagging_models.BULK_CHUNK_SIZE
+        tagging_models.BULK_CHUNK_SIZE = 2
+        try:
+            related, queries = count_queries(Tag.objects.related_for_model, ['bar', 'ter'], Parrot, counts=True)
+            # the tags, their co-occurrences, then the 3 candidates in chunks of 2
+            self.assertEquals(queries, 2 + 2)
+            self.assertEquals([(tag.name, tag.count) for tag in related], expected)
+        finally:
+            tagging_models.BULK_CHUNK_SIZE = old_chunk_size
+        self.assertEquals(Tag.objects.related_for_model([], Parrot), [])
+
 class TestGetTaggedObjectsByModel(TestCase):
     def setUp(self):
         parrot_details = (
@@ -696,6 +1361,46 @@ class TestGetTaggedObjectsByModel(TestCase):
         parrots = TaggedItem.objects.get_union_by_model(Parrot, [])
         self.assertEquals(len(parrots), 0)
 
+    def test_get_by_model_is_lazy(self):
+        for method in (TaggedItem.objects.get_intersection_by_model, TaggedItem.objects.get_union_by_model):
+            parrots, queries = count_queries(method, Parrot.objects.filter(perch__smelly=True), [self.foo, self.ter])
+            self.assertEquals(queries, 0)
+            count, queries = count_queries(parrots.count)
+            self.assertEquals(queries, 1)
+            first, queries = count_queries(lambda: list(parrots.order_by('state')[:1]))
+            self.assertEquals(queries, 1)
+        self.assertEquals(list(TaggedItem.objects.get_intersection_by_model(
+            Parrot.objects.filter(perch__smelly=True), ['foo', 'ter'])), [self.no_more_parrot])
+        self.assertEquals(TaggedItem.objects.get_union_by_model(
+            Parrot.objects.filter(perch__smelly=True), ['foo', 'ter']).count(), 2)
+        self.assertEquals(TaggedItem.objects.get_intersection_by_model(Parrot, ['foo', 'baz']).count(), 0)
+
+class TestStatementCache(TestCase):
+    def setUp(self):
+        for state, tags in (('late', 'bar ter'), ('no more', 'foo ter'), ('passed on', 'foo bar')):
+            Tag.objects.update_tags(Parrot.objects.create(state=state), tags)
+        self.foo, self.bar, self.ter = [Tag.objects.get(name=name) for name in ('foo', 'bar', 'ter')]
+        self.late_parrot = Parrot.objects.get(state='late')
+
+    def test_statements_are_built_once_per_shape(self):
+        statements.clear()
+        for tags in ([self.foo, self.bar], [self.bar, self.ter], [self.foo, self.ter]):
+            TaggedItem.objects.get_intersection_by_model(Parrot, tags)
+            TaggedItem.objects.get_union_by_model(Parrot, tags)
+            Tag.objects.related_for_model(tags, Parrot, counts=True)
+        self.assertEquals(len(statements._statements), 3)
+        TaggedItem.objects.get_intersection_by_model(Parrot, [self.foo, self.bar, self.ter])
+        self.assertEquals(len(statements._statements), 4)
+
+    def test_variable_data_is_bound(self):
+        statements.clear()
+        TaggedItem.objects.get_intersection_by_model(Parrot, [self.foo, self.bar])
+        TaggedItem.objects.get_related(self.late_parrot, Parrot, num=1)
+        Tag.objects.usage_for_queryset(Parrot.objects.all(), min_count=2)
+        placeholders = sorted([sql.count('%s') for sql in statements._statements.values() if isinstance(sql, basestring)])
+        # three content types and object; content type, two tags and tag count
+        self.assertEquals(placeholders, [4, 4])
+
 class TestGetRelatedTaggedItems(TestCase):
     def setUp(self):
         parrot_details = (
@@ -755,6 +1460,62 @@ class TestGetRelatedTaggedItems(TestCase):
         related_objects = TaggedItem.objects.get_related(self.a1, Link)
         self.assertEquals(len(related_objects), 0)
         
+class TestRankedRelatedTaggedItems(TestCase):
+    def setUp(self):
+        self.link = Link.objects.create(name='link')
+        Tag.objects.update_tags(self.link, 'common rare')
+        self.commoner = Link.objects.create(name='commoner')
+        Tag.objects.update_tags(self.commoner, 'common')
+        self.rarer = Link.objects.create(name='rarer')
+        Tag.objects.update_tags(self.rarer, 'rare')
+        for i in range(5):
+            Tag.objects.update_tags(Link.objects.create(name='other %s' % i), 'common')
+
+    def test_rare_tags_count_for_more(self):
+        related, queries = count_queries(TaggedItem.objects.get_related, self.link, Link, num=2)
+        self.assertEquals(queries, 3)
+        self.assertEquals(related[0], self.rarer)
+        self.assertEquals(related[1], self.commoner)
+        self.assertAlmostEquals(related[0].score, math.log(1 + 7.0 / 1))
+        self.assertAlmostEquals(related[1].score, math.log(1 + 7.0 / 6))
+
+    def test_common_tags_can_be_ignored(self):
+        related = TaggedItem.objects.get_related(self.link, Link, max_df=0.5)
+        self.assertEquals(related, [self.rarer])
+
+    def test_candidates_are_bounded(self):
+        Tag.objects.add_tag(self.commoner, 'rare')
+        related = TaggedItem.objects.get_related(self.link, Link, max_candidates=2)
+        # Only the uses of the rare tag are read for candidates, but they
+        # are scored on every tag
+        self.assertEquals(related, [self.commoner, self.rarer])
+        self.assertAlmostEquals(related[0].score, math.log(1 + 7.0 / 2) + math.log(1 + 7.0 / 6))
+        # The rare tag's uses are read in object id order when they don't all fit
+        related = TaggedItem.objects.get_related(self.link, Link, max_candidates=1)
+        self.assertEquals(related, [self.commoner])
+
+    def test_related_in_bulk_matches_one_at_a_time(self):
+        links = list(Link.objects.order_by('pk'))
+        related, queries = count_queries(TaggedItem.objects.get_related_in_bulk, links, Link, num=2)
+        # as many queries as get_related() takes for one of them
+        self.assertEquals(queries, 3)
+        for link in links:
+            expected = TaggedItem.objects.get_related(link, Link, num=2)
+            self.assertEquals(related[link.pk], expected)
+            self.assertEquals([r.score for r in related[link.pk]], [r.score for r in expected])
+
+    def test_instances_are_not_counted_per_query(self):
+        Link.objects.create(name='untagged')
+        old_debug, django_settings.DEBUG = django_settings.DEBUG, True
+        try:
+            connection.queries = []
+            related = TaggedItem.objects.get_related(self.link, Link, num=1)
+            self.failIf([q for q in connection.queries if 'COUNT(' in q['sql'].upper()])
+        finally:
+            django_settings.DEBUG = old_debug
+        # N is how many links have tags
+        self.assertAlmostEquals(related[0].score, math.log(1 + 7.0 / 1))
+
 class TestTagUsageForQuerySet(TestCase):
     def setUp(self):
         parrot_details = (
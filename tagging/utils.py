@@ -3,18 +3,117 @@ Tagging utilities - from user tag input parsing to tag cloud
 calculation.
 """
 import math
+import threading
+from bisect import bisect_left
+import time
 import types
 
+from django.db import transaction
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_unicode
+from django.utils.functional import wraps
 from django.utils.translation import ugettext as _
 
+from tagging import settings
+
+# NumPy is optional - it's used to size the tags of large clouds if it's
+# installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Python 2.3 compatibility
 try:
     set
 except NameError:
     from sets import Set as set
 
+class LRUCache(object):
+    """
+    A dictionary-like cache holding at most ``size`` entries, which
+    drops the least recently used entry to make room for a new one.
+    If ``timeout`` is given, entries also expire that many seconds
+    after they were set.
+
+    It's safe to share between threads.
+    """
+    def __init__(self, size, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.clock = time.time
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # Entries are [previous, next, key, value, expires] links in a
+            # circular list, most recently used last
+            self._entries = {}
+            self._root = root = []
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[4] is not None and entry[4] <= self.clock():
+                self._unlink(entry)
+                return default
+            self._unlink(entry)
+            self._link(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            elif len(self._entries) >= self.size:
+                self._unlink(self._root[1])
+            expires = self.timeout is not None and self.clock() + self.timeout or None
+            self._link([None, None, key, value, expires])
+        finally:
+            self._lock.release()
+
+    def discard_values(self, value):
+        """
+        Removes every entry holding ``value``.
+        """
+        self._lock.acquire()
+        try:
+            for entry in [entry for entry in self._entries.values() if entry[3] == value]:
+                self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        root = self._root
+        last = root[0]
+        entry[0], entry[1] = last, root
+        last[1] = root[0] = entry
+        self._entries[entry[2]] = entry
+
+    def _unlink(self, entry):
+        entry[0][1], entry[1][0] = entry[1], entry[0]
+        del self._entries[entry[2]]
+
+# Tag names parsed from tag input, and the ids of tags by name - which
+# the tagging models forget when tags are changed or deleted
+parsed_tags = LRUCache(settings.PARSED_TAGS_CACHE_SIZE)
+tag_ids = LRUCache(settings.TAG_IDS_CACHE_SIZE, settings.TAG_IDS_CACHE_TIMEOUT)
+
 def parse_tag_input(input):
     """
     Parses tag input, with multiple word input being activated and
@@ -27,6 +126,13 @@ def parse_tag_input(input):
         return []
 
     input = force_unicode(input)
+    words = parsed_tags.get(input)
+    if words is None:
+        words = _parse_tag_input(input)
+        parsed_tags.set(input, words)
+    return list(words)
+
+def _parse_tag_input(input):
 
     # Special case - if there are no commas or double quotes in the
     # input, we don't *do* a recall... I mean, we know we only need to
@@ -36,51 +142,23 @@ def parse_tag_input(input):
         words.sort()
         return words
 
-    words = []
-    buffer = []
-    # Defer splitting of non-quoted sections until we know if there are
-    # any unquoted commas.
-    to_be_split = []
-    saw_loose_comma = False
-    open_quote = False
-    i = iter(input)
-    try:
-        while 1:
-            c = i.next()
-            if c == u'"':
-                if buffer:
-                    to_be_split.append(u''.join(buffer))
-                    buffer = []
-                # Find the matching quote
-                open_quote = True
-                c = i.next()
-                while c != u'"':
-                    buffer.append(c)
-                    c = i.next()
-                if buffer:
-                    word = u''.join(buffer).strip()
-                    if word:
-                        words.append(word)
-                    buffer = []
-                open_quote = False
-            else:
-                if not saw_loose_comma and c == u',':
-                    saw_loose_comma = True
-                buffer.append(c)
-    except StopIteration:
-        # If we were parsing an open quote which was never closed treat
-        # the buffer as unquoted.
-        if buffer:
-            if open_quote and u',' in buffer:
-                saw_loose_comma = True
-            to_be_split.append(u''.join(buffer))
-    if to_be_split:
-        if saw_loose_comma:
-            delimiter = u','
-        else:
-            delimiter = u' '
-        for chunk in to_be_split:
-            words.extend(split_strip(chunk, delimiter))
+    # Splitting on double quotes leaves the unquoted sections at even
+    # positions and the quoted ones at odd positions - except a last
+    # quote which was never closed, whose text is treated as unquoted.
+    sections = input.split(u'"')
+    quoted = sections[1::2]
+    unquoted = sections[::2]
+    if len(sections) % 2 == 0:
+        unquoted.append(quoted.pop())
+
+    words = [word for word in [section.strip() for section in quoted] if word]
+    # Only split on spaces if there are no unquoted commas
+    if [section for section in unquoted if u',' in section]:
+        delimiter = u','
+    else:
+        delimiter = u' '
+    for section in unquoted:
+        words.extend(split_strip(section, delimiter))
     words = list(set(words))
     words.sort()
     return words
@@ -126,6 +204,19 @@ def edit_string_for_tags(tags):
         glue = u' '
     return glue.join(names)
 
+def commit_on_success_unless_managed(func):
+    """
+    Runs ``func`` in a transaction committed if it succeeds and rolled back
+    if it raises - unless a transaction is already being managed, eg by
+    a view decorator or the transaction middleware, in which case ``func``
+    becomes part of that one, for its owner to commit or roll back.
+    """
+    def _commit_on_success_unless_managed(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    return wraps(func)(_commit_on_success_unless_managed)
+
 def get_queryset_and_model(queryset_or_model):
     """
     Given a ``QuerySet`` or a ``Model``, returns a two-tuple of
@@ -165,7 +256,7 @@ def get_tag_list(tags):
     elif isinstance(tags, QuerySet) and tags.model is Tag:
         return tags
     elif isinstance(tags, types.StringTypes):
-        return Tag.objects.filter(name__in=parse_tag_input(tags))
+        return get_tags_by_name(parse_tag_input(tags))
     elif isinstance(tags, (types.ListType, types.TupleType)):
         if len(tags) == 0:
             return tags
@@ -179,8 +270,7 @@ def get_tag_list(tags):
                 contents.add('int')
         if len(contents) == 1:
             if 'string' in contents:
-                return Tag.objects.filter(name__in=[force_unicode(tag) \
-                                                    for tag in tags])
+                return get_tags_by_name([force_unicode(tag) for tag in tags])
             elif 'tag' in contents:
                 return tags
             elif 'int' in contents:
@@ -190,6 +280,33 @@ def get_tag_list(tags):
     else:
         raise ValueError(_('The tag input given was invalid.'))
 
+def get_tags_by_name(names):
+    """
+    Returns a list of the ``Tag`` objects with the given names, ordered
+    by name, looking up only the ids of names which aren't cached.
+
+    Ids read while the current transaction has uncommitted writes aren't
+    cached, as they may be of tags it created and a rollback would take
+    away again without any signals being sent.
+    """
+    from tagging.models import Tag
+    tags = []
+    missing = []
+    for name in set(names):
+        tag_id = tag_ids.get(name)
+        if tag_id is None:
+            missing.append(name)
+        else:
+            tags.append(Tag(id=tag_id, name=name))
+    if missing:
+        cacheable = not transaction.is_dirty()
+        for tag_id, name in Tag.objects.filter(name__in=missing).values_list('id', 'name'):
+            if cacheable:
+                tag_ids.set(name, tag_id)
+            tags.append(Tag(id=tag_id, name=name))
+    tags.sort(key=lambda tag: tag.name)
+    return tags
+
 def get_tag(tag):
     """
     Utility function for accepting single tag input in a flexible
@@ -207,7 +324,9 @@ def get_tag(tag):
 
     try:
         if isinstance(tag, types.StringTypes):
-            return Tag.objects.get(name=tag)
+            tags = get_tags_by_name([force_unicode(tag)])
+            if tags:
+                return tags[0]
         elif isinstance(tag, (types.IntType, types.LongType)):
             return Tag.objects.get(id=tag)
     except Tag.DoesNotExist:
@@ -235,6 +354,31 @@ def _calculate_tag_weight(weight, max_weight, distribution):
         return math.log(weight) * max_weight / math.log(max_weight)
     raise ValueError(_('Invalid distribution algorithm specified: %s.') % distribution)
 
+# The number of tags from which calculate_cloud uses NumPy, if it's there
+NUMPY_CLOUD_SIZE = 1000
+
+def _calculate_font_sizes(counts, max_weight, thresholds, distribution):
+    """
+    Returns the font size of each of ``counts`` - the position of the
+    first threshold its weight doesn't exceed, counting from 1. Each
+    distinct count is only weighted once.
+    """
+    font_sizes = {}
+    for count in set(counts):
+        font_sizes[count] = bisect_left(thresholds, _calculate_tag_weight(count, max_weight, distribution)) + 1
+    return [font_sizes[count] for count in counts]
+
+def _numpy_calculate_font_sizes(counts, max_weight, thresholds, distribution):
+    """
+    ``_calculate_font_sizes`` using NumPy to find the distinct counts
+    and their font sizes. The weights themselves are still worked out
+    by ``_calculate_tag_weight``, so they round exactly as it does.
+    """
+    distinct, positions = numpy.unique(numpy.asarray(counts), return_inverse=True)
+    weights = [_calculate_tag_weight(count, max_weight, distribution) for count in distinct.tolist()]
+    font_sizes = numpy.searchsorted(numpy.asarray(thresholds), weights, side='left') + 1
+    return font_sizes[positions].tolist()
+
 def calculate_cloud(tags, steps=4, distribution=LOGARITHMIC):
     """
     Add a ``font_size`` attribute to each tag according to the
@@ -253,11 +397,12 @@ def calculate_cloud(tags, steps=4, distribution=LOGARITHMIC):
         min_weight = float(min(counts))
         max_weight = float(max(counts))
         thresholds = _calculate_thresholds(min_weight, max_weight, steps)
-        for tag in tags:
-            font_set = False
-            tag_weight = _calculate_tag_weight(tag.count, max_weight, distribution)
-            for i in range(steps):
-                if not font_set and tag_weight <= thresholds[i]:
-                    tag.font_size = i + 1
-                    font_set = True
+        if numpy is not None and len(counts) >= NUMPY_CLOUD_SIZE:
+            font_sizes = _numpy_calculate_font_sizes(counts, max_weight, thresholds, distribution)
+        else:
+            font_sizes = _calculate_font_sizes(counts, max_weight, thresholds, distribution)
+        for tag, font_size in zip(tags, font_sizes):
+            # A weight rounded past the last threshold gets no font size
+            if font_size <= steps:
+                tag.font_size = font_size
     return tags